@@ -0,0 +1,160 @@
+"""
+Local stand-in for the OpenAI Files and Batch APIs, so batch recommendation generation can be tested offline.
+
+Run it from the project root and point the batch client at it:
+    uvicorn client.local_batch_server:app --port 8001
+    BATCH_API_BASE_URL=http://localhost:8001/v1
+
+Batches complete right after creation, every chat completion request gets a short templated response.
+"""
+import json
+import re
+import time
+import uuid
+from typing import Dict, Optional
+
+from fastapi import BackgroundTasks, FastAPI, File, Form, HTTPException, UploadFile
+from fastapi.responses import PlainTextResponse
+from pydantic import BaseModel
+
+app = FastAPI(title="Local Batch API stand-in")
+
+# in-memory state, lost on restart
+FILES: Dict[str, dict] = {}
+FILE_CONTENTS: Dict[str, bytes] = {}
+BATCHES: Dict[str, dict] = {}
+
+NAME_PATTERN = re.compile(r"- Name: (.+)")
+
+
+class BatchCreateRequest(BaseModel):
+    input_file_id: str
+    endpoint: str
+    completion_window: str
+    metadata: Optional[Dict[str, str]] = None
+
+
+def _store_file(filename: str, purpose: str, content: bytes) -> dict:
+    file_id = f"file-{uuid.uuid4().hex}"
+    FILES[file_id] = {
+        "id": file_id,
+        "object": "file",
+        "bytes": len(content),
+        "created_at": int(time.time()),
+        "filename": filename,
+        "purpose": purpose,
+        "status": "processed",
+    }
+    FILE_CONTENTS[file_id] = content
+    return FILES[file_id]
+
+
+def _complete(body: dict) -> dict:
+    """Build a templated chat completion for the request body."""
+    user_content = next((m["content"] for m in body.get("messages", []) if m["role"] == "user"), "")
+    match = NAME_PATTERN.search(user_content)
+    name = match.group(1).strip() if match else "there"
+
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", "gpt-4o-mini"),
+        "choices": [
+            {
+                "index": 0,
+                "message": {
+                    "role": "assistant",
+                    "content": f"Great work today, {name}! Let's keep building healthy habits together tomorrow.",
+                },
+                "finish_reason": "stop",
+            }
+        ],
+        "usage": {"prompt_tokens": len(user_content) // 4, "completion_tokens": 16, "total_tokens": len(user_content) // 4 + 16},
+    }
+
+
+def _process_batch(batch_id: str) -> None:
+    batch = BATCHES[batch_id]
+    batch["status"] = "in_progress"
+    batch["in_progress_at"] = int(time.time())
+
+    lines = [json.loads(line) for line in FILE_CONTENTS[batch["input_file_id"]].decode().splitlines() if line.strip()]
+    output_lines = []
+    for line in lines:
+        output_lines.append({
+            "id": f"batch_req_{uuid.uuid4().hex}",
+            "custom_id": line["custom_id"],
+            "response": {"status_code": 200, "request_id": uuid.uuid4().hex, "body": _complete(line["body"])},
+            "error": None,
+        })
+
+    output = "".join(json.dumps(line) + "\n" for line in output_lines).encode()
+    output_file = _store_file(f"{batch_id}_output.jsonl", "batch_output", output)
+
+    batch.update({
+        "status": "completed",
+        "output_file_id": output_file["id"],
+        "finalizing_at": int(time.time()),
+        "completed_at": int(time.time()),
+        "request_counts": {"total": len(lines), "completed": len(lines), "failed": 0},
+    })
+
+
+@app.post("/v1/files")
+async def create_file(file: UploadFile = File(...), purpose: str = Form(...)) -> dict:
+    return _store_file(file.filename, purpose, await file.read())
+
+
+@app.get("/v1/files/{file_id}")
+def retrieve_file(file_id: str) -> dict:
+    if file_id not in FILES:
+        raise HTTPException(status_code=404, detail="File not found")
+    return FILES[file_id]
+
+
+@app.get("/v1/files/{file_id}/content", response_class=PlainTextResponse)
+def retrieve_file_content(file_id: str) -> PlainTextResponse:
+    if file_id not in FILE_CONTENTS:
+        raise HTTPException(status_code=404, detail="File not found")
+    return PlainTextResponse(FILE_CONTENTS[file_id].decode())
+
+
+@app.post("/v1/batches")
+def create_batch(request: BatchCreateRequest, background_tasks: BackgroundTasks) -> dict:
+    if request.input_file_id not in FILES:
+        raise HTTPException(status_code=404, detail="Input file not found")
+
+    batch_id = f"batch_{uuid.uuid4().hex}"
+    BATCHES[batch_id] = {
+        "id": batch_id,
+        "object": "batch",
+        "endpoint": request.endpoint,
+        "input_file_id": request.input_file_id,
+        "completion_window": request.completion_window,
+        "status": "validating",
+        "output_file_id": None,
+        "error_file_id": None,
+        "created_at": int(time.time()),
+        "request_counts": {"total": 0, "completed": 0, "failed": 0},
+        "metadata": request.metadata,
+    }
+    background_tasks.add_task(_process_batch, batch_id)
+
+    return dict(BATCHES[batch_id])
+
+
+@app.get("/v1/batches/{batch_id}")
+def retrieve_batch(batch_id: str) -> dict:
+    if batch_id not in BATCHES:
+        raise HTTPException(status_code=404, detail="Batch not found")
+    return BATCHES[batch_id]
+
+
+@app.post("/v1/batches/{batch_id}/cancel")
+def cancel_batch(batch_id: str) -> dict:
+    if batch_id not in BATCHES:
+        raise HTTPException(status_code=404, detail="Batch not found")
+    if BATCHES[batch_id]["status"] not in ("completed", "failed", "expired"):
+        BATCHES[batch_id]["status"] = "cancelled"
+    return BATCHES[batch_id]
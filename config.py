@@ -1,5 +1,5 @@
 from pydantic_settings import BaseSettings
-from typing import List
+from typing import Dict, List, Optional
 from dotenv import load_dotenv
 
 
@@ -16,6 +16,135 @@ class Settings(BaseSettings):
     # External Services
     OPENAI_API_KEY: str = ""  # Will be loaded from environment variable
 
+    # Orchestration
+    ORCHESTRATION_MODERATION_WORKERS: int = 16  # threads for moderation checks, apart from the completions
+    SPECULATIVE_COMPLETION: bool = True  # start the LLM completion before moderation has finished
+    BULK_MAX_CONCURRENCY: int = 8  # recommendations generated in parallel for a single bulk request
+
+    # Deadlines, recommendations fall back to a template when the assistant can't answer in time
+    RECOMMENDATION_DEADLINE_SECONDS: float = 10.0  # when the client doesn't send X-Request-Timeout-Ms
+    RECOMMENDATION_DEADLINE_MAX_SECONDS: float = 30.0
+    DEADLINE_MODERATION_BUDGET_SECONDS: float = 3.0
+    DEADLINE_OUTPUT_MODERATION_BUDGET_SECONDS: float = 1.0  # kept back from the completion to moderate its text
+    DEADLINE_FALLBACK_RESERVE_SECONDS: float = 0.05  # kept back from every stage to build the fallback
+
+    # Admission control
+    ADMISSION_ENABLED: bool = True
+    ADMISSION_USER_RATE_PER_MINUTE: float = 6.0
+    ADMISSION_USER_BURST: int = 5
+    ADMISSION_CARETAKER_RATE_PER_MINUTE: float = 30.0
+    ADMISSION_CARETAKER_BURST: int = 20
+    ADMISSION_MAX_CONCURRENT_LLM_REQUESTS: int = 64  # bulk requests hold one slot per item they run concurrently
+    ADMISSION_CONCURRENCY_RETRY_AFTER_SECONDS: float = 1.0
+    ADMISSION_MAX_TRACKED_KEYS: int = 100_000  # token buckets kept in memory
+
+    # Outbound LLM concurrency, adapted to the provider's capacity
+    LLM_LIMITER_INITIAL_LIMIT: int = 16
+    LLM_LIMITER_MIN_LIMIT: int = 1
+    LLM_LIMITER_MAX_LIMIT: int = 64
+    LLM_LIMITER_DECREASE_RATIO: float = 0.7  # limit multiplier on rate limits and latency spikes
+    LLM_LIMITER_LATENCY_TOLERANCE: float = 2.0  # latency relative to the baseline that counts as a spike
+    LLM_LIMITER_ACQUIRE_TIMEOUT_SECONDS: float = 30.0  # max time a call waits for a free slot
+    LLM_LIMITER_MAX_ATTEMPTS: int = 4  # attempts per call while the provider is rate limiting
+    LLM_LIMITER_BACKOFF_BASE_SECONDS: float = 0.5  # doubled on every retry
+    LLM_LIMITER_BACKOFF_MAX_SECONDS: float = 20.0
+
+    # Hedging and circuit breaking per LLM call site: moderation, recommendation, behavior_alert
+    HEDGE_CALL_SITES: List[str] = []  # call sites that send a second request when the first one is slow
+    HEDGE_PERCENTILE: float = 0.95  # latency percentile after which the hedge is sent
+    HEDGE_MIN_DELAY_SECONDS: float = 0.2
+    HEDGE_MIN_SAMPLES: int = 20  # latencies recorded before hedging starts
+    HEDGE_LATENCY_WINDOW_SIZE: int = 200
+    HEDGE_MAX_RATIO: float = 0.1  # max share of calls that get a hedge
+    HEDGE_MAX_WORKERS: int = 64
+    BREAKER_SLOW_CALL_SECONDS: Dict[str, float] = {"moderation": 2.0, "recommendation": 8.0, "behavior_alert": 10.0}
+    BREAKER_WINDOW_SIZE: int = 50  # recent calls the failure and slow call rates are computed over
+    BREAKER_MIN_CALLS: int = 20
+    BREAKER_FAILURE_RATE_THRESHOLD: float = 0.5
+    BREAKER_SLOW_CALL_RATE_THRESHOLD: float = 0.5
+    BREAKER_OPEN_SECONDS: float = 30.0  # time before a probe call is let through
+
+    # Moderation
+    MODERATION_PATTERNS_PATH: Optional[str] = None  # JSON terms and patterns file, defaults to the bundled one
+    MODERATION_BATCH_MAX_ITEMS: int = 256  # texts accepted by a single batch moderation request
+    MODERATION_BATCH_MAX_INPUTS: int = 32  # texts sent to the moderation API per array-input call
+    OUTPUT_MODERATION: bool = True  # moderate generated recommendations before they are saved or returned
+    STREAM_MODERATION: bool = True  # moderate streamed recommendations as they are generated
+    STREAM_MODERATION_LOCAL_OVERLAP: int = 100  # chars before a chunk checked with it, must exceed the longest term
+    STREAM_MODERATION_TIMEOUT_SECONDS: float = 5.0  # max wait for the last moderation API check of a stream
+
+    # Behavior analysis
+    BEHAVIOR_DIGEST_MAX_CHILDREN: int = 10  # children analyzed together in one caretaker digest call
+    BEHAVIOR_CACHE_TTL_SECONDS: float = 60 * 60
+    BEHAVIOR_CACHE_MAX_ENTRIES: int = 10_000
+
+    # Streaming anomaly detection over steps, calories, sleep and weight
+    ANOMALY_EWMA_ALPHA: float = 0.2  # weight of the newest day in a user's baseline
+    ANOMALY_WARMUP_DAYS: int = 7  # days of a metric seen before its anomalies are reported
+    ANOMALY_ZSCORE_THRESHOLD: float = 3.0  # a single day this many standard deviations off is an outlier
+    ANOMALY_CUSUM_SLACK: float = 0.5  # standard deviations per day tolerated before a shift accumulates
+    ANOMALY_CUSUM_THRESHOLD: float = 4.0  # accumulated standard deviations that signal a sustained shift
+    ANOMALY_MAX_TRACKED_USERS: int = 100_000
+
+    # Population percentiles of the daily metrics per age band and sex
+    POPULATION_SKETCH_K: int = 200  # quantile sketch accuracy, rank error is about 1.7 / k
+    POPULATION_MIN_SAMPLES: int = 50  # values a cohort needs before its percentiles are added to prompts
+    POPULATION_MAX_TRACKED_USERS: int = 100_000
+    POPULATION_WORKER_ID: Optional[str] = None  # identifies this worker's exported sketches, defaults to host:pid
+    POPULATION_MAX_MERGED_WORKERS: int = 64  # other workers whose sketches are kept, the least recently merged go
+    PROMPT_PEER_PERCENTILES: bool = False  # tell the assistant the child's percentiles among their peers
+
+    # Goal progress
+    GOAL_HISTORY_DAYS: int = 31  # days of metrics kept per user to evaluate goals, enough for a monthly period
+    GOAL_HISTORY_MAX_USERS: int = 100_000
+    GOAL_WEIGHT_TOLERANCE_KG: float = 1.0  # how close to a weight target counts as met
+    GOAL_BATCH_MAX_GOALS: int = 10_000  # goals accepted by a single batch evaluation request
+
+    # Prompts
+    PROMPT_MAX_USER_TOKENS: int = 600  # estimated tokens of a request's own context, long lists are cut short
+    PROMPT_FEW_SHOT_EXAMPLES: bool = False  # add the few-shot examples to every coach's static prompt prefix
+
+    # Recommendation store
+    RECOMMENDATION_DB_PATH: str = "recommendations.db"
+    RECOMMENDATION_DB_BATCH_SIZE: int = 100  # max writes committed per transaction
+    RECOMMENDATION_DB_FLUSH_INTERVAL_SECONDS: float = 0.05  # max time a write waits for its batch to fill up
+    RECOMMENDATION_DB_WRITE_ATTEMPTS: int = 3  # attempts per batch before it's queued again behind newer writes
+    RECOMMENDATION_DB_RETRY_BACKOFF_SECONDS: float = 0.5  # doubled on every attempt
+    RECOMMENDATION_DB_MAX_REQUEUES: int = 5  # times a failed write is queued again before it's dropped
+
+    # Idempotency
+    IDEMPOTENCY_TTL_SECONDS: float = 24 * 60 * 60  # how long responses are kept for retried requests
+    IDEMPOTENCY_MAX_ENTRIES: int = 100_000
+
+    # Recommendation jobs
+    JOB_WORKER_COUNT: int = 4
+    JOB_QUEUE_MAX_DEPTH: int = 1000  # submissions are rejected once this many jobs are waiting
+    JOB_MAX_ATTEMPTS: int = 3
+    JOB_RETRY_BACKOFF_SECONDS: float = 2.0  # doubled on every retry
+    JOB_RESULT_TTL_SECONDS: float = 60 * 60  # how long finished jobs can be polled
+    JOB_CALLBACK_TIMEOUT_SECONDS: float = 10.0
+
+    # Just-in-time pre-generation
+    SCHEDULER_LEAD_MINUTES: int = 30  # how long before the send window a recommendation is generated
+    SCHEDULER_WAVE_SIZE: int = 50  # max recommendations handed to the job workers per wave
+    SCHEDULER_WAVE_INTERVAL_SECONDS: float = 60.0  # min time between waves
+
+    # Batch API
+    BATCH_API_BASE_URL: Optional[str] = None  # e.g. http://localhost:8001/v1 for client/local_batch_server.py
+    BATCH_WORK_DIR: str = "batches"  # where JSONL batch request files are written
+    BATCH_COMPLETION_WINDOW: str = "24h"
+    BATCH_PRICE_MULTIPLIER: float = 0.5  # Batch API discount on the per-token prices
+    BATCH_RESULT_TTL_SECONDS: float = 24 * 60 * 60  # how long ingested batches are kept for later polls
+    BATCH_RESULT_MAX_ENTRIES: int = 1000
+
+    # Usage accounting
+    LLM_PRICES_PER_MILLION_TOKENS: Dict[str, Dict[str, float]] = {
+        "gpt-4o-mini": {"prompt": 0.15, "cached_prompt": 0.075, "completion": 0.60},
+        "omni-moderation-latest": {"prompt": 0.0, "completion": 0.0},
+    }
+    USAGE_COHORT_AGE_BOUNDARIES: List[int] = [6, 10, 13, 16]  # users are grouped into the age bands between these
+    USAGE_RECOMMENDATION_CALL_SITES: List[str] = ["moderation", "recommendation", "recommendation_batch"]
+
     # CORS Settings
     ALLOWED_ORIGINS: List[str] = ["http://localhost:3000", "http://localhost:8000"]
 
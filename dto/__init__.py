@@ -1,9 +1,13 @@
 from .metrics import DailyMetric
 from .recommendation import Recommendation, BehavioralRecommendation
 from .user import UserProfile
-from .goal import Goal, GoalType, GoalPeriod
+from .goal import Goal, GoalType, GoalPeriod, GoalProgress, GoalProgressRequest
 from .coach import Coach, GPTModel, AssistantTool, Metadata
 from .timing import TimingPolicyUpdate, TimingPolicyType, TimingPolicyResponse
+from .batch import RecommendationRequest, RecommendationBatchStatus, RecommendationBulkResult, BulkItemError
+from .job import JobStatus, RecommendationJob, ScheduledRecommendation
+from .moderation import ModerationBatchRequest
+from .caretaker import CaretakerDigestRequest, ChildBehaviorMetrics
 
 __all__ = [
     "DailyMetric",
@@ -13,6 +17,8 @@ __all__ = [
     "Goal",
     "GoalType",
     "GoalPeriod",
+    "GoalProgress",
+    "GoalProgressRequest",
     "Coach",
     "GPTModel",
     "AssistantTool",
@@ -20,4 +26,14 @@ __all__ = [
     "TimingPolicyUpdate",
     "TimingPolicyType",
     "TimingPolicyResponse",
+    "RecommendationRequest",
+    "RecommendationBatchStatus",
+    "RecommendationBulkResult",
+    "BulkItemError",
+    "JobStatus",
+    "RecommendationJob",
+    "ScheduledRecommendation",
+    "ModerationBatchRequest",
+    "CaretakerDigestRequest",
+    "ChildBehaviorMetrics",
 ]
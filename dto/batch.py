@@ -0,0 +1,55 @@
+"""DTOs for offline bulk recommendation generation."""
+from datetime import datetime
+from typing import Any, List, Optional
+
+from pydantic import BaseModel, Field
+
+from .goal import Goal
+from .metrics import DailyMetric
+from .recommendation import Recommendation
+from .user import UserProfile
+
+
+class RecommendationRequest(BaseModel):
+    """Inputs for a single user's daily recommendation."""
+    profile: UserProfile
+    daily_metrics: DailyMetric
+    goals: List[Goal] = Field(default_factory=list)
+
+    class Config:
+        from_attributes = True
+
+
+class RecommendationBatchStatus(BaseModel):
+    """Status of a batch of recommendations generated through the Batch API."""
+    batch_id: str
+    status: str  # validating / in_progress / finalizing / completed / failed / expired / cancelling / cancelled
+    total_count: int = 0
+    completed_count: int = 0
+    failed_count: int = 0
+    flagged_user_ids: List[str] = Field(default_factory=list)  # users whose goals or generated message were flagged
+    failed_user_ids: List[str] = Field(default_factory=list)  # users whose request failed within the batch
+    recommendations: List[Recommendation] = Field(default_factory=list)  # only populated once completed
+
+    created_at: Optional[datetime] = None
+    completed_at: Optional[datetime] = None
+
+    class Config:
+        from_attributes = True
+
+
+class BulkItemError(BaseModel):
+    """Error for a single item of a bulk request."""
+    type: str  # invalid_request / rate_limited / content_flagged / internal_error
+    detail: Any
+
+
+class RecommendationBulkResult(BaseModel):
+    """Outcome of a single item of a bulk recommendation request, streamed as one NDJSON line."""
+    index: int  # position of the item in the request
+    user_id: str
+    recommendation: Optional[Recommendation] = None
+    error: Optional[BulkItemError] = None
+
+    class Config:
+        from_attributes = True
@@ -0,0 +1,19 @@
+"""DTOs for caretaker-level behavior analysis."""
+from typing import List
+
+from pydantic import BaseModel, Field
+
+from .metrics import DailyMetric
+from .user import UserProfile
+
+
+class ChildBehaviorMetrics(BaseModel):
+    """A child's profile and daily metrics."""
+    profile: UserProfile
+    metrics: List[DailyMetric]
+
+
+class CaretakerDigestRequest(BaseModel):
+    """All of a caretaker's children, analyzed together in one assistant call."""
+    caretaker_id: str
+    children: List[ChildBehaviorMetrics] = Field(min_length=1)
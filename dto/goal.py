@@ -1,7 +1,9 @@
 import enum
 from pydantic import BaseModel, Field
 from datetime import datetime
-from typing import Optional
+from typing import List, Optional
+
+from .metrics import DailyMetric
 
 
 class GoalType(str, enum.Enum):
@@ -39,3 +41,24 @@ class Goal(BaseModel):
 
     class Config:
         from_attributes = True
+
+
+class GoalProgress(BaseModel):
+    """Progress of a goal over its current period."""
+    goal_id: str
+    user_id: str
+    metric: str
+    period: GoalPeriod
+    target: float
+    value: Optional[float] = None  # None if there are no metrics in the period
+    progress: float = 0.0  # value relative to the target, 1.0 or more once reached
+    status: str = Field("active", pattern="^(active|met|expired)$")  # expired once a ceiling is exceeded
+    period_start: datetime
+    period_end: Optional[datetime] = None  # exclusive, None for lifetime goals
+
+
+class GoalProgressRequest(BaseModel):
+    """Goals of any number of users, evaluated against their metric history."""
+    goals: List[Goal] = Field(min_length=1)
+    metrics: List[DailyMetric] = Field(default_factory=list)
+    as_of: Optional[datetime] = None  # day the periods are evaluated on, the user's latest metric day by default
@@ -0,0 +1,44 @@
+"""DTOs for asynchronous recommendation jobs."""
+import enum
+from datetime import datetime
+from typing import Optional
+
+from pydantic import BaseModel, Field
+
+from .recommendation import Recommendation
+
+
+class JobStatus(str, enum.Enum):
+    """Lifecycle of a job."""
+    QUEUED = "queued"
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+
+
+class RecommendationJob(BaseModel):
+    """A recommendation generated in the background, returned when the client asks for async processing."""
+    id: str
+    user_id: str
+    status: JobStatus = JobStatus.QUEUED
+    attempts: int = 0
+    recommendation: Optional[Recommendation] = None  # set once the job succeeded
+    error: Optional[str] = None  # set once the job failed
+    callback_url: Optional[str] = None  # receives the job as a POST once it succeeded or failed
+
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    updated_at: datetime = Field(default_factory=datetime.utcnow)
+
+    class Config:
+        from_attributes = True
+
+
+class ScheduledRecommendation(BaseModel):
+    """A recommendation that will be generated shortly before its send window."""
+    user_id: str
+    send_time: int  # hour at which the send window begins
+    generate_at: datetime
+    job_id: Optional[str] = None  # set once the recommendation was handed to a job worker
+
+    class Config:
+        from_attributes = True
@@ -0,0 +1,9 @@
+"""DTOs for content moderation."""
+from typing import List
+
+from pydantic import BaseModel, Field
+
+
+class ModerationBatchRequest(BaseModel):
+    """Texts to moderate in a single request."""
+    contents: List[str] = Field(min_length=1)
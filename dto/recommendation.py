@@ -13,9 +13,11 @@ class Recommendation(BaseModel):
     - Should this be split into multiple messages?
     """
     id: str
+    user_id: Optional[str] = None
     message: str
     send_time: int  # hour indicating when the msg should be sent
     badge: Optional[str] = None  # gold / silver / bronze
+    is_fallback: bool = False  # template message used because the assistant couldn't answer before the deadline
 
     created_at: datetime  # when the recommendation was created by the orchestration system
 
@@ -32,6 +34,7 @@ class BehavioralRecommendation(BaseModel):
     summary: str
     suggested_step: str
     triggered_rules: list[str]  # list of rule IDs that triggered this recommendation
+    is_fallback: bool = False  # template alert for the triggered rules used because the assistant was unavailable
 
     generated_at: datetime = Field(default_factory=datetime.utcnow)
 
@@ -1,15 +1,35 @@
+import math
 import yaml
 import os
 import sys
 import logging.config
+from contextlib import asynccontextmanager
 
-from fastapi import FastAPI, status
+from fastapi import Depends, FastAPI, status
 from fastapi.middleware.cors import CORSMiddleware
-from starlette.responses import JSONResponse
+from starlette.responses import JSONResponse, PlainTextResponse
 
 from .config import settings
-from .router import recommendation_router, behavior_router, timing_router, moderation_router
-from .service import ContentDetectionFlaggedError
+from .router import (
+    recommendation_router,
+    behavior_router,
+    timing_router,
+    moderation_router,
+    monitoring_router,
+    population_router,
+    goal_router,
+)
+from .service import (
+    AdmissionRejectedError,
+    ContentDetectionFlaggedError,
+    IdempotencyKeyReusedError,
+    JobQueueFullError,
+    UpstreamOverloadedError,
+    default_job_service,
+    default_metrics_registry,
+    default_recommendation_store,
+    default_scheduler,
+)
 from pathlib import Path
 
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
@@ -28,13 +48,44 @@ else:
         f"Logging configuration file not found: {CONFIG_PATH}, using basicConfig"
     )
 
+
+def _log_queue_samples():
+    """Records dropped by each async log handler, see `structured_logging.AsyncStreamHandler`."""
+    handlers = {
+        handler
+        for name in (None, "uvicorn.error", "uvicorn.access")
+        for handler in logging.getLogger(name).handlers
+        if hasattr(handler, "dropped")
+    }
+    return [("coaching_log_records_dropped", {"handler": handler.get_name()}, handler.dropped) for handler in handlers]
+
+
+# records are dropped rather than blocking requests when the async log handlers can't keep up
+default_metrics_registry.register_collector("Log records dropped by full logging queues.", _log_queue_samples)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # the store's database is opened here rather than on import
+    default_recommendation_store.start()
+    yield
+    default_scheduler.stop()
+    default_job_service.stop(timeout=settings.JOB_CALLBACK_TIMEOUT_SECONDS)
+    # commit recommendations that are still queued for the store
+    default_recommendation_store.close()
+
+
 app = FastAPI(
     title="Coaching Engine API",
     description="Prototyped Coaching Engine API",
     version="1.0.0",
     debug=settings.DEBUG,
+    lifespan=lifespan,
+    dependencies=[Depends(monitoring_router.label_route)],
 )
 
+app.add_middleware(monitoring_router.MetricsMiddleware)
+
 # Configure CORS
 app.add_middleware(
     CORSMiddleware,
@@ -67,15 +118,63 @@ async def content_detection_flagged_handler(request, exc):
     )
 
 
+@app.exception_handler(IdempotencyKeyReusedError)
+async def idempotency_key_reused_handler(request, exc):
+    """Handle idempotency keys that are reused for a different request."""
+    return JSONResponse(
+        status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+        content={"detail": str(exc)},
+    )
+
+
+@app.exception_handler(JobQueueFullError)
+async def job_queue_full_handler(request, exc):
+    """Handle job submissions while the queue is full."""
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"detail": str(exc)},
+        headers={"Retry-After": str(int(settings.JOB_RETRY_BACKOFF_SECONDS) or 1)},
+    )
+
+
+@app.exception_handler(AdmissionRejectedError)
+async def admission_rejected_handler(request, exc):
+    """Reject excess load quickly so clients back off instead of timing out."""
+    return JSONResponse(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        content={"detail": str(exc), "reason": exc.reason},
+        headers={"Retry-After": str(max(1, math.ceil(exc.retry_after)))},
+    )
+
+
+@app.exception_handler(UpstreamOverloadedError)
+async def upstream_overloaded_handler(request, exc):
+    """Handle requests that couldn't be served because the LLM provider stayed overloaded."""
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"detail": str(exc)},
+        headers={"Retry-After": str(max(1, math.ceil(exc.retry_after)))},
+    )
+
+
 @app.get("/health")
 async def health_check():
     return {"status": "healthy"}
 
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    """Metrics in the Prometheus text format."""
+    return PlainTextResponse(default_metrics_registry.render(), media_type="text/plain; version=0.0.4")
+
 # app.include_router(coach_router.router)
 app.include_router(recommendation_router.router)
 app.include_router(behavior_router.router)
 app.include_router(timing_router.router)
 app.include_router(moderation_router.router)
+app.include_router(monitoring_router.router)
+app.include_router(population_router.router)
+app.include_router(goal_router.router)
 
 if __name__ == "__main__":
     import uvicorn
@@ -1,8 +1,11 @@
+from .anomaly_detector import AnomalyDetector, default_anomaly_detector
 from .risk_predictor import RiskPredictor, DemoRiskPredictor, demo_risk_predictor
 from .timing_policy import ThompsonSamplerTimingPolicy, TimingPolicy, thompson_timing_policy
 from .timing_policy_factory import TimingPolicyFactory
 
 __all__ = [
+    "AnomalyDetector",
+    "default_anomaly_detector",
     "RiskPredictor",
     "DemoRiskPredictor",
     "demo_risk_predictor",
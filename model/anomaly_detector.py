@@ -0,0 +1,183 @@
+"""Online per-user anomaly detection over the daily metrics."""
+import math
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+from ..config import settings
+from ..dto import DailyMetric
+
+# monitored DailyMetric fields, with the name used in the rule ids and the smallest standard deviation assumed so
+# a user with very regular days doesn't alert on every small change
+MONITORED_METRICS = {
+    "steps": ("STEPS", 250.0),
+    "calories_in": ("CALORIES", 100.0),
+    "sleep_hours": ("SLEEP", 0.25),
+    "weight_kg": ("WEIGHT", 0.2),
+}
+
+# anomalies are reported while their day is within this many days of the newest metric of the analyzed window
+ANOMALY_LOOKBACK_DAYS = 7
+
+
+class MetricDetector:
+    """
+    EWMA, z-score and CUSUM detection over one metric of one user, in constant memory.
+
+    The exponentially weighted mean and variance are the user's baseline. A value whose z-score against the baseline
+    is above `z_threshold` is an outlier. The two-sided CUSUM accumulates the z-scores beyond `cusum_slack`, so a
+    sustained shift is detected even when no single day is an outlier, and is reset once it has signalled.
+    """
+
+    __slots__ = ("count", "mean", "variance", "cusum_high", "cusum_low", "last_date", "anomalies", "anomaly_date")
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.variance = 0.0
+        self.cusum_high = 0.0
+        self.cusum_low = 0.0
+        self.last_date: Optional[datetime] = None
+        # anomalies of the most recent day that had any
+        self.anomalies: List[str] = []
+        self.anomaly_date: Optional[datetime] = None
+
+    def update(
+        self,
+        name: str,
+        value: float,
+        date: datetime,
+        min_std: float,
+        alpha: float,
+        warmup: int,
+        z_threshold: float,
+        cusum_slack: float,
+        cusum_threshold: float,
+    ) -> None:
+        """Add a day's value, in O(1)."""
+        if self.count == 0:
+            self.mean = value
+        else:
+            z_score = (value - self.mean) / max(math.sqrt(self.variance), min_std)
+
+            if self.count >= warmup:
+                anomalies = []
+                if z_score > z_threshold:
+                    anomalies.append(f"{name}_OUTLIER_HIGH")
+                elif z_score < -z_threshold:
+                    anomalies.append(f"{name}_OUTLIER_LOW")
+
+                self.cusum_high = max(0.0, self.cusum_high + z_score - cusum_slack)
+                self.cusum_low = max(0.0, self.cusum_low - z_score - cusum_slack)
+                if self.cusum_high > cusum_threshold:
+                    anomalies.append(f"{name}_SHIFT_UP")
+                    self.cusum_high = 0.0
+                if self.cusum_low > cusum_threshold:
+                    anomalies.append(f"{name}_SHIFT_DOWN")
+                    self.cusum_low = 0.0
+
+                if anomalies:
+                    self.anomalies = anomalies
+                    self.anomaly_date = date
+
+            # incremental exponentially weighted mean and variance
+            diff = value - self.mean
+            increment = alpha * diff
+            self.mean += increment
+            self.variance = (1 - alpha) * (self.variance + diff * increment)
+
+        self.count += 1
+        self.last_date = date
+
+
+class AnomalyDetector:
+    """
+    Per-user streaming anomaly detection over steps, calories, sleep and weight.
+
+    Each metric of a user keeps a `MetricDetector`, so memory is constant per user whatever their history length and
+    every new `DailyMetric` is an O(1) update. Analyzed windows usually overlap the previous ones, only days newer than
+    the last one seen for the user are added, so repeated requests don't skew the baseline.
+    """
+
+    def __init__(
+        self,
+        alpha: Optional[float] = None,
+        warmup_days: Optional[int] = None,
+        z_threshold: Optional[float] = None,
+        cusum_slack: Optional[float] = None,
+        cusum_threshold: Optional[float] = None,
+        max_users: Optional[int] = None,
+    ):
+        """
+        Initialize the detector.
+
+        Args:
+            alpha (Optional[float]): Weight of the newest day in the baseline, defaults to `settings.ANOMALY_EWMA_ALPHA`.
+            warmup_days (Optional[int]): Days added before anything is reported, defaults to
+                `settings.ANOMALY_WARMUP_DAYS`.
+            z_threshold (Optional[float]): Z-score of an outlier, defaults to `settings.ANOMALY_ZSCORE_THRESHOLD`.
+            cusum_slack (Optional[float]): Z-score tolerated per day by the CUSUM, defaults to
+                `settings.ANOMALY_CUSUM_SLACK`.
+            cusum_threshold (Optional[float]): Accumulated z-score of a shift, defaults to
+                `settings.ANOMALY_CUSUM_THRESHOLD`.
+            max_users (Optional[int]): Users kept in memory, the least recently updated are evicted first, defaults to
+                `settings.ANOMALY_MAX_TRACKED_USERS`.
+        """
+        self.alpha = alpha or settings.ANOMALY_EWMA_ALPHA
+        self.warmup_days = warmup_days or settings.ANOMALY_WARMUP_DAYS
+        self.z_threshold = z_threshold or settings.ANOMALY_ZSCORE_THRESHOLD
+        self.cusum_slack = cusum_slack or settings.ANOMALY_CUSUM_SLACK
+        self.cusum_threshold = cusum_threshold or settings.ANOMALY_CUSUM_THRESHOLD
+        self.max_users = max_users or settings.ANOMALY_MAX_TRACKED_USERS
+        self._users: "OrderedDict[str, Dict[str, MetricDetector]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def observe(self, user_id: str, metrics: List[DailyMetric]) -> List[str]:
+        """
+        Add the user's new days and return the anomalies found within the last week of the window.
+
+        Args:
+            user_id (str): The user the metrics belong to, metrics of any other user are ignored so they can't
+                change this user's baselines.
+            metrics (List[DailyMetric]): The user's daily metrics, in any order.
+
+        Returns:
+            List[str]: Anomaly rule ids, e.g. "SLEEP_SHIFT_DOWN" or "CALORIES_OUTLIER_LOW".
+        """
+        metrics = sorted((metric for metric in metrics if metric.user_id == user_id), key=lambda metric: metric.date)
+        if not metrics:
+            return []
+
+        since = metrics[-1].date - timedelta(days=ANOMALY_LOOKBACK_DAYS)
+
+        with self._lock:
+            detectors = self._users.get(user_id)
+            if detectors is None:
+                detectors = {field: MetricDetector() for field in MONITORED_METRICS}
+                self._users[user_id] = detectors
+                if len(self._users) > self.max_users:
+                    self._users.popitem(last=False)
+            else:
+                self._users.move_to_end(user_id)
+
+            anomalies = []
+            for field, (name, min_std) in MONITORED_METRICS.items():
+                detector = detectors[field]
+                for metric in metrics:
+                    value = getattr(metric, field)
+                    if value is None or (detector.last_date is not None and metric.date <= detector.last_date):
+                        continue
+                    detector.update(
+                        name, float(value), metric.date, min_std,
+                        self.alpha, self.warmup_days, self.z_threshold, self.cusum_slack, self.cusum_threshold,
+                    )
+
+                if detector.anomaly_date is not None and since < detector.anomaly_date <= metrics[-1].date:
+                    anomalies.extend(detector.anomalies)
+
+        return anomalies
+
+
+# TODO: replace with DI/singleton
+default_anomaly_detector = AnomalyDetector()
@@ -1,11 +1,18 @@
 import logging
 from typing import List, Optional
 
-from fastapi import HTTPException, APIRouter
+from fastapi import HTTPException, APIRouter, Header, Query, Response
 
-from ..dto import BehavioralRecommendation
-from ..service import default_orchestrator
-from ..dto import DailyMetric, UserProfile
+from ..config import settings
+from ..service import (
+    default_orchestrator,
+    default_recommendation_store,
+    default_idempotency_store,
+    default_admission_controller,
+    default_behavior_cache,
+    request_fingerprint,
+)
+from ..dto import BehavioralRecommendation, CaretakerDigestRequest, DailyMetric, UserProfile
 
 logger = logging.getLogger(__name__)
 
@@ -28,7 +35,12 @@ router = APIRouter(
         }
     },
 )
-def create_behavioral_analysis(profile: UserProfile, metrics: List[DailyMetric]):
+def create_behavioral_analysis(
+    profile: UserProfile,
+    metrics: List[DailyMetric],
+    response: Response,
+    idempotency_key: Optional[str] = Header(None, description="Retries with the same key get the original response."),
+):
     """Primary endpoint consumed by Orchestrator or Assistants function call."""
 
     # basic validation of request payload
@@ -38,17 +50,90 @@ def create_behavioral_analysis(profile: UserProfile, metrics: List[DailyMetric])
     if len(metrics) < 7:
         raise HTTPException(status_code=400, detail="At least 7 days of metrics are required")
 
-    behavior_rec = default_orchestrator.check_for_concerning_behaviors(
-        user_profile=profile,
-        daily_metrics=metrics,
-    )
+    if any(metric.user_id != profile.user_id for metric in metrics):
+        raise HTTPException(status_code=400, detail="user_id mismatch between profile and metrics")
+
+    def analyze() -> Optional[BehavioralRecommendation]:
+        with default_admission_controller.admit(profile.user_id, profile.caretaker_id):
+            return default_orchestrator.check_for_concerning_behaviors(
+                user_profile=profile,
+                daily_metrics=metrics,
+            )
 
-    logger.info(f"Behavioral recommendation created: user_id={profile.user_id}, rec={behavior_rec}")
+    def check_for_concerning_behaviors() -> Optional[BehavioralRecommendation]:
+        # repeated views of the same metric window are served from the cache, without taking admission tokens
+        return default_behavior_cache.get_or_analyze(profile, metrics, analyze)
+
+    if idempotency_key is None:
+        behavior_rec = check_for_concerning_behaviors()
+    else:
+        behavior_rec, replayed = default_idempotency_store.run(
+            key=f"behavior:{idempotency_key}",
+            fingerprint=request_fingerprint(profile, *metrics),
+            fn=check_for_concerning_behaviors,
+        )
+        if replayed:
+            response.headers["Idempotent-Replayed"] = "true"
+
+    logger.info(
+        "Behavioral recommendation created - user_id=%s, id=%s",
+        profile.user_id, behavior_rec.id if behavior_rec else None,
+    )
 
     return behavior_rec
 
 
+@router.post("/caretaker/", response_model=List[BehavioralRecommendation])
+def create_caretaker_digest(request: CaretakerDigestRequest):
+    """
+    Analyze all of a caretaker's children in one assistant call, returns an alert per child that needs action.
+    """
+    if len(request.children) > settings.BEHAVIOR_DIGEST_MAX_CHILDREN:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {settings.BEHAVIOR_DIGEST_MAX_CHILDREN} children can be analyzed together",
+        )
+
+    user_ids = [child.profile.user_id for child in request.children]
+    if len(set(user_ids)) != len(user_ids):
+        raise HTTPException(status_code=400, detail="Each child can only be included once")
+
+    for child in request.children:
+        if child.profile.caretaker_id not in (None, "UNKNOWN", request.caretaker_id):
+            raise HTTPException(status_code=400, detail=f"Child {child.profile.user_id} has a different caretaker")
+        if len(child.metrics) < 7:
+            raise HTTPException(
+                status_code=400, detail=f"At least 7 days of metrics are required for child {child.profile.user_id}"
+            )
+        if any(metric.user_id != child.profile.user_id for metric in child.metrics):
+            raise HTTPException(status_code=400, detail=f"user_id mismatch between profile and metrics of child {child.profile.user_id}")
+
+    with default_admission_controller.admit(None, request.caretaker_id):
+        recommendations = default_orchestrator.check_caretaker_digest(
+            caretaker_id=request.caretaker_id,
+            children=[(child.profile, child.metrics) for child in request.children],
+        )
+
+    logger.info(
+        "Caretaker digest created - caretaker_id=%s, children=%d, alerts=%d",
+        request.caretaker_id, len(request.children), len(recommendations),
+    )
+
+    return recommendations
+
+
+@router.get("/user/{user_id}", response_model=List[BehavioralRecommendation])
+def list_behavioral_recommendations(user_id: str, limit: int = Query(20, ge=1, le=100)):
+    """Get a user's most recent behavioral recommendations, newest first."""
+    return default_recommendation_store.list_behavioral_recommendations(user_id, limit=limit)
+
+
 @router.get("/{recommendation_id}", response_model=BehavioralRecommendation)
 def get_behavioral_recommendation(recommendation_id: str):
     """Get an existing recommendation by ID."""
-    return HTTPException(status_code=501, detail="Not implemented")
+    recommendation = default_recommendation_store.get_behavioral_recommendation(recommendation_id)
+
+    if recommendation is None:
+        raise HTTPException(status_code=404, detail="Behavioral recommendation not found")
+
+    return recommendation
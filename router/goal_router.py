@@ -0,0 +1,38 @@
+from typing import List
+
+from fastapi import APIRouter, HTTPException
+
+from ..config import settings
+from ..dto import GoalProgress, GoalProgressRequest
+from ..service import default_goal_progress_service
+
+router = APIRouter(
+    prefix="/goals",
+    tags=["goals"],
+    responses={404: {"description": "Not found"}},
+)
+
+
+@router.post("/progress", response_model=List[GoalProgress])
+def evaluate_goal_progress(request: GoalProgressRequest) -> List[GoalProgress]:
+    """
+    Progress of the active goals of any number of users over their current period, in the order of `goals`.
+
+    Without `metrics`, goals are evaluated against the metric history kept from the users' recommendations. Goals on
+    untracked metrics or without a numeric target are left out.
+    """
+    if len(request.goals) > settings.GOAL_BATCH_MAX_GOALS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {settings.GOAL_BATCH_MAX_GOALS} goals can be evaluated per request",
+        )
+
+    metrics = request.metrics
+    if not metrics:
+        metrics = [
+            metric
+            for user_id in {goal.user_id for goal in request.goals}
+            for metric in default_goal_progress_service.history(user_id)
+        ]
+
+    return default_goal_progress_service.evaluate(request.goals, metrics, as_of=request.as_of)
@@ -1,6 +1,10 @@
-from fastapi import APIRouter
+from typing import List
+
+from fastapi import APIRouter, HTTPException
 from openai.types import Moderation
 
+from ..config import settings
+from ..dto import ModerationBatchRequest
 from ..service import default_content_detection_service
 
 router = APIRouter(
@@ -14,3 +18,24 @@ router = APIRouter(
 def detect_text_content(content: str) -> Moderation:
     """Get the timing for a specific policy type and user."""
     return default_content_detection_service.detect_content(content)
+
+
+@router.post("/textContentDetection/batch", response_model=List[Moderation])
+def detect_text_content_many(request: ModerationBatchRequest) -> List[Moderation]:
+    """Moderate many texts in one request, results are in the order of `contents`."""
+    if len(request.contents) > settings.MODERATION_BATCH_MAX_ITEMS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {settings.MODERATION_BATCH_MAX_ITEMS} texts can be moderated per request",
+        )
+    return default_content_detection_service.detect_content_many(request.contents)
+
+
+@router.post("/patterns/reload")
+def reload_patterns() -> dict:
+    """Reload the local moderation terms and patterns from their file, without a restart."""
+    try:
+        categories = default_content_detection_service.reload_patterns()
+    except (OSError, ValueError) as exc:
+        raise HTTPException(status_code=422, detail=f"Patterns not reloaded: {exc}")
+    return {"categories": categories}
@@ -0,0 +1,97 @@
+import time
+from typing import Optional
+
+from fastapi import APIRouter, Request
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from ..service import (
+    default_admission_controller,
+    default_call_sites,
+    default_completion_limiter,
+    default_moderation_limiter,
+    default_usage_tracker,
+)
+from ..service.metrics import HTTP_REQUEST_DURATION, HTTP_REQUESTS_IN_FLIGHT, current_route
+
+router = APIRouter(
+    prefix="/monitoring",
+    tags=["monitoring"],
+    responses={404: {"description": "Not found"}},
+)
+
+
+@router.get("/admission")
+def get_admission_stats() -> dict:
+    """Admission control counters: admitted and rejected requests, and LLM-bound requests in flight."""
+    return default_admission_controller.stats()
+
+
+@router.get("/llm-limits")
+def get_llm_limit_stats() -> dict:
+    """Adaptive concurrency limits of the outbound LLM calls: current limits, calls in flight and congestion signals."""
+    return {
+        default_completion_limiter.name: default_completion_limiter.stats(),
+        default_moderation_limiter.name: default_moderation_limiter.stats(),
+    }
+
+
+@router.get("/call-sites")
+def get_call_site_stats() -> dict:
+    """Hedges fired and won, failures and circuit breaker state of each LLM call site."""
+    return {name: call_site.stats() for name, call_site in default_call_sites.items()}
+
+
+@router.get("/usage")
+def get_usage(call_site: Optional[str] = None, model: Optional[str] = None, cohort: Optional[str] = None) -> dict:
+    """
+    Tokens and estimated cost of the LLM calls by call site, model and user cohort, with the cost per delivered
+    recommendation of each cohort. Counted since the process started.
+    """
+    return default_usage_tracker.report(call_site=call_site, model=model, cohort=cohort)
+
+
+async def label_route(request: Request) -> None:
+    """
+    App-wide dependency making the route template available to the pipeline stages through `current_route`, so their
+    metrics can be broken down per route. Async so it runs in the request's context rather than a copy of it.
+    """
+    current_route.set(request.scope["route"].path)
+
+
+class MetricsMiddleware:
+    """
+    Records the latency of every HTTP request, labelled by route template, and the number of requests in flight.
+
+    Unmatched paths share a single label to keep the number of series bounded.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status_code = 500
+
+        async def send_with_status(message: Message) -> None:
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        HTTP_REQUESTS_IN_FLIGHT.inc()
+        started_at = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # the router sets the matched route on the scope, streamed responses are only done once their body was sent
+            route = scope.get("route")
+            HTTP_REQUEST_DURATION.observe(
+                time.perf_counter() - started_at,
+                route=getattr(route, "path", "unmatched"),
+                method=scope["method"],
+                status=str(status_code),
+            )
+            HTTP_REQUESTS_IN_FLIGHT.dec()
@@ -0,0 +1,58 @@
+from typing import Dict, Optional
+
+from fastapi import APIRouter, Body, HTTPException, Query
+
+from ..service import default_population_percentiles, population_cohort
+from ..service.percentile_service import PERCENTILE_METRICS
+
+router = APIRouter(
+    prefix="/population",
+    tags=["population"],
+    responses={404: {"description": "Not found"}},
+)
+
+
+@router.get("/percentiles/{metric}")
+def get_percentiles(
+    metric: str,
+    age: int = Query(..., ge=2, le=19),
+    sex: Optional[str] = None,
+    value: Optional[float] = None,
+) -> dict:
+    """
+    Quantiles of a daily metric among the users of an age and sex, and the percentile of `value` if given.
+    """
+    if metric not in PERCENTILE_METRICS:
+        raise HTTPException(status_code=400, detail=f"Unknown metric, expected one of {list(PERCENTILE_METRICS)}")
+
+    cohort = population_cohort(age, sex)
+    summary = default_population_percentiles.summary(cohort, metric)
+    if summary is None:
+        raise HTTPException(status_code=404, detail=f"No {metric} values for cohort {cohort} yet")
+
+    result = {"cohort": cohort, "metric": metric, **summary}
+    if value is not None:
+        result["percentile"] = default_population_percentiles.percentile(cohort, metric, value)
+    return result
+
+
+@router.get("/sketches")
+def export_sketches() -> dict:
+    """This worker's own quantile sketches per cohort and metric, with its worker id, to be merged into another's."""
+    return default_population_percentiles.export()
+
+
+@router.post("/sketches")
+def merge_sketches(
+    worker_id: str = Body(...),
+    sketches: Dict[str, Dict[str, dict]] = Body(...),
+) -> dict:
+    """
+    Merge another worker's exported quantile sketches, replacing the ones merged from that worker before, so
+    posting the same export again doesn't count its values twice.
+    """
+    try:
+        cohorts = default_population_percentiles.merge({"worker_id": worker_id, "sketches": sketches})
+    except ValueError as exc:
+        raise HTTPException(status_code=422, detail=f"Sketches not merged: {exc}")
+    return {"cohorts": cohorts}
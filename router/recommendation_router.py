@@ -1,10 +1,41 @@
-from typing import List
+import json
+import logging
+from typing import Iterator, List, Optional, Union
 
-from fastapi import HTTPException, APIRouter
+from fastapi import HTTPException, APIRouter, Header, Query, Response, status
+from fastapi.responses import JSONResponse, StreamingResponse
 
-from ..service import default_orchestrator
-from ..dto import DailyMetric, Recommendation, UserProfile, Goal
+from ..config import settings
+from ..service import (
+    default_orchestrator,
+    default_batch_recommendation_service,
+    default_recommendation_store,
+    default_idempotency_store,
+    default_job_service,
+    default_scheduler,
+    default_admission_controller,
+    request_fingerprint,
+    AdmissionRejectedError,
+    ContentDetectionFlaggedError,
+    EmptyBatchError,
+    UpstreamOverloadedError,
+)
+from ..service.admission_control import AdmissionTicket
+from ..service.deadline import Deadline
+from ..dto import (
+    DailyMetric,
+    Recommendation,
+    UserProfile,
+    Goal,
+    RecommendationRequest,
+    RecommendationBatchStatus,
+    RecommendationBulkResult,
+    RecommendationJob,
+    ScheduledRecommendation,
+    BulkItemError,
+)
 
+logger = logging.getLogger(__name__)
 
 router = APIRouter(
     prefix="/recommendation",
@@ -16,21 +47,324 @@ router = APIRouter(
 )
 
 
-@router.post("/")
-def create_recommendation(profile: UserProfile, daily_metrics: DailyMetric, goals: List[Goal]) -> Recommendation:
-    """Primary endpoint consumed by Orchestrator or Assistants function call."""
-
-    # Very basic validation of request payload
+def _validate_recommendation_request(profile: UserProfile, daily_metrics: DailyMetric) -> None:
+    """Very basic validation of request payload."""
     if not profile or not daily_metrics:
         raise HTTPException(status_code=400, detail="missing profile or metrics")
 
     if profile.user_id != daily_metrics.user_id:
         raise HTTPException(status_code=400, detail="user_id mismatch between profile and metrics")
 
-    return default_orchestrator.create_daily_recommendation(profile, daily_metrics, goals)
+
+def _format_server_sent_event(event: str, data: str) -> str:
+    """Format a single server-sent event, `data` must not contain newlines."""
+    return f"event: {event}\ndata: {data}\n\n"
+
+
+def _to_server_sent_events(events: Iterator[Union[str, Recommendation]], ticket: AdmissionTicket) -> Iterator[str]:
+    """Convert the orchestrator's recommendation stream into server-sent events, admission lasts until it ends."""
+    try:
+        for event in events:
+            if isinstance(event, Recommendation):
+                # the message was already sent token by token
+                yield _format_server_sent_event("recommendation", event.model_dump_json(exclude={"message"}))
+            else:
+                yield _format_server_sent_event("token", json.dumps({"delta": event}))
+    except ContentDetectionFlaggedError as exc:
+        # the client must discard the text it already received
+        yield _format_server_sent_event(
+            "error",
+            json.dumps({"detail": "The recommendation was withdrawn by moderation.", "categories": exc.flagged_categories}),
+        )
+    except UpstreamOverloadedError as exc:
+        # the text couldn't be moderated, so it's withdrawn too
+        yield _format_server_sent_event(
+            "error",
+            json.dumps({"detail": "The recommendation was withdrawn, it couldn't be moderated.", "retry_after": exc.retry_after}),
+        )
+    except Exception:
+        # the status code was already sent, so errors can only be reported in-band
+        logger.exception("Recommendation stream failed")
+        yield _format_server_sent_event(
+            "error", json.dumps({"detail": "Unknown error occurred. Please contact responsible team."})
+        )
+    finally:
+        ticket.release()
+
+
+def _to_ndjson_results(
+    requests: List[RecommendationRequest],
+    max_concurrency: int,
+    ticket: AdmissionTicket,
+) -> Iterator[str]:
+    """Validate and process the bulk items, converting each outcome into an NDJSON line as soon as it's available."""
+    try:
+        yield from _process_bulk_items(requests, max_concurrency)
+    finally:
+        ticket.release()
+
+
+def _process_bulk_items(requests: List[RecommendationRequest], max_concurrency: int) -> Iterator[str]:
+    valid_indexes = []
+    for index, request in enumerate(requests):
+        try:
+            _validate_recommendation_request(request.profile, request.daily_metrics)
+            # the bulk request holds the concurrency slots, the items only spend their users' tokens
+            default_admission_controller.admit(request.profile.user_id, request.profile.caretaker_id, slots=0)
+            valid_indexes.append(index)
+        except HTTPException as exc:
+            error = BulkItemError(type="invalid_request", detail=exc.detail)
+            yield _format_bulk_result(index, request, error=error)
+        except AdmissionRejectedError as exc:
+            error = BulkItemError(type="rate_limited", detail={"reason": exc.reason, "retry_after": exc.retry_after})
+            yield _format_bulk_result(index, request, error=error)
+
+    results = default_orchestrator.create_daily_recommendations(
+        [requests[index] for index in valid_indexes],
+        max_concurrency=max_concurrency,
+    )
+    for valid_index, result in results:
+        index = valid_indexes[valid_index]
+        if isinstance(result, Recommendation):
+            yield _format_bulk_result(index, requests[index], recommendation=result)
+        elif isinstance(result, ContentDetectionFlaggedError):
+            error = BulkItemError(type="content_flagged", detail=result.flagged_categories)
+            yield _format_bulk_result(index, requests[index], error=error)
+        else:
+            error = BulkItemError(type="internal_error", detail="Unknown error occurred. Please contact responsible team.")
+            yield _format_bulk_result(index, requests[index], error=error)
+
+
+def _format_bulk_result(
+    index: int,
+    request: RecommendationRequest,
+    recommendation: Optional[Recommendation] = None,
+    error: Optional[BulkItemError] = None,
+) -> str:
+    result = RecommendationBulkResult(
+        index=index,
+        user_id=request.profile.user_id,
+        recommendation=recommendation,
+        error=error,
+    )
+    return result.model_dump_json(exclude_none=True) + "\n"
+
+
+def _accepted_job_response(job: RecommendationJob, replayed: bool = False) -> JSONResponse:
+    headers = {"Location": f"{router.prefix}/jobs/{job.id}"}
+    if replayed:
+        headers["Idempotent-Replayed"] = "true"
+
+    return JSONResponse(status_code=status.HTTP_202_ACCEPTED, content=job.model_dump(mode="json"), headers=headers)
+
+
+@router.post(
+    "/",
+    responses={
+        202: {
+            "model": RecommendationJob,
+            "description": "Job accepted when the request has a `Prefer: respond-async` header, "
+                           "poll `GET /recommendation/jobs/{job_id}` or wait for the callback.",
+        },
+        503: {"description": "Job queue is full"},
+    },
+)
+def create_recommendation(
+    profile: UserProfile,
+    daily_metrics: DailyMetric,
+    goals: List[Goal],
+    response: Response,
+    idempotency_key: Optional[str] = Header(None, description="Retries with the same key get the original response."),
+    prefer: Optional[str] = Header(None, description="`respond-async` to generate the recommendation as a job."),
+    callback_url: Optional[str] = Query(None, description="Receives the finished job as a POST, for async jobs."),
+    x_request_timeout_ms: Optional[int] = Header(
+        None,
+        gt=0,
+        description="Time the client waits for the recommendation, a template recommendation marked as "
+                    "`is_fallback` is returned if the assistant can't answer in time.",
+    ),
+) -> Recommendation:
+    """Primary endpoint consumed by Orchestrator or Assistants function call."""
+    _validate_recommendation_request(profile, daily_metrics)
+
+    if prefer and "respond-async" in prefer.lower():
+        request = RecommendationRequest(profile=profile, daily_metrics=daily_metrics, goals=goals)
+
+        def submit_job() -> RecommendationJob:
+            # the client doesn't wait on the LLM, so the job queue bounds concurrency instead of admission control
+            default_admission_controller.admit(profile.user_id, profile.caretaker_id, slots=0)
+            return default_job_service.submit(request, callback_url=callback_url)
+
+        if idempotency_key is None:
+            return _accepted_job_response(submit_job())
+
+        job, replayed = default_idempotency_store.run(
+            key=f"recommendation-job:{idempotency_key}",
+            fingerprint=request_fingerprint(request),
+            fn=submit_job,
+        )
+        # replays report the job's current status rather than the status at submission
+        return _accepted_job_response(default_job_service.get(job.id) or job, replayed=replayed)
+
+    # started before admission and idempotency, time spent there counts towards the client's timeout
+    deadline = Deadline.from_timeout_ms(x_request_timeout_ms)
+
+    def create() -> Recommendation:
+        with default_admission_controller.admit(profile.user_id, profile.caretaker_id):
+            return default_orchestrator.create_daily_recommendation(profile, daily_metrics, goals, deadline=deadline)
+
+    if idempotency_key is None:
+        return create()
+
+    # replays don't go through admission control, they are answered without any LLM calls
+    recommendation, replayed = default_idempotency_store.run(
+        key=f"recommendation:{idempotency_key}",
+        fingerprint=request_fingerprint(profile, daily_metrics, *goals),
+        fn=create,
+    )
+    if replayed:
+        response.headers["Idempotent-Replayed"] = "true"
+
+    return recommendation
+
+
+@router.post(
+    "/stream",
+    response_class=StreamingResponse,
+    responses={
+        200: {
+            "description": "Server-sent events: `token` events with a `delta` of the message, followed by a "
+                           "`recommendation` event with the recommendation metadata or an `error` event.",
+            "content": {"text/event-stream": {}},
+        }
+    },
+)
+def stream_recommendation(profile: UserProfile, daily_metrics: DailyMetric, goals: List[Goal]) -> StreamingResponse:
+    """Streaming variant of the recommendation endpoint for interactive coach chats."""
+    _validate_recommendation_request(profile, daily_metrics)
+
+    ticket = default_admission_controller.admit(profile.user_id, profile.caretaker_id)
+    try:
+        events = default_orchestrator.stream_daily_recommendation(profile, daily_metrics, goals)
+    except Exception:
+        ticket.release()
+        raise
+
+    return StreamingResponse(
+        _to_server_sent_events(events, ticket),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.post(
+    "/bulk",
+    response_class=StreamingResponse,
+    responses={
+        200: {
+            "description": "One `RecommendationBulkResult` JSON object per line, in order of completion.",
+            "content": {"application/x-ndjson": {}},
+        }
+    },
+)
+def create_recommendations_bulk(
+    requests: List[RecommendationRequest],
+    max_concurrency: int = Query(settings.BULK_MAX_CONCURRENCY, ge=1, le=settings.BULK_MAX_CONCURRENCY),
+) -> StreamingResponse:
+    """Create recommendations for many users, each result is streamed back as soon as it is ready."""
+    if not requests:
+        raise HTTPException(status_code=400, detail="missing recommendation requests")
+
+    # holds a slot for every item that can run at once
+    ticket = default_admission_controller.admit(None, slots=max_concurrency)
+
+    return StreamingResponse(
+        _to_ndjson_results(requests, max_concurrency, ticket),
+        media_type="application/x-ndjson",
+    )
+
+
+@router.post("/batch", response_model=RecommendationBatchStatus)
+def create_recommendation_batch(requests: List[RecommendationRequest]) -> RecommendationBatchStatus:
+    """Submit daily recommendations for many users to the Batch API, for recommendations that aren't time-critical."""
+    if not requests:
+        raise HTTPException(status_code=400, detail="missing recommendation requests")
+
+    user_ids = set()
+    for request in requests:
+        _validate_recommendation_request(request.profile, request.daily_metrics)
+        if request.profile.user_id in user_ids:
+            raise HTTPException(status_code=400, detail=f"duplicate user_id in batch: {request.profile.user_id}")
+        user_ids.add(request.profile.user_id)
+
+    try:
+        return default_batch_recommendation_service.submit_batch(requests)
+    except EmptyBatchError as exc:
+        raise HTTPException(
+            status_code=422,
+            detail={"message": "every user of the batch was flagged", "flagged_user_ids": exc.flagged_user_ids},
+        )
+
+
+@router.get("/batch/{batch_id}", response_model=RecommendationBatchStatus)
+def get_recommendation_batch(batch_id: str) -> RecommendationBatchStatus:
+    """Poll a recommendation batch, the recommendations are included once the batch has completed."""
+    return default_batch_recommendation_service.get_batch(batch_id)
+
+
+@router.post("/schedule", status_code=status.HTTP_202_ACCEPTED, response_model=List[ScheduledRecommendation])
+def schedule_recommendations(
+    requests: List[RecommendationRequest],
+    callback_url: Optional[str] = Query(None, description="Receives each finished job as a POST."),
+) -> List[ScheduledRecommendation]:
+    """
+    Generate recommendations shortly before each user's send window instead of right away.
+
+    Scheduling a user again before their recommendation is generated replaces the inputs with the latest metrics.
+    """
+    if not requests:
+        raise HTTPException(status_code=400, detail="missing recommendation requests")
+
+    for request in requests:
+        _validate_recommendation_request(request.profile, request.daily_metrics)
+
+    return [default_scheduler.schedule(request, callback_url=callback_url) for request in requests]
+
+
+@router.get("/schedule/{user_id}", response_model=ScheduledRecommendation)
+def get_scheduled_recommendation(user_id: str) -> ScheduledRecommendation:
+    """Get a user's latest scheduled recommendation, its `job_id` is set once generation started."""
+    scheduled = default_scheduler.get(user_id)
+
+    if scheduled is None:
+        raise HTTPException(status_code=404, detail="No scheduled recommendation")
+
+    return scheduled
+
+
+@router.get("/jobs/{job_id}", response_model=RecommendationJob)
+def get_recommendation_job(job_id: str) -> RecommendationJob:
+    """Get the status of a recommendation job, including the recommendation once it succeeded."""
+    job = default_job_service.get(job_id)
+
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    return job
+
+
+@router.get("/user/{user_id}", response_model=List[Recommendation])
+def list_recommendations(user_id: str, limit: int = Query(20, ge=1, le=100)) -> List[Recommendation]:
+    """Get a user's most recent recommendations, newest first."""
+    return default_recommendation_store.list_recommendations(user_id, limit=limit)
 
 
 @router.get("/{recommendation_id}", response_model=Recommendation)
 def get_recommendation(recommendation_id: str) -> Recommendation:
     """Get an existing recommendation by ID."""
-    raise HTTPException(status_code=501, detail="Not implemented")
+    recommendation = default_recommendation_store.get_recommendation(recommendation_id)
+
+    if recommendation is None:
+        raise HTTPException(status_code=404, detail="Recommendation not found")
+
+    return recommendation
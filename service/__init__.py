@@ -2,23 +2,133 @@ from ..model import DemoRiskPredictor, ThompsonSamplerTimingPolicy
 from .assistant_service import AssistantService, assistant_service
 from .behavioral_analysis_service import BehavioralAnalysisService, behavior_service
 from .orchestration_service import OrchestrationService
+from .batch_recommendation_service import BatchRecommendationService
+from .recommendation_store import RecommendationStore
+from .job_service import RecommendationJobService
+from .scheduler_service import PreGenerationScheduler
 from .content_detection_service import default_content_detection_service
-from .exceptions import ContentDetectionFlaggedError
+from .exceptions import (
+    AdmissionRejectedError,
+    ContentDetectionFlaggedError,
+    EmptyBatchError,
+    IdempotencyKeyReusedError,
+    JobQueueFullError,
+    UpstreamOverloadedError,
+    CircuitOpenError,
+)
+from .admission_control import AdmissionController, default_admission_controller
+from .call_site import CallSite, default_call_sites
+from .concurrency_limiter import AdaptiveConcurrencyLimiter, default_completion_limiter, default_moderation_limiter
+from .single_flight import SingleFlightStore
+from .idempotency_service import IdempotencyStore, default_idempotency_store, request_fingerprint
+from .behavior_cache import BehaviorResultCache, default_behavior_cache
+from .metrics import MetricsRegistry, default_metrics_registry, stats_samples
+from .goal_progress_service import GoalProgressService, default_goal_progress_service
+from .percentile_service import PopulationPercentiles, default_population_percentiles, population_cohort
+from .usage_service import UsageTracker, default_usage_tracker, user_cohort
+
+# opens `settings.RECOMMENDATION_DB_PATH` at app startup, or on first use outside the app
+default_recommendation_store = RecommendationStore()
 
 default_orchestrator = OrchestrationService(
     assistant_service=AssistantService(),
     behavior_service=BehavioralAnalysisService(),
     risk_predictor=DemoRiskPredictor(),
     timing_policy=ThompsonSamplerTimingPolicy(),
+    recommendation_store=default_recommendation_store,
+)
+
+default_job_service = RecommendationJobService(orchestrator=default_orchestrator)
+
+default_scheduler = PreGenerationScheduler(
+    job_service=default_job_service,
+    timing_policy=default_orchestrator.timing_policy,
+)
+
+default_batch_recommendation_service = BatchRecommendationService(
+    assistant_service=default_orchestrator.assistant_service,
+    risk_predictor=default_orchestrator.risk_predictor,
+    timing_policy=default_orchestrator.timing_policy,
+    recommendation_store=default_recommendation_store,
+)
+
+# the services' own counters, reported on /metrics when it's scraped
+default_metrics_registry.register_collector(
+    "Admission control state.",
+    lambda: stats_samples("coaching_admission", default_admission_controller.stats()),
+)
+default_metrics_registry.register_collector(
+    "Adaptive concurrency limiter state.",
+    lambda: [
+        sample
+        for limiter in (default_completion_limiter, default_moderation_limiter)
+        for sample in stats_samples("coaching_llm_limiter", limiter.stats(), limiter=limiter.name)
+    ],
+)
+default_metrics_registry.register_collector(
+    "LLM call site hedging and circuit breaker state.",
+    lambda: [
+        sample
+        for name, call_site in default_call_sites.items()
+        for sample in stats_samples(
+            "coaching_call_site",
+            {**call_site.stats(), "breaker_open": call_site.breaker.state != "closed"},
+            call_site=name,
+        )
+    ],
+)
+default_metrics_registry.register_collector(
+    "Background recommendation generation state.",
+    lambda: [
+        ("coaching_job_queue_depth", {}, default_job_service.queue_depth()),
+        ("coaching_scheduled_pending", {}, default_scheduler.pending_count()),
+    ],
 )
 
 __all__ = [
     "AssistantService",
     "BehavioralAnalysisService",
     "OrchestrationService",
+    "BatchRecommendationService",
+    "RecommendationStore",
+    "RecommendationJobService",
+    "PreGenerationScheduler",
     "default_orchestrator",
+    "default_batch_recommendation_service",
+    "default_recommendation_store",
+    "default_job_service",
+    "default_scheduler",
     "assistant_service",
     "behavior_service",
     "default_content_detection_service",
-    "ContentDetectionFlaggedError"
+    "ContentDetectionFlaggedError",
+    "EmptyBatchError",
+    "AdmissionRejectedError",
+    "AdmissionController",
+    "default_admission_controller",
+    "IdempotencyKeyReusedError",
+    "JobQueueFullError",
+    "UpstreamOverloadedError",
+    "CircuitOpenError",
+    "CallSite",
+    "default_call_sites",
+    "AdaptiveConcurrencyLimiter",
+    "default_completion_limiter",
+    "default_moderation_limiter",
+    "SingleFlightStore",
+    "IdempotencyStore",
+    "default_idempotency_store",
+    "request_fingerprint",
+    "BehaviorResultCache",
+    "default_behavior_cache",
+    "MetricsRegistry",
+    "default_metrics_registry",
+    "UsageTracker",
+    "default_usage_tracker",
+    "user_cohort",
+    "PopulationPercentiles",
+    "default_population_percentiles",
+    "population_cohort",
+    "GoalProgressService",
+    "default_goal_progress_service",
 ]
@@ -0,0 +1,188 @@
+"""Admission control for the LLM-bound routes."""
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Optional
+
+from .exceptions import AdmissionRejectedError
+from ..config import settings
+
+logger = logging.getLogger(__name__)
+
+UNKNOWN_CARETAKER_ID = "UNKNOWN"
+
+
+class TokenBucket:
+    """Token bucket refilled continuously at `rate` tokens per second, holding at most `burst` tokens."""
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = now
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def seconds_until_available(self) -> float:
+        """Seconds until a token is available, 0 if one is available now. Call `refill` first."""
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class AdmissionTicket:
+    """Held while an admitted request runs, releases its concurrency slots when closed."""
+
+    def __init__(self, release: Callable[[int], None], slots: int):
+        self._release = release
+        self._slots = slots
+
+    def release(self) -> None:
+        """Release the slots, safe to call more than once."""
+        slots, self._slots = self._slots, 0
+        if slots:
+            self._release(slots)
+
+    def __enter__(self) -> "AdmissionTicket":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.release()
+
+
+class AdmissionController:
+    """
+    Rejects excess load up front instead of letting it queue into timeouts.
+
+    Every request spends a token from its user's bucket and, when known, its caretaker's bucket. Requests that run
+    LLM calls while the client waits also hold a slot of the global concurrency limit until they finish.
+    """
+
+    def __init__(
+        self,
+        user_rate_per_minute: Optional[float] = None,
+        user_burst: Optional[int] = None,
+        caretaker_rate_per_minute: Optional[float] = None,
+        caretaker_burst: Optional[int] = None,
+        max_concurrent_requests: Optional[int] = None,
+        max_tracked_keys: Optional[int] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        """
+        Initialize the admission controller, unset arguments default to the `ADMISSION_*` settings.
+
+        Args:
+            user_rate_per_minute (Optional[float]): Sustained requests per minute per user.
+            user_burst (Optional[int]): Requests a user can make at once.
+            caretaker_rate_per_minute (Optional[float]): Sustained requests per minute per caretaker.
+            caretaker_burst (Optional[int]): Requests a caretaker can make at once.
+            max_concurrent_requests (Optional[int]): Global limit of concurrent LLM-bound requests.
+            max_tracked_keys (Optional[int]): Buckets kept in memory, the least recently used are dropped.
+            clock (Callable[[], float]): Monotonic clock in seconds.
+        """
+        self.user_rate = (user_rate_per_minute or settings.ADMISSION_USER_RATE_PER_MINUTE) / 60
+        self.user_burst = user_burst or settings.ADMISSION_USER_BURST
+        self.caretaker_rate = (caretaker_rate_per_minute or settings.ADMISSION_CARETAKER_RATE_PER_MINUTE) / 60
+        self.caretaker_burst = caretaker_burst or settings.ADMISSION_CARETAKER_BURST
+        self.max_concurrent_requests = max_concurrent_requests or settings.ADMISSION_MAX_CONCURRENT_LLM_REQUESTS
+        self.max_tracked_keys = max_tracked_keys or settings.ADMISSION_MAX_TRACKED_KEYS
+        self._clock = clock
+
+        self._buckets: "OrderedDict[str, TokenBucket]" = OrderedDict()
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        self._counters: Dict[str, int] = {
+            "admitted": 0,
+            "rejected_user_rate": 0,
+            "rejected_caretaker_rate": 0,
+            "rejected_concurrency": 0,
+        }
+
+    def admit(self, user_id: Optional[str], caretaker_id: Optional[str] = None, slots: int = 1) -> AdmissionTicket:
+        """
+        Admit a request or reject it right away.
+
+        Args:
+            user_id (Optional[str]): The user the request is for, None for requests covering many users.
+            caretaker_id (Optional[str]): The user's caretaker, unknown caretakers aren't limited.
+            slots (int): Concurrency slots held until the ticket is released, 0 for requests that don't make the
+                client wait on LLM calls. Capped at the global limit.
+
+        Returns:
+            AdmissionTicket: Must be released once the request finishes.
+
+        Raises:
+            AdmissionRejectedError: If a rate or the concurrency limit is exceeded.
+        """
+        slots = min(slots, self.max_concurrent_requests)
+        if not settings.ADMISSION_ENABLED:
+            return AdmissionTicket(self._release, 0)
+
+        now = self._clock()
+        with self._lock:
+            if self._in_flight + slots > self.max_concurrent_requests:
+                self._counters["rejected_concurrency"] += 1
+                raise AdmissionRejectedError("concurrency", settings.ADMISSION_CONCURRENCY_RETRY_AFTER_SECONDS)
+
+            user_bucket = None
+            if user_id:
+                user_bucket = self._bucket(f"user:{user_id}", self.user_rate, self.user_burst, now)
+                wait = user_bucket.seconds_until_available()
+                if wait:
+                    self._counters["rejected_user_rate"] += 1
+                    raise AdmissionRejectedError("user_rate", wait)
+
+            caretaker_bucket = None
+            if caretaker_id and caretaker_id != UNKNOWN_CARETAKER_ID:
+                caretaker_bucket = self._bucket(
+                    f"caretaker:{caretaker_id}", self.caretaker_rate, self.caretaker_burst, now
+                )
+                wait = caretaker_bucket.seconds_until_available()
+                if wait:
+                    self._counters["rejected_caretaker_rate"] += 1
+                    raise AdmissionRejectedError("caretaker_rate", wait)
+
+            # only spend tokens once every limit admitted the request
+            if user_bucket is not None:
+                user_bucket.tokens -= 1
+            if caretaker_bucket is not None:
+                caretaker_bucket.tokens -= 1
+            self._in_flight += slots
+            self._counters["admitted"] += 1
+
+        return AdmissionTicket(self._release, slots)
+
+    def stats(self) -> Dict[str, int]:
+        """Counters for monitoring."""
+        with self._lock:
+            return {
+                **self._counters,
+                "in_flight": self._in_flight,
+                "max_concurrent_requests": self.max_concurrent_requests,
+                "tracked_keys": len(self._buckets),
+            }
+
+    def _bucket(self, key: str, rate: float, burst: int, now: float) -> TokenBucket:
+        """Get the refilled bucket for a key, must hold the lock."""
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(rate, burst, now)
+            self._buckets[key] = bucket
+            if len(self._buckets) > self.max_tracked_keys:
+                # a dropped bucket was idle the longest, so it'd most likely be full again anyway
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+            bucket.refill(now)
+        return bucket
+
+    def _release(self, slots: int) -> None:
+        with self._lock:
+            self._in_flight -= slots
+
+
+# TODO: replace with DI/singleton
+default_admission_controller = AdmissionController()
@@ -1,15 +1,67 @@
 import logging
 
 import openai
-from typing import List
+from openai import Stream
+from openai.types.chat import ChatCompletionChunk
+from openai.types import CompletionUsage
+from typing import Callable, Dict, Iterator, List, Optional
 
+from .call_site import RECOMMENDATION_CALL_SITE, CallSite, default_call_sites
+from .metrics import track_stage
+from .concurrency_limiter import AdaptiveConcurrencyLimiter, ConcurrencyPermit, default_completion_limiter
+from .goal_progress_service import GoalProgressService, default_goal_progress_service
+from .prompt_builder import compact, fit_to_budget, prefix_messages
+from .percentile_service import PopulationPercentiles, default_population_percentiles
+from .usage_service import UsageTracker, default_usage_tracker, user_cohort
 from ..config import settings
-from ..dto import Goal, UserProfile, DailyMetric
+from ..dto import Goal, GoalPeriod, GoalProgress, UserProfile, DailyMetric
 
 logger = logging.getLogger(__name__)
 
 DEFAULT_COACH_NAME = "Laura"
 
+SYSTEM_TEMPLATE = compact("""
+    You are {assistant_name}, a friendly, empathetic youth health coach (age-appropriate tone, no weight-shaming).
+    Use evidence-based behaviour-change techniques: goal-setting, self-monitoring, feedback, praise.
+    When suggesting goals, only pick ONE, make it SMART (don't mention this explicitly, instead summarize how it's smart in a conversational, simple manner),
+    and tie it to the child's interests. You should always address the child by their first name in your message.
+""")
+
+USER_TEMPLATE = compact("""
+    Child info:
+    - Name: {first_name}
+    - Age: {age}
+    - Sex: {sex}
+    - Preferences: {preferences}
+    - Health conditions: {health_conditions}
+    - Height (cm): {height_cm}
+    - Weight (kg): {weight_kg}
+    Child metrics today:
+    - Steps: {steps}
+    - Active minutes: {active_minutes}
+    - Calories in: {calories_in}
+    - Sleep hours: {sleep_hours}{peer_section}
+    Current goals:
+    {goal_lines}
+    Risk score: {risk}
+""")
+
+# how the current period of a goal is worded in prompts
+PROGRESS_PERIOD_LABELS = {
+    GoalPeriod.DAILY: "today",
+    GoalPeriod.WEEKLY: "this week",
+    GoalPeriod.MONTHLY: "this month",
+    GoalPeriod.YEARLY: "this year",
+    GoalPeriod.LIFETIME: "so far",
+}
+
+# daily metrics a goal's `metric` can be compared against in fallback recommendations, with how they're worded
+FALLBACK_METRIC_LABELS = {
+    "steps": "steps",
+    "active_minutes": "active minutes",
+    "sleep_hours": "hours of sleep",
+}
+
 FUNCTIONS = [
     {
       "name": "suggest_goal",
@@ -39,94 +91,297 @@ FUNCTIONS = [
 class AssistantService:
     """Service for managing assistants."""
 
-    def __init__(self):
-        self.client = openai.OpenAI(api_key=settings.OPENAI_API_KEY)
-
-    @staticmethod
-    def _build_system_context(assistant_name: str):
-        return f"""
-        You are {assistant_name}, a friendly, empathetic youth health coach (age-appropriate tone, no weight-shaming).
-        Use evidence-based behaviour-change techniques: goal-setting, self-monitoring, feedback, praise.
-        When suggesting goals, only pick ONE, make it SMART (don't mention this explicitly, instead summarize how it's smart in a conversational, simple manner), 
-        and tie it to the child's interests. You should always address the child by their first name in your message.
-        """
+    def __init__(
+        self,
+        limiter: Optional[AdaptiveConcurrencyLimiter] = None,
+        call_site: Optional[CallSite] = None,
+        usage_tracker: Optional[UsageTracker] = None,
+        population_percentiles: Optional[PopulationPercentiles] = None,
+        goal_progress_service: Optional[GoalProgressService] = None,
+    ):
+        # retries are left to the limiter, so rate limits adjust the concurrency instead of being retried blindly
+        self.client = openai.OpenAI(api_key=settings.OPENAI_API_KEY, max_retries=0)
+        self.limiter = limiter or default_completion_limiter
+        self.call_site = call_site or default_call_sites[RECOMMENDATION_CALL_SITE]
+        self.usage_tracker = usage_tracker or default_usage_tracker
+        self.population_percentiles = population_percentiles or default_population_percentiles
+        self.goal_progress_service = goal_progress_service or default_goal_progress_service
 
     @staticmethod
     def _build_user_context(
         user_profile: UserProfile,
         metrics: DailyMetric,
         goals: List[Goal],
-        risk: float
+        risk: float,
+        peer_percentiles: Optional[Dict[str, int]] = None,
+        goal_progress: Optional[Dict[str, GoalProgress]] = None,
     ) -> str:
         """
         Build context for the assistant based on daily metrics and goals.
+
+        Preferences, then goals, then health conditions are cut short if the context is over
+        `settings.PROMPT_MAX_USER_TOKENS`.
         """
-        goal_lines = "\n".join([f"- {g.description} (status: {g.status})" for g in goals])
-        risk = "unknown" if not risk else f"{risk:.2%}"
-
-        return f"""
-        Child info:
-        - Name: {user_profile.first_name}
-        - Age: {user_profile.age}
-        - Sex: {user_profile.sex}
-        - Preferences: {', '.join(user_profile.preferences)}
-        - Health conditions: {', '.join(user_profile.health_conditions)}
-        - Height (cm): {user_profile.height_cm}
-        - Weight (kg): {user_profile.weight_kg}
-        
-        Child metrics today:
-        - Steps: {metrics.steps}
-        - Active minutes: {metrics.active_minutes}
-        - Calories in: {metrics.calories_in}
-        - Sleep hours: {metrics.sleep_hours}
-
-        Current goals:
-        {goal_lines or 'None'}
-
-        Risk score: {risk}
-        """
+        goal_progress = goal_progress or {}
+        goal_lines = [
+            f"- {g.description} (status: {g.status})" if g.id not in goal_progress
+            else f"- {g.description} ({AssistantService._format_goal_progress(goal_progress[g.id])})"
+            for g in goals
+        ]
+        peer_section = ""
+        if peer_percentiles:
+            peer_section = "\nPercentile among peers of the same age and sex:" + "".join(
+                f"\n- {label}: {percentile}" for label, percentile in peer_percentiles.items()
+            )
 
-    def create_recommendation(
+        def render(items: Dict[str, List[str]], dropped: Dict[str, int]) -> str:
+            def listed(name: str, more: str) -> str:
+                text = ", ".join(items[name])
+                return f"{text} (+{dropped[name]} {more})" if dropped[name] else text
+
+            lines = items["goals"] + ([f"- (+{dropped['goals']} more goals)"] if dropped["goals"] else [])
+            return USER_TEMPLATE.format(
+                first_name=user_profile.first_name,
+                age=user_profile.age,
+                sex=user_profile.sex,
+                preferences=listed("preferences", "more"),
+                health_conditions=listed("health_conditions", "more"),
+                height_cm=user_profile.height_cm,
+                weight_kg=user_profile.weight_kg,
+                steps=metrics.steps,
+                active_minutes=metrics.active_minutes,
+                calories_in=metrics.calories_in,
+                sleep_hours=metrics.sleep_hours,
+                peer_section=peer_section,
+                goal_lines="\n".join(lines) or "None",
+                risk="unknown" if not risk else f"{risk:.2%}",
+            )
+
+        return fit_to_budget(
+            render,
+            {
+                "preferences": user_profile.preferences,
+                "goals": goal_lines,
+                "health_conditions": user_profile.health_conditions,
+            },
+            trim_order=("preferences", "goals", "health_conditions"),
+            max_tokens=settings.PROMPT_MAX_USER_TOKENS,
+        )
+
+    @staticmethod
+    def _format_goal_progress(progress: GoalProgress) -> str:
+        """Compact progress of a goal, e.g. "status: active, this week: 60/150, 40%"."""
+        return (
+            f"status: {progress.status}, {PROGRESS_PERIOD_LABELS[progress.period]}: "
+            f"{progress.value or 0:g}/{progress.target:g}, {progress.progress:.0%}"
+        )
+
+    def build_completion_request(
         self,
         user_profile: UserProfile,
         metrics: DailyMetric,
         goals: List[Goal],
         risk: float
-    ) -> str:
+    ) -> dict:
         """
-        Get recommendations from the assistant based on daily metrics and goals.
+        Build the chat completion request body for a recommendation.
+
+        The body is shared by the synchronous, streaming and batch recommendation paths.
         """
         assistant_name = user_profile.coach_profile.name if user_profile.coach_profile else DEFAULT_COACH_NAME
 
-        system_content = self._build_system_context(assistant_name)
+        # only read here, speculative and batch requests are built before moderation, the day is observed by the
+        # callers once it passed
+        peer_percentiles = None
+        if settings.PROMPT_PEER_PERCENTILES:
+            peer_percentiles = self.population_percentiles.peer_percentiles(user_profile, metrics)
+
+        # the assistant is told the progress rather than inferring it from the goal descriptions, the day's metrics
+        # replace any kept for it
+        goal_progress = {
+            progress.goal_id: progress
+            for progress in self.goal_progress_service.evaluate(
+                goals, self.goal_progress_service.history(user_profile.user_id) + [metrics], as_of=metrics.date
+            )
+        }
+
         user_content = self._build_user_context(
             user_profile=user_profile,
             metrics=metrics,
             goals=goals,
-            risk=risk
+            risk=risk,
+            peer_percentiles=peer_percentiles,
+            goal_progress=goal_progress,
         )
 
-        logger.info(f"User content: {user_content}")
+        logger.debug("User content - user_id=%s, content=%s", user_profile.user_id, user_content)
 
-        messages = [
-            {"role": "system", "content": system_content},
-            {"role": "user", "content": user_content}
-        ]
+        # the coach's static messages come first so the provider can cache them as a prefix
+        messages = prefix_messages(SYSTEM_TEMPLATE, assistant_name) + [{"role": "user", "content": user_content}]
 
-        resp = self.client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=messages,
-            functions=FUNCTIONS,
-            function_call="none",
-            temperature=0.8,
-            user=user_profile.user_id,
-            seed=42,
-        )
+        return {
+            "model": "gpt-4o-mini",
+            "messages": messages,
+            "functions": FUNCTIONS,
+            "function_call": "none",
+            "temperature": 0.8,
+            "user": user_profile.user_id,
+            "seed": 42,
+        }
+
+    def create_recommendation(
+        self,
+        user_profile: UserProfile,
+        metrics: DailyMetric,
+        goals: List[Goal],
+        risk: float
+    ) -> str:
+        """
+        Get recommendations from the assistant based on daily metrics and goals.
+        """
+        request = self.build_completion_request(user_profile=user_profile, metrics=metrics, goals=goals, risk=risk)
+        cohort = user_cohort(user_profile)
 
-        logger.info(f"Assistant response: {resp}")
+        # usage is recorded per attempt, so retries and hedges count towards the cost too
+        def _create():
+            response = self.client.chat.completions.create(**request)
+            self.usage_tracker.record(self.call_site.name, request["model"], response.usage, cohort)
+            return response
+
+        with track_stage("completion"):
+            resp = self.call_site.call(lambda: self.limiter.call(_create))
+
+        logger.debug("Assistant response - user_id=%s, response=%s", user_profile.user_id, resp)
 
         return resp.choices[0].message.content
 
+    @staticmethod
+    def create_fallback_recommendation(
+        user_profile: UserProfile,
+        metrics: DailyMetric,
+        goals: List[Goal],
+        risk: Optional[float] = None,
+    ) -> str:
+        """
+        Build a template recommendation from the same inputs as the assistant's user context, for when the assistant
+        can't answer in time.
+
+        The message is deterministic and only compares today's metrics to the user's active daily goals. Goal
+        descriptions aren't quoted since the goals may not have been moderated yet.
+        """
+        lines = [f"Hi {user_profile.first_name}!"]
+
+        progress = []
+        for goal in goals:
+            if goal.status != "active" or goal.period != GoalPeriod.DAILY or goal.metric not in FALLBACK_METRIC_LABELS:
+                continue
+            try:
+                target = float(goal.target_value)
+            except ValueError:
+                continue
+            if target <= 0:
+                continue
+            progress.append((getattr(metrics, goal.metric) / target, goal.metric, target))
+
+        label = FALLBACK_METRIC_LABELS
+        met = [(metric, target) for ratio, metric, target in progress if ratio >= 1]
+        missed = sorted((ratio, metric, target) for ratio, metric, target in progress if ratio < 1)
+
+        for metric, target in met:
+            lines.append(f"You reached your goal of {target:g} {label[metric]} today, great work!")
+
+        if missed:
+            # only the goal that's furthest off, one small step at a time
+            _, metric, target = missed[0]
+            value = getattr(metrics, metric)
+            lines.append(
+                f"You're at {value:g} of your {target:g} {label[metric]} today, "
+                f"just {target - value:g} more to reach your goal."
+            )
+        elif not met:
+            lines.append(
+                f"Thanks for checking in! Today you logged {metrics.steps} steps "
+                f"and {metrics.active_minutes} active minutes."
+            )
+
+        if user_profile.preferences and (missed or not met):
+            lines.append(f"How about some {user_profile.preferences[0]} to keep moving?")
+
+        # higher risk users get encouragement rather than more targets
+        if risk is not None and risk >= 0.5:
+            lines.append("Every small step counts, and I'm proud of you for keeping at it.")
+        else:
+            lines.append("Keep it up, I'm cheering for you!")
+
+        return " ".join(lines)
+
+    def stream_recommendation(
+        self,
+        user_profile: UserProfile,
+        metrics: DailyMetric,
+        goals: List[Goal],
+        risk: float
+    ) -> "CompletionStream":
+        """
+        Stream a recommendation from the assistant based on daily metrics and goals.
+
+        The request is sent right away so the connection can be opened ahead of consuming the tokens,
+        the returned stream must be closed if it isn't consumed to completion.
+        """
+        request = self.build_completion_request(user_profile=user_profile, metrics=metrics, goals=goals, risk=risk)
+        cohort = user_cohort(user_profile)
+
+        # the stream holds its slot of the limit until it is closed
+        with track_stage("completion_stream_open"):
+            stream, permit = self.call_site.call(
+                lambda: self.limiter.open(lambda: self.client.chat.completions.create(
+                    **request,
+                    stream=True,
+                    stream_options={"include_usage": True},
+                )),
+                hedge=False,
+            )
+
+        return CompletionStream(
+            stream,
+            permit,
+            on_usage=lambda usage: self.usage_tracker.record(self.call_site.name, request["model"], usage, cohort),
+        )
+
+
+class CompletionStream:
+    """Iterator over the text deltas of a streamed chat completion."""
+
+    def __init__(
+        self,
+        stream: Stream[ChatCompletionChunk],
+        permit: Optional[ConcurrencyPermit] = None,
+        on_usage: Optional[Callable[[CompletionUsage], None]] = None,
+    ):
+        self._stream = stream
+        self._permit = permit
+        self._on_usage = on_usage
+
+    def __iter__(self) -> Iterator[str]:
+        try:
+            for chunk in self._stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+                # the last chunk carries the usage of the whole stream and no choices
+                if chunk.usage is not None and self._on_usage is not None:
+                    self._on_usage(chunk.usage)
+        finally:
+            self._release()
+
+    def close(self) -> None:
+        """Close the underlying HTTP response."""
+        self._stream.close()
+        self._release()
+
+    def _release(self) -> None:
+        if self._permit is not None:
+            self._permit.release()
+
 
 # TODO: replace with DI
 assistant_service = AssistantService()
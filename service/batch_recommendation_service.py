@@ -0,0 +1,359 @@
+"""Service to generate daily recommendations offline through the OpenAI Batch API."""
+import json
+import logging
+import os
+import time
+import uuid
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+import openai
+from openai.types import Batch
+
+from .assistant_service import AssistantService
+from .content_detection_service import ContentDetectionService, default_content_detection_service
+from .exceptions import EmptyBatchError
+from .goal_progress_service import GoalProgressService, default_goal_progress_service
+from .percentile_service import PopulationPercentiles, default_population_percentiles
+from .recommendation_store import RecommendationStore
+from .single_flight import SingleFlightStore
+from .usage_service import UsageTracker, default_usage_tracker
+from ..config import settings
+from ..dto import Recommendation, RecommendationBatchStatus, RecommendationRequest
+from ..model import RiskPredictor, TimingPolicy
+
+logger = logging.getLogger(__name__)
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+BATCH_CALL_SITE = "recommendation_batch"
+TERMINAL_BATCH_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+# namespace for deterministic recommendation ids, so ingesting the same batch output twice yields the same ids
+RECOMMENDATION_ID_NAMESPACE = uuid.UUID("6f1c0b8e-8a51-4d38-9a55-0d6f4f3c2b7e")
+
+
+class BatchRecommendationService:
+    """
+    Generates recommendations for many users at batch throughput and cost.
+
+    Each user's request is written as one line of a JSONL batch file using the same completion body as the
+    synchronous path, the file is submitted to the Batch API and the results are ingested into `Recommendation`s
+    once the batch completes. A completed batch is ingested once, later polls get the ingested status.
+    """
+
+    def __init__(
+        self,
+        assistant_service: AssistantService,
+        risk_predictor: RiskPredictor,
+        timing_policy: TimingPolicy,
+        content_detection_service: ContentDetectionService = default_content_detection_service,
+        recommendation_store: Optional[RecommendationStore] = None,
+        work_dir: Optional[str] = None,
+        usage_tracker: Optional[UsageTracker] = None,
+        population_percentiles: Optional[PopulationPercentiles] = None,
+        goal_progress_service: Optional[GoalProgressService] = None,
+    ):
+        """
+        Initialize the batch recommendation service.
+
+        Args:
+            assistant_service (AssistantService): Builds the completion request bodies.
+            risk_predictor (RiskPredictor): The risk predictor to use.
+            timing_policy (TimingPolicy): The timing policy to use.
+            content_detection_service (ContentDetectionService): Moderates the goals before they are batched and the
+                generated messages before they are ingested.
+            recommendation_store (Optional[RecommendationStore]): Where ingested recommendations are persisted,
+                nothing is persisted if None.
+            work_dir (Optional[str]): Directory for batch request files, defaults to `settings.BATCH_WORK_DIR`.
+            usage_tracker (Optional[UsageTracker]): Accounts the tokens of the ingested results at the batch price.
+            population_percentiles (Optional[PopulationPercentiles]): The days of the submitted users are added to it.
+            goal_progress_service (Optional[GoalProgressService]): The days of the submitted users are added to
+                their history.
+        """
+        self.assistant_service = assistant_service
+        self.risk_predictor = risk_predictor
+        self.timing_policy = timing_policy
+        self.content_detection_service = content_detection_service
+        self.recommendation_store = recommendation_store
+        self.work_dir = work_dir or settings.BATCH_WORK_DIR
+        self.usage_tracker = usage_tracker or default_usage_tracker
+        self.population_percentiles = population_percentiles or default_population_percentiles
+        self.goal_progress_service = goal_progress_service or default_goal_progress_service
+        self._ingested: SingleFlightStore[RecommendationBatchStatus] = SingleFlightStore(
+            "batch_results", settings.BATCH_RESULT_TTL_SECONDS, settings.BATCH_RESULT_MAX_ENTRIES
+        )
+        self.openai_client: openai.OpenAI = openai.OpenAI(
+            api_key=settings.OPENAI_API_KEY,
+            base_url=settings.BATCH_API_BASE_URL,
+        )
+
+    def write_batch_file(self, requests: List[RecommendationRequest]) -> Tuple[str, List[str]]:
+        """
+        Write the batch request file for the given users.
+
+        Users whose goals are flagged by moderation are left out of the file.
+
+        Args:
+            requests (List[RecommendationRequest]): One request per user.
+
+        Returns:
+            Tuple[str, List[str]]: The path of the written file, which the caller removes, and the ids of the flagged
+                users.
+        """
+        user_ids = [request.profile.user_id for request in requests]
+        if len(set(user_ids)) != len(user_ids):
+            raise ValueError("A batch can only contain one request per user.")
+
+        os.makedirs(self.work_dir, exist_ok=True)
+        path = os.path.join(self.work_dir, f"recommendations_{datetime.now():%Y%m%d_%H%M%S}_{uuid.uuid4().hex[:8]}.jsonl")
+
+        # the goals of all users are moderated together, in as few moderation API calls as possible
+        goal_texts = ["\n".join(f"{goal.description}" for goal in request.goals) for request in requests]
+        moderations = self.content_detection_service.detect_content_many(goal_texts)
+
+        flagged_user_ids = []
+        try:
+            with open(path, "w") as f:
+                for request, moderation in zip(requests, moderations):
+                    if moderation.flagged:
+                        logger.warning(f"Content flagged, excluded from batch - user_id={request.profile.user_id}")
+                        flagged_user_ids.append(request.profile.user_id)
+                        continue
+
+                    f.write(json.dumps(self._build_batch_line(request)) + "\n")
+        except Exception:
+            os.remove(path)
+            raise
+
+        logger.info(f"Batch file written - path={path}, users={len(requests)}, flagged={len(flagged_user_ids)}")
+
+        return path, flagged_user_ids
+
+    def submit_batch(self, requests: List[RecommendationRequest]) -> RecommendationBatchStatus:
+        """
+        Write and submit a batch of recommendation requests, the batch file is removed once it's uploaded.
+
+        Args:
+            requests (List[RecommendationRequest]): One request per user.
+
+        Returns:
+            RecommendationBatchStatus: The status of the submitted batch.
+
+        Raises:
+            EmptyBatchError: If no request is left once the flagged users are left out, nothing is uploaded then.
+        """
+        path, flagged_user_ids = self.write_batch_file(requests)
+        if len(flagged_user_ids) == len(requests):
+            os.remove(path)
+            raise EmptyBatchError(flagged_user_ids)
+
+        try:
+            with open(path, "rb") as f:
+                input_file = self.openai_client.files.create(file=f, purpose="batch")
+        finally:
+            # the uploaded copy is the one the batch runs from, a failed upload is retried with a new file
+            os.remove(path)
+
+        batch = self.openai_client.batches.create(
+            input_file_id=input_file.id,
+            endpoint=BATCH_ENDPOINT,
+            completion_window=settings.BATCH_COMPLETION_WINDOW,
+            metadata={"source": "coaching_engine", "type": "daily_recommendation"},
+        )
+
+        logger.info(f"Batch submitted - batch_id={batch.id}, input_file_id={input_file.id}")
+
+        # only the days of users whose goals passed moderation, once the batch is actually submitted
+        flagged = set(flagged_user_ids)
+        submitted = [request for request in requests if request.profile.user_id not in flagged]
+        for request in submitted:
+            self.population_percentiles.observe(request.profile, [request.daily_metrics])
+        self.goal_progress_service.observe(request.daily_metrics for request in submitted)
+
+        status = self._build_status(batch)
+        status.flagged_user_ids = flagged_user_ids
+
+        return status
+
+    def get_batch(self, batch_id: str) -> RecommendationBatchStatus:
+        """
+        Poll a batch and ingest its results if it has completed.
+
+        Args:
+            batch_id (str): The Batch API id.
+
+        Returns:
+            RecommendationBatchStatus: The status of the batch, including recommendations once completed.
+        """
+        batch = self.openai_client.batches.retrieve(batch_id)
+        if batch.status != "completed" or not batch.output_file_id:
+            return self._build_status_with_errors(batch)
+
+        # concurrent polls share one ingestion and later ones get its status
+        status, _ = self._ingested.get_or_compute(batch_id, lambda: self._ingest_batch(batch))
+
+        return status.model_copy(deep=True)
+
+    def wait_for_batch(
+        self,
+        batch_id: str,
+        poll_interval_seconds: float = 30.0,
+        timeout_seconds: Optional[float] = None,
+    ) -> RecommendationBatchStatus:
+        """
+        Poll a batch until it reaches a terminal status or the timeout elapses.
+
+        Args:
+            batch_id (str): The Batch API id.
+            poll_interval_seconds (float): Time between polls.
+            timeout_seconds (Optional[float]): Maximum time to wait, waits indefinitely if None.
+
+        Returns:
+            RecommendationBatchStatus: The last polled status of the batch.
+        """
+        started = time.monotonic()
+        while True:
+            status = self.get_batch(batch_id)
+            if status.status in TERMINAL_BATCH_STATUSES:
+                return status
+
+            if timeout_seconds is not None and time.monotonic() - started >= timeout_seconds:
+                return status
+
+            time.sleep(poll_interval_seconds)
+
+    def _ingest_batch(self, batch: Batch) -> RecommendationBatchStatus:
+        """Download, ingest and save the results of a completed batch."""
+        status = self._build_status_with_errors(batch)
+
+        output = self.openai_client.files.content(batch.output_file_id).text
+        status.recommendations, failed_user_ids, flagged_user_ids = self.ingest_results(batch.id, output)
+        status.failed_user_ids.extend(failed_user_ids)
+        status.flagged_user_ids.extend(flagged_user_ids)
+
+        # ids are deterministic, so ingesting a batch again after its status expired overwrites rather than duplicates
+        if self.recommendation_store is not None:
+            for recommendation in status.recommendations:
+                self.recommendation_store.save_recommendation(recommendation)
+
+        return status
+
+    def _build_status_with_errors(self, batch: Batch) -> RecommendationBatchStatus:
+        """The status of the batch, with the users whose request is in its error file."""
+        status = self._build_status(batch)
+        if batch.error_file_id:
+            errors = self.openai_client.files.content(batch.error_file_id).text
+            status.failed_user_ids.extend(self._parse_user_id(line["custom_id"]) for line in self._read_jsonl(errors))
+
+        return status
+
+    def ingest_results(self, batch_id: str, output: str) -> Tuple[List[Recommendation], List[str], List[str]]:
+        """
+        Convert the lines of a batch output file into recommendations.
+
+        Ingestion is deterministic, the same output always yields the same recommendations. The usage of each line
+        is only accounted the first time it is ingested. Batch lines don't carry the user's cohort, their usage is
+        accounted under the unknown cohort. The generated messages are moderated together, flagged ones are left out.
+
+        Args:
+            batch_id (str): The Batch API id the output belongs to.
+            output (str): The content of the batch output file.
+
+        Returns:
+            Tuple[List[Recommendation], List[str], List[str]]: The recommendations, the ids of users whose request
+                failed and the ids of users whose generated message was flagged.
+
+        Raises:
+            UpstreamOverloadedError: If the messages couldn't be moderated, nothing is ingested then.
+        """
+        recommendations = []
+        failed_user_ids = []
+
+        for line in self._read_jsonl(output):
+            custom_id = line["custom_id"]
+            response = line.get("response") or {}
+
+            if line.get("error") or response.get("status_code") != 200:
+                logger.warning(f"Batch request failed - batch_id={batch_id}, custom_id={custom_id}, error={line.get('error')}")
+                failed_user_ids.append(self._parse_user_id(custom_id))
+                continue
+
+            body = response["body"]
+            self.usage_tracker.record(
+                BATCH_CALL_SITE,
+                body["model"],
+                body.get("usage"),
+                price_multiplier=settings.BATCH_PRICE_MULTIPLIER,
+                dedupe_key=f"usage:{batch_id}:{custom_id}",
+            )
+            self.usage_tracker.record_recommendation(dedupe_key=f"recommendation:{batch_id}:{custom_id}")
+
+            recommendations.append(
+                Recommendation(
+                    id=str(uuid.uuid5(RECOMMENDATION_ID_NAMESPACE, f"{batch_id}:{custom_id}")),
+                    user_id=self._parse_user_id(custom_id),
+                    message=body["choices"][0]["message"]["content"],
+                    send_time=self._parse_send_time(custom_id),
+                    created_at=datetime.fromtimestamp(body["created"]),
+                )
+            )
+
+        # like the synchronous path, the messages are checked against the local patterns first and only the rest
+        # go to the moderation API, in as few calls as possible
+        moderations = self.content_detection_service.detect_content_many(
+            [recommendation.message for recommendation in recommendations]
+        )
+        flagged_user_ids = []
+        for recommendation, moderation in zip(recommendations, moderations):
+            if moderation.flagged:
+                logger.warning(f"Generated content flagged, not ingested - batch_id={batch_id}, user_id={recommendation.user_id}")
+                flagged_user_ids.append(recommendation.user_id)
+        recommendations = [
+            recommendation for recommendation, moderation in zip(recommendations, moderations) if not moderation.flagged
+        ]
+
+        return recommendations, failed_user_ids, flagged_user_ids
+
+    def _build_batch_line(self, request: RecommendationRequest) -> dict:
+        """Build the batch line for a single user, the send time is chosen now and carried in the custom id."""
+        risk = self.risk_predictor.score(request.profile)
+        send_time = self.timing_policy.select_hour()
+
+        body = self.assistant_service.build_completion_request(
+            user_profile=request.profile,
+            metrics=request.daily_metrics,
+            goals=request.goals,
+            risk=risk,
+        )
+
+        return {
+            "custom_id": f"{send_time}:{request.profile.user_id}",
+            "method": "POST",
+            "url": BATCH_ENDPOINT,
+            "body": body,
+        }
+
+    @staticmethod
+    def _parse_send_time(custom_id: str) -> int:
+        return int(custom_id.split(":", 1)[0])
+
+    @staticmethod
+    def _parse_user_id(custom_id: str) -> str:
+        return custom_id.split(":", 1)[1]
+
+    @staticmethod
+    def _read_jsonl(content: str) -> List[dict]:
+        return [json.loads(line) for line in content.splitlines() if line.strip()]
+
+    @staticmethod
+    def _build_status(batch: Batch) -> RecommendationBatchStatus:
+        counts = batch.request_counts
+        return RecommendationBatchStatus(
+            batch_id=batch.id,
+            status=batch.status,
+            total_count=counts.total if counts else 0,
+            completed_count=counts.completed if counts else 0,
+            failed_count=counts.failed if counts else 0,
+            created_at=datetime.fromtimestamp(batch.created_at),
+            completed_at=datetime.fromtimestamp(batch.completed_at) if batch.completed_at else None,
+        )
@@ -0,0 +1,65 @@
+"""Cache of behavior analysis results for repeated views of the same metric window."""
+from typing import Callable, List, Optional
+
+from .behavioral_analysis_service import RULESET_VERSION
+from .idempotency_service import request_fingerprint
+from .single_flight import SingleFlightStore
+from ..config import settings
+from ..dto import BehavioralRecommendation, DailyMetric, UserProfile
+
+
+class BehaviorResultCache(SingleFlightStore):
+    """
+    In-memory cache of behavior analysis results, including "no action needed".
+
+    Results are keyed on the user, a hash of their profile and metric window sorted by date, and the rule-set version,
+    so a new day of metrics or a change to the rules is a new key. Concurrent requests for the same key share one
+    analysis. Fallback alerts aren't cached, the next view gets a fresh analysis.
+    """
+
+    def __init__(self, ttl_seconds: Optional[float] = None, max_entries: Optional[int] = None):
+        """
+        Initialize the cache.
+
+        Args:
+            ttl_seconds (Optional[float]): How long a result is cached, defaults to `settings.BEHAVIOR_CACHE_TTL_SECONDS`.
+            max_entries (Optional[int]): Maximum cached results, the oldest are evicted first,
+                defaults to `settings.BEHAVIOR_CACHE_MAX_ENTRIES`.
+        """
+        super().__init__(
+            "behavior",
+            ttl_seconds or settings.BEHAVIOR_CACHE_TTL_SECONDS,
+            max_entries or settings.BEHAVIOR_CACHE_MAX_ENTRIES,
+        )
+
+    @staticmethod
+    def key(user_profile: UserProfile, daily_metrics: List[DailyMetric]) -> str:
+        """Cache key of a user's metric window."""
+        window = sorted(daily_metrics, key=lambda metric: metric.date)
+        return f"{user_profile.user_id}:{RULESET_VERSION}:{request_fingerprint(user_profile, *window)}"
+
+    def get_or_analyze(
+        self,
+        user_profile: UserProfile,
+        daily_metrics: List[DailyMetric],
+        analyze: Callable[[], Optional[BehavioralRecommendation]],
+    ) -> Optional[BehavioralRecommendation]:
+        """
+        Return the cached result for the metric window, or analyze it and cache the result.
+
+        Args:
+            user_profile (UserProfile): The user's profile.
+            daily_metrics (List[DailyMetric]): The user's daily metrics, in any order.
+            analyze (Callable[[], Optional[BehavioralRecommendation]]): Runs the analysis on a miss.
+        """
+        # requests already waiting on an analysis that fell back still get the fallback
+        result, _ = self.get_or_compute(
+            self.key(user_profile, daily_metrics),
+            analyze,
+            keep=lambda result: result is None or not result.is_fallback,
+        )
+        return result
+
+
+# TODO: replace with DI/singleton
+default_behavior_cache = BehaviorResultCache()
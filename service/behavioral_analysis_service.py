@@ -6,10 +6,18 @@ import uuid
 import openai
 import pandas as pd
 
-from typing import List, Optional
-
+from typing import Dict, List, Optional, Tuple
+
+from .call_site import BEHAVIOR_ALERT_CALL_SITE, CallSite, default_call_sites
+from .concurrency_limiter import AdaptiveConcurrencyLimiter, default_completion_limiter
+from .exceptions import UpstreamOverloadedError
+from .metrics import FALLBACKS, current_route, track_stage
+from .prompt_builder import compact
+from .percentile_service import PopulationPercentiles, default_population_percentiles
+from .usage_service import UNKNOWN_COHORT, UsageTracker, default_usage_tracker, user_cohort
 from ..config import settings
 from ..dto import BehavioralRecommendation, DailyMetric, UserProfile
+from ..model import AnomalyDetector, default_anomaly_detector
 
 CAREGIVER_FUNCTIONS = [
     {
@@ -30,12 +38,125 @@ CAREGIVER_FUNCTIONS = [
     }
 ]
 
-SYSTEM_CONTENT = """
-You are an expert pediatric dietitian helping a caregiver interpret multiple days of health data.
-Be friendly, concise, supportive, and avoid blame. 
-"""
+# one call for all of a caretaker's children, the alerts say which child they're about
+CAREGIVER_DIGEST_FUNCTIONS = [
+    {
+        "name": "issue_alerts",
+        "description": (
+            "Generate one concise, plain-language alert per child with concerning behaviour patterns, "
+            "summarising the patterns, why they matter, and a suggested next step for the caretaker."
+        ),
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "alerts": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "child_id": {"type": "string"},
+                            "alert_title": {"type": "string"},
+                            "summary": {"type": "string"},
+                            "suggested_step": {"type": "string"}
+                        },
+                        "required": ["child_id", "alert_title", "summary", "suggested_step"]
+                    }
+                }
+            },
+            "required": ["alerts"]
+        }
+    }
+]
+
+SYSTEM_CONTENT = compact("""
+    You are an expert pediatric dietitian helping a caregiver interpret multiple days of health data.
+    Be friendly, concise, supportive, and avoid blame.
+""")
+
+# the instructions are static, so they're in the system message ahead of the children's data for prefix caching
+ALERT_SYSTEM_CONTENT = SYSTEM_CONTENT + "\n" + compact("""
+    If Triggered rules is not 'None' or you identify other concerning patterns, call the function `issue_alert`
+    with a helpful, empathetic title, a 1-3-sentence summary, and one concrete suggested next step.
+    If no concerning pattern, respond with: {"message":"No action needed"}
+""")
+
+DIGEST_SYSTEM_CONTENT = SYSTEM_CONTENT + "\n" + compact("""
+    For every child whose Triggered rules is not 'None' or where you identify other concerning patterns, add an
+    alert to the function `issue_alerts` with the child's id, a helpful, empathetic title, a 1-3-sentence summary,
+    and one concrete suggested next step. Children without concerning patterns get no alert.
+    If no child has a concerning pattern, respond with: {"message":"No action needed"}
+""")
 NO_ACTION_RESPONSE = "no action needed"
 
+# alerts issued for the triggered rules while the assistant is unavailable: title, summary, suggested step
+FALLBACK_ALERTS = {
+    "CAL_DROP_ACTIVITY_RISE": (
+        "Less food, more activity this week",
+        "Calories dropped noticeably over the last week while activity went up.",
+        "Check in about how they're feeling and make sure meals keep up with their activity.",
+    ),
+    "LOW_CAL_PERSIST": (
+        "Several low-calorie days",
+        "Calorie intake has been low for several days in a row.",
+        "Offer regular meals and snacks they enjoy, and talk to their doctor if it continues.",
+    ),
+    "SLEEP_DEBT": (
+        "Not enough sleep lately",
+        "They slept less than recommended on several nights this week.",
+        "Try a consistent bedtime routine with screens off an hour before bed.",
+    ),
+}
+
+# wording of the anomaly rules of `AnomalyDetector` per metric: what changed, and the suggested step when it went
+# up or down
+ANOMALY_FALLBACK_WORDING = {
+    "STEPS": (
+        "activity",
+        "Make sure they rest and eat enough on their more active days.",
+        "Ask how they're feeling and suggest a walk or active game they enjoy.",
+    ),
+    "CALORIES": (
+        "calorie intake",
+        "Keep meals regular and talk about hunger and fullness without judgement.",
+        "Offer regular meals and snacks they enjoy, and talk to their doctor if it continues.",
+    ),
+    "SLEEP": (
+        "sleep",
+        "Ask how they're feeling, sleeping a lot more than usual can be a sign of low mood.",
+        "Try a consistent bedtime routine with screens off an hour before bed.",
+    ),
+    "WEIGHT": (
+        "weight",
+        "Talk to their doctor if the change continues.",
+        "Talk to their doctor if the change continues.",
+    ),
+}
+
+
+def _anomaly_fallback_alerts() -> Dict[str, Tuple[str, str, str]]:
+    """Fallback alerts of the outlier and shift rules of every metric in `ANOMALY_FALLBACK_WORDING`."""
+    alerts = {}
+    for name, (label, step_up, step_down) in ANOMALY_FALLBACK_WORDING.items():
+        alerts[f"{name}_OUTLIER_HIGH"] = (
+            f"Unusually high {label}", f"A recent day's {label} was well above their usual.", step_up,
+        )
+        alerts[f"{name}_OUTLIER_LOW"] = (
+            f"Unusually low {label}", f"A recent day's {label} was well below their usual.", step_down,
+        )
+        alerts[f"{name}_SHIFT_UP"] = (
+            f"Rising {label}", f"Their {label} has been trending above their usual for several days.", step_up,
+        )
+        alerts[f"{name}_SHIFT_DOWN"] = (
+            f"Falling {label}", f"Their {label} has been trending below their usual for several days.", step_down,
+        )
+    return alerts
+
+
+FALLBACK_ALERTS.update(_anomaly_fallback_alerts())
+
+# version of the rules and thresholds below, bump it when they change so cached analyses are recomputed
+RULESET_VERSION = "2"
+
 # TODO: these should be configurable and not constants
 INCREASED_ACTIVITY_STEP_THRESHOLD = 1500
 DECREASED_CALORIE_THRESHOLD = 0.25
@@ -47,13 +168,36 @@ logger = logging.getLogger(__name__)
 
 
 class BehavioralAnalysisService:
-    def __init__(self):
+    def __init__(
+        self,
+        limiter: Optional[AdaptiveConcurrencyLimiter] = None,
+        call_site: Optional[CallSite] = None,
+        usage_tracker: Optional[UsageTracker] = None,
+        anomaly_detector: Optional[AnomalyDetector] = None,
+        population_percentiles: Optional[PopulationPercentiles] = None,
+    ):
         """
         Initializes the Behavioral Analysis Service.
+
+        Args:
+            limiter (Optional[AdaptiveConcurrencyLimiter]): Limits the completion calls, shared with the
+                recommendations by default since they use the same model.
+            call_site (Optional[CallSite]): Hedging and circuit breaking of the alert calls.
+            usage_tracker (Optional[UsageTracker]): Accounts the tokens of the alert calls.
+            anomaly_detector (Optional[AnomalyDetector]): Per-user streaming anomaly detection, its anomalies are
+                triggered rules too.
+            population_percentiles (Optional[PopulationPercentiles]): The analyzed days are added to it.
         """
+        # retries are left to the limiter
         self.openai_client: openai.OpenAI = openai.OpenAI(
-            api_key=settings.OPENAI_API_KEY
+            api_key=settings.OPENAI_API_KEY,
+            max_retries=0,
         )
+        self.limiter = limiter or default_completion_limiter
+        self.call_site = call_site or default_call_sites[BEHAVIOR_ALERT_CALL_SITE]
+        self.usage_tracker = usage_tracker or default_usage_tracker
+        self.anomaly_detector = anomaly_detector or default_anomaly_detector
+        self.population_percentiles = population_percentiles or default_population_percentiles
 
     def analyze_aggregate_user_metrics(
         self,
@@ -73,9 +217,11 @@ class BehavioralAnalysisService:
         Returns:
             Optional[BehavioralRecommendation]: The recommendation for the user or None if no action is needed.
         """
-        rule_violations = self._check_red_flag_rules(daily_metrics)
+        with track_stage("behavior_rules"):
+            rule_violations = self._check_rules(user_profile, daily_metrics)
+            self.population_percentiles.observe(user_profile, daily_metrics)
 
-        logger.info(f"Internal rule violations - user_id={user_profile.user_id}, violations={rule_violations}")
+        logger.info("Internal rule violations - user_id=%s, violations=%s", user_profile.user_id, rule_violations)
 
         user_content = self._build_context(
             user=user_profile,
@@ -84,23 +230,37 @@ class BehavioralAnalysisService:
         )
 
         messages = [
-            {"role": "system", "content": SYSTEM_CONTENT},
+            {"role": "system", "content": ALERT_SYSTEM_CONTENT},
             {"role": "user", "content": user_content}
         ]
 
-        response = self.openai_client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=messages,
-            functions=CAREGIVER_FUNCTIONS,
-            function_call="auto",
-            temperature=0.8,
-            user=user_profile.caretaker_id if user_profile.caretaker_id else user_profile.user_id,
-        )
+        cohort = user_cohort(user_profile)
+
+        def _create():
+            response = self.openai_client.chat.completions.create(
+                model="gpt-4o-mini",
+                messages=messages,
+                functions=CAREGIVER_FUNCTIONS,
+                function_call="auto",
+                temperature=0.8,
+                user=user_profile.caretaker_id if user_profile.caretaker_id else user_profile.user_id,
+            )
+            self.usage_tracker.record(self.call_site.name, "gpt-4o-mini", response.usage, cohort)
+            return response
+
+        try:
+            with track_stage("behavior_alert"):
+                response = self.call_site.call(lambda: self.limiter.call(_create))
+        except UpstreamOverloadedError as exc:
+            logger.warning(f"Assistant unavailable, using fallback alert - user_id={user_profile.user_id}, error={exc!r}")
+            FALLBACKS.inc(route=current_route.get(), kind="behavior_alert")
+            return self._build_fallback_alert(user_profile, rule_violations)
+
         msg = response.choices[0].message
 
         # If no action needed, return null
         if msg.content and NO_ACTION_RESPONSE in msg.content.lower():
-            logger.info(f"No action needed - user_id={user_profile.user_id}")
+            logger.info("No action needed - user_id=%s", user_profile.user_id)
             return None
 
         payload = json.loads(msg.function_call.arguments)
@@ -110,8 +270,10 @@ class BehavioralAnalysisService:
         suggested_step = payload.get("suggested_step")
 
         logger.info(
-            f"Alert generated - user_id={user_profile.user_id}, violations={rule_violations}, "
-            f"alert_title={alert_title}, summary={summary}, suggested_step={suggested_step}"
+            "Alert generated - user_id=%s, violations=%s, alert_title=%s", user_profile.user_id, rule_violations, alert_title
+        )
+        logger.debug(
+            "Alert content - user_id=%s, summary=%s, suggested_step=%s", user_profile.user_id, summary, suggested_step
         )
 
         return BehavioralRecommendation(
@@ -124,9 +286,137 @@ class BehavioralAnalysisService:
             triggered_rules=rule_violations,
         )
 
+    def analyze_caretaker_digest(
+        self,
+        caretaker_id: str,
+        children: List[Tuple[UserProfile, List[DailyMetric]]],
+    ) -> List[BehavioralRecommendation]:
+        """
+        Analyzes the behavioral data of all of a caretaker's children in a single assistant call.
+
+        The rules are checked per child, then one prompt summarizing every child asks for an alert per child with a
+        concerning pattern, so a household costs one call and one copy of the instructions.
+
+        Args:
+            caretaker_id (str): The caretaker.
+            children (List[Tuple[UserProfile, List[DailyMetric]]]): Each child's profile and daily metrics.
+
+        Returns:
+            List[BehavioralRecommendation]: One recommendation per child that needs action, in the order of `children`.
+        """
+        analyzed = []
+        with track_stage("behavior_rules"):
+            for user_profile, daily_metrics in children:
+                analyzed.append((user_profile, daily_metrics, self._check_rules(user_profile, daily_metrics)))
+                self.population_percentiles.observe(user_profile, daily_metrics)
+
+        logger.info(
+            "Internal rule violations - caretaker_id=%s, violations=%s",
+            caretaker_id, {user.user_id: rule_ids for user, _, rule_ids in analyzed},
+        )
+
+        messages = [
+            {"role": "system", "content": DIGEST_SYSTEM_CONTENT},
+            {"role": "user", "content": self._build_digest_context(caretaker_id, analyzed)}
+        ]
+
+        def _create():
+            response = self.openai_client.chat.completions.create(
+                model="gpt-4o-mini",
+                messages=messages,
+                functions=CAREGIVER_DIGEST_FUNCTIONS,
+                function_call="auto",
+                temperature=0.8,
+                user=caretaker_id,
+            )
+            # a household's children can be in different cohorts
+            self.usage_tracker.record(self.call_site.name, "gpt-4o-mini", response.usage, UNKNOWN_COHORT)
+            return response
+
+        try:
+            with track_stage("behavior_alert"):
+                response = self.call_site.call(lambda: self.limiter.call(_create))
+        except UpstreamOverloadedError as exc:
+            logger.warning(f"Assistant unavailable, using fallback alerts - caretaker_id={caretaker_id}, error={exc!r}")
+            FALLBACKS.inc(route=current_route.get(), kind="behavior_alert")
+            alerts = (self._build_fallback_alert(user, rule_ids) for user, _, rule_ids in analyzed)
+            return [alert for alert in alerts if alert is not None]
+
+        msg = response.choices[0].message
+        if msg.function_call is None:
+            logger.info("No action needed - caretaker_id=%s", caretaker_id)
+            return []
+
+        alerts_by_child: Dict[str, dict] = {}
+        for alert in json.loads(msg.function_call.arguments).get("alerts", []):
+            alerts_by_child.setdefault(alert.get("child_id"), alert)
+
+        recommendations = []
+        for user_profile, _, rule_ids in analyzed:
+            alert = alerts_by_child.pop(user_profile.user_id, None)
+            if alert is None:
+                continue
+            recommendations.append(BehavioralRecommendation(
+                id=str(uuid.uuid4()),
+                user_id=user_profile.user_id,
+                caretaker_id=caretaker_id,
+                alert_title=alert.get("alert_title"),
+                summary=alert.get("summary"),
+                suggested_step=alert.get("suggested_step"),
+                triggered_rules=rule_ids,
+            ))
+
+        if alerts_by_child:
+            logger.warning(f"Alerts for unknown children dropped - caretaker_id={caretaker_id}, child_ids={list(alerts_by_child)}")
+
+        logger.info(
+            "Alerts generated - caretaker_id=%s, children=%d, alerts=%d", caretaker_id, len(children), len(recommendations)
+        )
+
+        return recommendations
+
+    @staticmethod
+    def _build_fallback_alert(user_profile: UserProfile, rule_ids: List[str]) -> Optional[BehavioralRecommendation]:
+        """Template alert for the triggered rules, None if no rule was triggered."""
+        alerts = [FALLBACK_ALERTS[rule_id] for rule_id in rule_ids if rule_id in FALLBACK_ALERTS]
+        if not alerts:
+            return None
+
+        return BehavioralRecommendation(
+            id=str(uuid.uuid4()),
+            user_id=user_profile.user_id,
+            caretaker_id=user_profile.caretaker_id,
+            alert_title=alerts[0][0],
+            summary=" ".join(summary for _, summary, _ in alerts),
+            suggested_step=alerts[0][2],
+            triggered_rules=rule_ids,
+            is_fallback=True,
+        )
+
+    @classmethod
+    def _build_context(cls, user: UserProfile, metrics: List[DailyMetric], rule_ids: List[str]) -> str:
+        """Build the context for the assistant, the instructions are in `ALERT_SYSTEM_CONTENT`."""
+        return f"Caretaker id: {user.caretaker_id or 'Caretaker'}\n{cls._build_child_summary(user, metrics, rule_ids)}"
+
+    @classmethod
+    def _build_digest_context(
+        cls,
+        caretaker_id: str,
+        children: List[Tuple[UserProfile, List[DailyMetric], List[str]]],
+    ) -> str:
+        """
+        Build the context for the assistant covering all of a caretaker's children, the instructions are in
+        `DIGEST_SYSTEM_CONTENT`.
+        """
+        summaries = "\n".join(
+            f"Child id: {user.user_id}\n{cls._build_child_summary(user, metrics, rule_ids)}"
+            for user, metrics, rule_ids in children
+        )
+        return f"Caretaker id: {caretaker_id}\n{summaries}"
+
     @staticmethod
-    def _build_context(user: UserProfile, metrics: List[DailyMetric], rule_ids: List[str]) -> str:
-        """Build the context for the assistant."""
+    def _build_child_summary(user: UserProfile, metrics: List[DailyMetric], rule_ids: List[str]) -> str:
+        """Summarize a child's trailing week and triggered rules."""
         # convert to dataframe for easier manipulation
         df = pd.DataFrame(m.model_dump() for m in metrics)
         df.sort_values(by="date", ascending=False, inplace=True)
@@ -143,16 +433,15 @@ class BehavioralAnalysisService:
 
         trend_str = ", ".join(f"{k.replace('_',' ')}: {v}" for k, v in trends.items())
 
-        return f"""
-        Caretaker id: {user.caretaker_id or 'Caretaker'}
-        Child: {user.first_name}, {user.age} years old
-        7-day behaviour summary: {trend_str}
-        Triggered rules: {', '.join(rule_ids) or 'None'}
-        
-        If Triggered rules is not 'None' or you identify other concerning patterns, call the function `issue_alert`
-        with a helpful, empathetic title, a 1-3-sentence summary, and one concrete suggested next step.
-        If no concerning pattern, respond with: {{"message":"No action needed"}}
-        """
+        return (
+            f"Child: {user.first_name}, {user.age} years old\n"
+            f"7-day behaviour summary: {trend_str}\n"
+            f"Triggered rules: {', '.join(rule_ids) or 'None'}"
+        )
+
+    def _check_rules(self, user_profile: UserProfile, metrics: List[DailyMetric]) -> List[str]:
+        """The red flag rules violated by the metrics, followed by the anomalies found in them."""
+        return self._check_red_flag_rules(metrics) + self.anomaly_detector.observe(user_profile.user_id, metrics)
 
     @staticmethod
     def _check_red_flag_rules(metrics: List[DailyMetric]) -> List[str]:
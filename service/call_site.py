@@ -0,0 +1,287 @@
+"""Hedging and circuit breaking for the outbound LLM call sites."""
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Callable, Deque, Dict, Optional, Tuple, TypeVar
+
+import openai
+
+from .exceptions import CircuitOpenError
+from ..config import settings
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+MODERATION_CALL_SITE = "moderation"
+RECOMMENDATION_CALL_SITE = "recommendation"
+BEHAVIOR_ALERT_CALL_SITE = "behavior_alert"
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# errors caused by the request itself, they say nothing about the provider's health
+CLIENT_ERRORS = (openai.BadRequestError, openai.AuthenticationError, openai.PermissionDeniedError)
+
+
+class CircuitBreaker:
+    """
+    Stops calling a provider that is failing or slow, so requests go straight to their fallback.
+
+    The breaker opens when the failure rate or the slow call rate of the last `window_size` calls crosses its
+    threshold. After `open_seconds` a single probe call is let through, which closes the breaker if it succeeds
+    and opens it again otherwise.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        slow_call_seconds: float,
+        window_size: Optional[int] = None,
+        min_calls: Optional[int] = None,
+        failure_rate_threshold: Optional[float] = None,
+        slow_call_rate_threshold: Optional[float] = None,
+        open_seconds: Optional[float] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        """
+        Initialize the breaker, unset arguments default to the `BREAKER_*` settings.
+
+        Args:
+            name (str): Name of the call site, used in logs and errors.
+            slow_call_seconds (float): Calls slower than this count as slow.
+            window_size (Optional[int]): Number of recent calls the rates are computed over.
+            min_calls (Optional[int]): Calls needed in the window before the breaker can open.
+            failure_rate_threshold (Optional[float]): Failure rate that opens the breaker.
+            slow_call_rate_threshold (Optional[float]): Slow call rate that opens the breaker.
+            open_seconds (Optional[float]): How long the breaker stays open before probing.
+            clock (Callable[[], float]): Monotonic clock in seconds.
+        """
+        self.name = name
+        self.slow_call_seconds = slow_call_seconds
+        self.min_calls = min_calls or settings.BREAKER_MIN_CALLS
+        self.failure_rate_threshold = failure_rate_threshold or settings.BREAKER_FAILURE_RATE_THRESHOLD
+        self.slow_call_rate_threshold = slow_call_rate_threshold or settings.BREAKER_SLOW_CALL_RATE_THRESHOLD
+        self.open_seconds = open_seconds or settings.BREAKER_OPEN_SECONDS
+        self._clock = clock
+
+        self._outcomes: Deque[Tuple[bool, bool]] = deque(maxlen=window_size or settings.BREAKER_WINDOW_SIZE)
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._state
+
+    def before_call(self) -> None:
+        """
+        Check whether a call may go through.
+
+        Raises:
+            CircuitOpenError: If the breaker is open, or half-open with its probe already in flight.
+        """
+        with self._lock:
+            if self._state == CLOSED:
+                return
+
+            retry_after = self._opened_at + self.open_seconds - self._clock()
+            if self._state == OPEN and retry_after <= 0:
+                self._state = HALF_OPEN
+            if self._state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return
+
+        raise CircuitOpenError(self.name, max(retry_after, 0.0))
+
+    def record(self, succeeded: bool, latency: float) -> None:
+        """Record the outcome of a call that was let through."""
+        slow = latency > self.slow_call_seconds
+        with self._lock:
+            if self._state == HALF_OPEN:
+                self._probing = False
+                if succeeded and not slow:
+                    self._state = CLOSED
+                    self._outcomes.clear()
+                    logger.info(f"Circuit closed - call_site={self.name}")
+                else:
+                    self._open()
+                return
+
+            self._outcomes.append((succeeded, slow))
+            if self._state == CLOSED and len(self._outcomes) >= self.min_calls:
+                failure_rate = sum(1 for ok, _ in self._outcomes if not ok) / len(self._outcomes)
+                slow_rate = sum(1 for _, is_slow in self._outcomes if is_slow) / len(self._outcomes)
+                if failure_rate >= self.failure_rate_threshold or slow_rate >= self.slow_call_rate_threshold:
+                    logger.warning(
+                        f"Circuit opened - call_site={self.name}, failure_rate={failure_rate:.2f}, "
+                        f"slow_call_rate={slow_rate:.2f}"
+                    )
+                    self._open()
+
+    def _open(self) -> None:
+        """Must hold the lock."""
+        self._state = OPEN
+        self._opened_at = self._clock()
+        self._outcomes.clear()
+
+
+class CallSite:
+    """
+    An outbound LLM call site, with an optional hedge and a circuit breaker.
+
+    A hedged call sends a second identical request once the first one has taken longer than the recent
+    `HEDGE_PERCENTILE` latency, and returns whichever finishes first. Hedges are capped at `HEDGE_MAX_RATIO` of the
+    calls so a slow provider isn't hit with twice the load.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        hedge: Optional[bool] = None,
+        slow_call_seconds: Optional[float] = None,
+        breaker: Optional[CircuitBreaker] = None,
+    ):
+        """
+        Initialize the call site.
+
+        Args:
+            name (str): Name of the call site.
+            hedge (Optional[bool]): Whether calls are hedged, defaults to the site being in `settings.HEDGE_CALL_SITES`.
+            slow_call_seconds (Optional[float]): Latency that counts as slow for the breaker,
+                defaults to the site's entry in `settings.BREAKER_SLOW_CALL_SECONDS`.
+            breaker (Optional[CircuitBreaker]): Breaker of the call site, created from the settings if None.
+        """
+        self.name = name
+        self.hedge = hedge if hedge is not None else name in settings.HEDGE_CALL_SITES
+        self.breaker = breaker or CircuitBreaker(
+            name,
+            slow_call_seconds=slow_call_seconds or settings.BREAKER_SLOW_CALL_SECONDS.get(name, 10.0),
+        )
+
+        self._latencies: Deque[float] = deque(maxlen=settings.HEDGE_LATENCY_WINDOW_SIZE)
+        self._lock = threading.Lock()
+        self._counters: Dict[str, int] = {
+            "calls": 0,
+            "failures": 0,
+            "rejected_open": 0,
+            "hedges_fired": 0,
+            "hedges_won": 0,
+        }
+
+    def call(self, fn: Callable[[], T], hedge: bool = True) -> T:
+        """
+        Call the provider through the breaker, hedging the call if enabled for the site.
+
+        Args:
+            fn (Callable[[], T]): The provider call, must be safe to send twice.
+            hedge (bool): False for calls that must not be duplicated, e.g. streams.
+
+        Raises:
+            CircuitOpenError: If the breaker is open.
+        """
+        try:
+            self.breaker.before_call()
+        except CircuitOpenError:
+            with self._lock:
+                self._counters["rejected_open"] += 1
+            raise
+
+        with self._lock:
+            self._counters["calls"] += 1
+
+        started_at = time.monotonic()
+        try:
+            if self.hedge and hedge:
+                result = self._call_hedged(fn)
+            else:
+                result = fn()
+        except CLIENT_ERRORS:
+            self.breaker.record(True, time.monotonic() - started_at)
+            raise
+        except Exception:
+            with self._lock:
+                self._counters["failures"] += 1
+            self.breaker.record(False, time.monotonic() - started_at)
+            raise
+
+        latency = time.monotonic() - started_at
+        self.breaker.record(True, latency)
+        with self._lock:
+            self._latencies.append(latency)
+
+        return result
+
+    def hedge_delay(self) -> Optional[float]:
+        """Delay before a hedge is sent, None until enough latencies were recorded."""
+        with self._lock:
+            if len(self._latencies) < settings.HEDGE_MIN_SAMPLES:
+                return None
+            latencies = sorted(self._latencies)
+        index = min(len(latencies) - 1, int(len(latencies) * settings.HEDGE_PERCENTILE))
+        return max(latencies[index], settings.HEDGE_MIN_DELAY_SECONDS)
+
+    def stats(self) -> Dict[str, object]:
+        """Counters and breaker state for monitoring."""
+        delay = self.hedge_delay()
+        with self._lock:
+            return {
+                **self._counters,
+                "hedge_enabled": self.hedge,
+                "hedge_delay_seconds": delay,
+                "breaker_state": self.breaker.state,
+            }
+
+    def _call_hedged(self, fn: Callable[[], T]) -> T:
+        delay = self.hedge_delay()
+        primary = _hedge_executor.submit(fn)
+        if delay is None:
+            return primary.result()
+
+        done, _ = wait([primary], timeout=delay)
+        if done or not self._allow_hedge():
+            return primary.result()
+
+        logger.info(f"Hedge fired - call_site={self.name}, delay={delay:.2f}")
+        hedge = _hedge_executor.submit(fn)
+        winner = self._first_success(primary, hedge)
+        if winner is hedge:
+            with self._lock:
+                self._counters["hedges_won"] += 1
+
+        # the losing call can't be interrupted, its result is simply discarded
+        return winner.result()
+
+    def _allow_hedge(self) -> bool:
+        """Count a hedge if it stays within the hedge ratio."""
+        with self._lock:
+            if self._counters["hedges_fired"] + 1 > self._counters["calls"] * settings.HEDGE_MAX_RATIO:
+                return False
+            self._counters["hedges_fired"] += 1
+            return True
+
+    @staticmethod
+    def _first_success(*futures: Future) -> Future:
+        """The first future that succeeds, or the last one to fail if none do."""
+        pending = set(futures)
+        while True:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    return future
+            if not pending:
+                return done.pop()
+
+
+# primaries of hedged calls run here too, so they can be waited on with a timeout
+_hedge_executor = ThreadPoolExecutor(max_workers=settings.HEDGE_MAX_WORKERS, thread_name_prefix="hedge")
+
+# TODO: replace with DI/singleton
+default_call_sites: Dict[str, CallSite] = {
+    name: CallSite(name) for name in (MODERATION_CALL_SITE, RECOMMENDATION_CALL_SITE, BEHAVIOR_ALERT_CALL_SITE)
+}
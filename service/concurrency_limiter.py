@@ -0,0 +1,238 @@
+"""Adaptive concurrency limits for the outbound OpenAI calls."""
+import logging
+import random
+import threading
+import time
+from typing import Callable, Dict, Optional, Tuple, TypeVar
+
+import openai
+
+from .exceptions import UpstreamOverloadedError
+from ..config import settings
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# errors that mean the provider is at capacity, the limit is decreased when they occur
+OVERLOAD_ERRORS = (openai.RateLimitError, openai.InternalServerError)
+# errors that are retried with backoff
+RETRYABLE_ERRORS = OVERLOAD_ERRORS + (openai.APIConnectionError,)
+
+
+class ConcurrencyPermit:
+    """A slot of the limit held by a call in flight, released when the call finishes."""
+
+    def __init__(self, release: Callable[[], None]):
+        self._release = release
+        self._released = False
+
+    def release(self) -> None:
+        """Release the slot, safe to call more than once."""
+        if not self._released:
+            self._released = True
+            self._release()
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    AIMD concurrency limit for calls to a rate limited provider.
+
+    Every healthy call grows the limit by `1 / limit`, so about one slot per limit's worth of calls. Rate limit
+    errors, overloaded responses and latency spikes above `latency_tolerance` times the baseline latency shrink the
+    limit by `decrease_ratio`, at most once per baseline latency, so a burst of errors from calls that were started
+    together counts as a single congestion signal. Rate limited calls are retried after a jittered exponential
+    backoff that honours the provider's `Retry-After`, and don't hold a slot while they wait.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        initial_limit: Optional[int] = None,
+        min_limit: Optional[int] = None,
+        max_limit: Optional[int] = None,
+        decrease_ratio: Optional[float] = None,
+        latency_tolerance: Optional[float] = None,
+        acquire_timeout_seconds: Optional[float] = None,
+        max_attempts: Optional[int] = None,
+        backoff_base_seconds: Optional[float] = None,
+        backoff_max_seconds: Optional[float] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        """
+        Initialize the limiter, unset arguments default to the `LLM_LIMITER_*` settings.
+
+        Args:
+            name (str): Name of the limited calls, used in logs and errors.
+            initial_limit (Optional[int]): Concurrent calls allowed before any feedback.
+            min_limit (Optional[int]): Lower bound of the limit.
+            max_limit (Optional[int]): Upper bound of the limit.
+            decrease_ratio (Optional[float]): Factor the limit is multiplied by on congestion.
+            latency_tolerance (Optional[float]): Latency, relative to the baseline, that counts as congestion.
+            acquire_timeout_seconds (Optional[float]): Max time a call waits for a slot.
+            max_attempts (Optional[int]): Attempts per call, including the first one.
+            backoff_base_seconds (Optional[float]): Backoff before the first retry, doubled on every retry.
+            backoff_max_seconds (Optional[float]): Upper bound of the backoff.
+            clock (Callable[[], float]): Monotonic clock in seconds.
+        """
+        self.name = name
+        self.min_limit = min_limit or settings.LLM_LIMITER_MIN_LIMIT
+        self.max_limit = max_limit or settings.LLM_LIMITER_MAX_LIMIT
+        self.decrease_ratio = decrease_ratio or settings.LLM_LIMITER_DECREASE_RATIO
+        self.latency_tolerance = latency_tolerance or settings.LLM_LIMITER_LATENCY_TOLERANCE
+        self.acquire_timeout_seconds = acquire_timeout_seconds or settings.LLM_LIMITER_ACQUIRE_TIMEOUT_SECONDS
+        self.max_attempts = max_attempts or settings.LLM_LIMITER_MAX_ATTEMPTS
+        self.backoff_base_seconds = backoff_base_seconds or settings.LLM_LIMITER_BACKOFF_BASE_SECONDS
+        self.backoff_max_seconds = backoff_max_seconds or settings.LLM_LIMITER_BACKOFF_MAX_SECONDS
+        self._clock = clock
+
+        self._limit = float(initial_limit or settings.LLM_LIMITER_INITIAL_LIMIT)
+        self._in_flight = 0
+        self._baseline_latency: Optional[float] = None
+        self._last_decrease = float("-inf")
+        self._condition = threading.Condition()
+        self._counters: Dict[str, int] = {
+            "calls": 0,
+            "retries": 0,
+            "rate_limited": 0,
+            "latency_spikes": 0,
+            "decreases": 0,
+            "acquire_timeouts": 0,
+        }
+
+    def call(self, fn: Callable[[], T]) -> T:
+        """
+        Run a provider call within the limit, retrying it while the provider is overloaded.
+
+        Raises:
+            UpstreamOverloadedError: If no slot was available in time or every attempt was rejected.
+        """
+        result, permit = self.open(fn)
+        permit.release()
+        return result
+
+    def open(self, fn: Callable[[], T]) -> Tuple[T, ConcurrencyPermit]:
+        """
+        Like `call`, but the slot is kept until the returned permit is released, for calls like streams that keep
+        using the provider after `fn` returned. Latency is measured until `fn` returns.
+        """
+        for attempt in range(1, self.max_attempts + 1):
+            permit = self._acquire()
+            started_at = self._clock()
+            try:
+                result = fn()
+            except RETRYABLE_ERRORS as exc:
+                permit.release()
+                if isinstance(exc, OVERLOAD_ERRORS):
+                    self._on_overload()
+                if attempt == self.max_attempts:
+                    logger.warning(f"Provider overloaded, giving up - limiter={self.name}, attempts={attempt}, error={exc!r}")
+                    raise UpstreamOverloadedError(self.name, self._backoff_seconds(attempt, exc)) from exc
+
+                delay = self._backoff_seconds(attempt, exc)
+                logger.warning(f"Provider call retrying - limiter={self.name}, attempt={attempt}, delay={delay:.2f}, error={exc!r}")
+                with self._condition:
+                    self._counters["retries"] += 1
+                time.sleep(delay)
+                continue
+            except BaseException:
+                permit.release()
+                raise
+
+            self._on_success(self._clock() - started_at)
+            return result, permit
+
+    @property
+    def limit(self) -> int:
+        """Current number of concurrent calls allowed."""
+        with self._condition:
+            return int(self._limit)
+
+    def stats(self) -> Dict[str, float]:
+        """Counters and the current limit for monitoring."""
+        with self._condition:
+            return {
+                **self._counters,
+                "limit": int(self._limit),
+                "in_flight": self._in_flight,
+                "baseline_latency_seconds": self._baseline_latency or 0.0,
+            }
+
+    def _acquire(self) -> ConcurrencyPermit:
+        with self._condition:
+            acquired = self._condition.wait_for(
+                lambda: self._in_flight < int(self._limit), timeout=self.acquire_timeout_seconds
+            )
+            if not acquired:
+                self._counters["acquire_timeouts"] += 1
+                raise UpstreamOverloadedError(self.name, self.backoff_base_seconds)
+            self._in_flight += 1
+            self._counters["calls"] += 1
+
+        return ConcurrencyPermit(self._release)
+
+    def _release(self) -> None:
+        with self._condition:
+            self._in_flight -= 1
+            self._condition.notify()
+
+    def _on_success(self, latency: float) -> None:
+        with self._condition:
+            baseline = self._baseline_latency
+            # slow moving average, so spikes stand out while a lasting slowdown becomes the new baseline
+            self._baseline_latency = latency if baseline is None else 0.95 * baseline + 0.05 * latency
+
+            if baseline is not None and latency > baseline * self.latency_tolerance:
+                self._counters["latency_spikes"] += 1
+                self._decrease()
+                return
+
+            previous = int(self._limit)
+            self._limit = min(self.max_limit, self._limit + 1 / self._limit)
+            if int(self._limit) > previous:
+                # a new slot opened up
+                self._condition.notify()
+
+    def _on_overload(self) -> None:
+        with self._condition:
+            self._counters["rate_limited"] += 1
+            self._decrease()
+
+    def _decrease(self) -> None:
+        """Multiplicative decrease, once per baseline latency. Must hold the lock."""
+        now = self._clock()
+        if now - self._last_decrease < (self._baseline_latency or 0.0):
+            return
+        self._last_decrease = now
+        self._limit = max(self.min_limit, self._limit * self.decrease_ratio)
+        self._counters["decreases"] += 1
+        logger.info(f"Concurrency limit decreased - limiter={self.name}, limit={int(self._limit)}")
+
+    def _backoff_seconds(self, attempt: int, exc: Exception) -> float:
+        """Full jitter exponential backoff, at least as long as the provider's `Retry-After`."""
+        backoff = random.uniform(0, min(self.backoff_max_seconds, self.backoff_base_seconds * 2 ** (attempt - 1)))
+        return max(backoff, _retry_after_seconds(exc) or 0.0)
+
+
+def _retry_after_seconds(exc: Exception) -> Optional[float]:
+    """Delay requested by the provider through the `retry-after-ms` or `retry-after` headers."""
+    response = getattr(exc, "response", None)
+    if response is None:
+        return None
+
+    for header, scale in (("retry-after-ms", 1000), ("retry-after", 1)):
+        value = response.headers.get(header)
+        if value is None:
+            continue
+        try:
+            return float(value) / scale
+        except ValueError:
+            # HTTP-date values aren't used by the provider
+            continue
+    return None
+
+
+# TODO: replace with DI/singleton
+# the chat completion and moderation endpoints have separate rate limits
+default_completion_limiter = AdaptiveConcurrencyLimiter(name="completion")
+default_moderation_limiter = AdaptiveConcurrencyLimiter(name="moderation")
@@ -1,112 +1,178 @@
 import logging
+import os
 import re
-from typing import Dict, List, Pattern, Set
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+from typing import Callable, Dict, List, Optional, Set
 
 import openai
 from openai.types import Moderation
 from openai.types.moderation import Categories, CategoryScores
 
+from .call_site import MODERATION_CALL_SITE, CallSite, default_call_sites
+from .metrics import track_stage
+from .concurrency_limiter import AdaptiveConcurrencyLimiter, default_moderation_limiter
+from .exceptions import ContentDetectionFlaggedError, UpstreamOverloadedError
+from .keyword_matcher import KeywordMatcher
+from .usage_service import UNKNOWN_COHORT, UsageTracker, default_usage_tracker
 from ..config import settings
 
 logger = logging.getLogger(__name__)
 
+# terms and patterns shipped with the service, see `settings.MODERATION_PATTERNS_PATH`
+DEFAULT_PATTERNS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "moderation_patterns.json")
+
+# end of a sentence in generated text, where it's sent to the moderation API
+SENTENCE_BOUNDARY = re.compile(r"[.!?](?=\s)|\n")
+
 
 class ContentDetectionService:
-    CATEGORY_PATTERNS: Dict[str, List[Pattern]] = {
-        "harassment": [
-            re.compile(r"\b(stupid|idiot|dumb|moron)\b", re.IGNORECASE),
-            re.compile(r"\byou suck\b", re.IGNORECASE),
-        ],
-        "harassment/threatening": [
-            re.compile(r"\bkill you\b", re.IGNORECASE),
-            re.compile(r"\bI’ll (beat|smash) you\b", re.IGNORECASE),
-        ],
-        "hate": [
-            # targeted at protected classes
-            re.compile(r"\b(nigg[ae]r|faggot|kikes)\b", re.IGNORECASE),
-            re.compile(r"\bkill all (women|blacks|jews)\b", re.IGNORECASE),
-        ],
-        "hate/threatening": [
-            re.compile(r"\b(exterminate|annihilat)e ((women|blacks|jews))\b", re.IGNORECASE),
-        ],
-        "illicit": [
-            re.compile(r"\bhow to shoplift\b", re.IGNORECASE),
-            re.compile(r"\bbuild a bomb\b", re.IGNORECASE),
-        ],
-        "illicit/violent": [
-            re.compile(r"\bwhere to get a gun\b", re.IGNORECASE),
-            re.compile(r"\bkill for hire\b", re.IGNORECASE),
-        ],
-        "self-harm": [
-            re.compile(r"\b(I want to die|cut myself|starve myself)\b", re.IGNORECASE),
-        ],
-        "self-harm/intent": [
-            re.compile(r"\bI am going to kill myself\b", re.IGNORECASE),
-        ],
-        "self-harm/instructions": [
-            re.compile(r"\bhow to kill myself\b", re.IGNORECASE),
-            re.compile(r"\bways to cut yourself\b", re.IGNORECASE),
-        ],
-        "sexual": [
-            re.compile(r"\bsexual act\b", re.IGNORECASE),
-            re.compile(r"\bexplicit sex\b", re.IGNORECASE),
-        ],
-        "sexual/minors": [
-            re.compile(r"\bunder 18\b.*\bsex\b", re.IGNORECASE),
-        ],
-        "violence": [
-            re.compile(r"\b(murder|assault|rape)\b", re.IGNORECASE),
-        ],
-        "violence/graphic": [
-            re.compile(r"\b(gore|blood spurt|disembowel)\b", re.IGNORECASE),
-        ],
-    }
-
-    def __init__(self):
+    # categories of the moderation API, the local patterns can only flag these
+    CATEGORIES = (
+        "harassment",
+        "harassment/threatening",
+        "hate",
+        "hate/threatening",
+        "illicit",
+        "illicit/violent",
+        "self-harm",
+        "self-harm/intent",
+        "self-harm/instructions",
+        "sexual",
+        "sexual/minors",
+        "violence",
+        "violence/graphic",
+    )
+
+    def __init__(
+        self,
+        limiter: Optional[AdaptiveConcurrencyLimiter] = None,
+        call_site: Optional[CallSite] = None,
+        usage_tracker: Optional[UsageTracker] = None,
+        patterns_path: Optional[str] = None,
+    ):
+        # retries are left to the limiter
         self.openai_client: openai.OpenAI = openai.OpenAI(
-            api_key=settings.OPENAI_API_KEY
+            api_key=settings.OPENAI_API_KEY,
+            max_retries=0,
         )
+        self.limiter = limiter or default_moderation_limiter
+        self.call_site = call_site or default_call_sites[MODERATION_CALL_SITE]
+        self.usage_tracker = usage_tracker or default_usage_tracker
+        self.patterns_path = patterns_path or settings.MODERATION_PATTERNS_PATH or DEFAULT_PATTERNS_PATH
+        self._matcher = self._load_matcher(self.patterns_path)
+
+    def reload_patterns(self) -> List[str]:
+        """
+        Reload the local moderation patterns from `patterns_path`.
+
+        The new matcher replaces the old one atomically, texts being checked finish with the old patterns. The old
+        patterns stay in use if the file can't be loaded.
 
-    def detect_content(self, content: str) -> Moderation:
+        Returns:
+            List[str]: The categories with terms or patterns.
+        """
+        self._matcher = self._load_matcher(self.patterns_path)
+        logger.info(f"Moderation patterns reloaded - path={self.patterns_path}")
+        return list(self._matcher.categories)
+
+    def detect_content(self, content: str, cohort: str = UNKNOWN_COHORT) -> Moderation:
         """
         Detects the content type of the given text using OpenAI's content detection API.
 
         Args:
             content (str): The text content to be analyzed.
+            cohort (str): Cohort of the user the content belongs to, for usage accounting.
 
         Returns:
             list[str]: A list of detected content types.
         """
         # return early if content is empty or None, may want to change this to require some content
         # but for now, we want to avoid sending empty content to the API
-
-        def _build_moderation_response_from_detected_types(d_types: Set[str]) -> Moderation:
-            detected_map: Dict[str, bool] = {
-                k: (k in d_types) for k in self.CATEGORY_PATTERNS
-            }
-            return Moderation(
-                flagged=bool(d_types),
-                categories=detected_map,
-                category_scores={k: float(v) for k, v in detected_map.items()},
-                category_applied_input_types={k: ["text"] if v else [] for k, v in detected_map.items()},
-            )
-
         if not content:
-            return _build_moderation_response_from_detected_types(set())
+            return self._build_moderation_from_detected_types(set())
 
         detected_types = self._detect_by_keywords(content)
-        logger.info(f"Internal detection - content={content}, detected_types={detected_types}")
+        logger.info("Internal detection - content_length=%d, detected_types=%s", len(content), detected_types)
+        logger.debug("Internal detection content - content=%s", content)
 
         # if regex catches something, return early to save on api call
         if detected_types:
-            return _build_moderation_response_from_detected_types(detected_types)
+            return self._build_moderation_from_detected_types(detected_types)
+
+        return self._moderate_with_api([content], cohort)[0]
+
+    def detect_content_many(self, contents: List[str], cohort: str = UNKNOWN_COHORT) -> List[Moderation]:
+        """
+        Detects the content types of many texts, in the order they're given.
 
-        response = self.openai_client.moderations.create(
-            model="omni-moderation-latest",
-            input=content,
+        Every text goes through the local keyword pass first, only the distinct texts it doesn't resolve are sent to
+        the moderation API, as array inputs of up to `settings.MODERATION_BATCH_MAX_INPUTS` texts per call.
+
+        Args:
+            contents (List[str]): The texts to be analyzed.
+            cohort (str): Cohort of the user the content belongs to, for usage accounting.
+
+        Returns:
+            List[Moderation]: One result per text.
+        """
+        results: List[Optional[Moderation]] = [None] * len(contents)
+        unresolved: Dict[str, List[int]] = {}
+
+        for index, content in enumerate(contents):
+            detected_types = self._detect_by_keywords(content) if content else set()
+            if detected_types or not content:
+                results[index] = self._build_moderation_from_detected_types(detected_types)
+            else:
+                unresolved.setdefault(content, []).append(index)
+
+        logger.info(
+            "Internal detection - items=%d, resolved=%d, api_inputs=%d",
+            len(contents), len(contents) - sum(len(indexes) for indexes in unresolved.values()), len(unresolved),
         )
 
-        return response.results[0]
+        if unresolved:
+            inputs = list(unresolved)
+            for content, moderation in zip(inputs, self._moderate_with_api(inputs, cohort)):
+                for index in unresolved[content]:
+                    results[index] = moderation
+
+        return results
+
+    def _moderate_with_api(self, inputs: List[str], cohort: str) -> List[Moderation]:
+        """Moderate the texts with the moderation API in array-input calls, results are in the order of `inputs`."""
+        results: List[Moderation] = []
+        chunk_size = settings.MODERATION_BATCH_MAX_INPUTS
+
+        for start in range(0, len(inputs), chunk_size):
+            results.extend(self._moderate_chunk(inputs[start:start + chunk_size], cohort))
+        return results
+
+    def _moderate_chunk(self, chunk: List[str], cohort: str) -> List[Moderation]:
+        def _create():
+            response = self.openai_client.moderations.create(
+                model="omni-moderation-latest",
+                input=chunk[0] if len(chunk) == 1 else chunk,
+            )
+            # moderation doesn't report token usage, the call is still counted
+            self.usage_tracker.record(self.call_site.name, "omni-moderation-latest", None, cohort)
+            return response
+
+        with track_stage("moderation_api"):
+            response = self.call_site.call(lambda: self.limiter.call(_create))
+
+        return response.results
+
+    def _build_moderation_from_detected_types(self, detected_types: Set[str]) -> Moderation:
+        detected_map: Dict[str, bool] = {
+            k: (k in detected_types) for k in self.CATEGORIES
+        }
+        return Moderation(
+            flagged=bool(detected_types),
+            categories=detected_map,
+            category_scores={k: float(v) for k, v in detected_map.items()},
+            category_applied_input_types={k: ["text"] if v else [] for k, v in detected_map.items()},
+        )
 
     def _detect_by_keywords(self, content: str) -> Set[str]:
         """
@@ -118,15 +184,116 @@ class ContentDetectionService:
         Returns:
             Set[str]: A list of detected content types.
         """
-        detected_types: Set[str] = set()
+        return self._matcher.match(content)
+
+    def _load_matcher(self, path: str) -> KeywordMatcher:
+        """
+        Load and compile the patterns file.
+
+        Raises:
+            ValueError: If the file has a category the moderation API doesn't.
+        """
+        matcher = KeywordMatcher.from_file(path)
+        unknown = set(matcher.categories) - set(self.CATEGORIES)
+        if unknown:
+            raise ValueError(f"Unknown moderation categories in {path}: {sorted(unknown)}")
+        return matcher
+
+
+class StreamModerator:
+    """
+    Moderates generated text as it streams.
+
+    Every chunk is checked against the local patterns before it is released, together with the end of the text
+    before it so terms split across chunks are caught. Completed sentences are sent to the moderation API in the
+    background, one call at a time per stream, so the tokens aren't held back by the round-trip. Only the last
+    sentence is waited on, in `finish`. A check the moderation API can't complete fails the stream, like a flagged one.
+    """
+
+    def __init__(self, service: ContentDetectionService, submit: Callable[..., Future], cohort: str = UNKNOWN_COHORT):
+        """
+        Initialize the moderator.
+
+        Args:
+            service (ContentDetectionService): Checks the text locally and with the moderation API.
+            submit (Callable[..., Future]): Runs a moderation API check in the background.
+            cohort (str): Cohort of the user the text is generated for, for usage accounting.
+        """
+        self.service = service
+        self.cohort = cohort
+        self._submit = submit
+        self._text = ""
+        self._local_from = 0  # start of the text the next local check covers
+        self._api_from = 0  # start of the text not sent to the moderation API yet
+        self._api_check: Optional[Future] = None
+
+    def feed(self, delta: str) -> None:
+        """
+        Check the next chunk, call before releasing it.
+
+        Raises:
+            ContentDetectionFlaggedError: If the text so far was flagged, locally or by a completed API check.
+            UpstreamOverloadedError: If a completed API check failed because the moderation API is overloaded.
+        """
+        self._text += delta
+
+        detected_types = self.service._detect_by_keywords(self._text[self._local_from:])
+        if detected_types:
+            self._flag(detected_types)
+        self._local_from = max(self._local_from, len(self._text) - settings.STREAM_MODERATION_LOCAL_OVERLAP)
+
+        if self._api_check is not None and self._api_check.done():
+            self._check_api_result(self._api_check)
+            self._api_check = None
+
+        if self._api_check is None:
+            boundary = max((m.end() for m in SENTENCE_BOUNDARY.finditer(self._text, self._api_from)), default=None)
+            if boundary is not None:
+                self._start_api_check(boundary)
+
+    def finish(self) -> None:
+        """
+        Check the rest of the text with the moderation API and wait for the checks in flight.
+
+        Raises:
+            ContentDetectionFlaggedError: If the text was flagged.
+            UpstreamOverloadedError: If an API check failed or didn't complete within
+                `settings.STREAM_MODERATION_TIMEOUT_SECONDS`.
+        """
+        if self._api_check is not None:
+            self._check_api_result(self._api_check, timeout=settings.STREAM_MODERATION_TIMEOUT_SECONDS)
+            self._api_check = None
+
+        if self._text[self._api_from:].strip():
+            self._start_api_check(len(self._text))
+            self._check_api_result(self._api_check, timeout=settings.STREAM_MODERATION_TIMEOUT_SECONDS)
+            self._api_check = None
+
+    def _start_api_check(self, end: int) -> None:
+        content = self._text[self._api_from:end]
+        self._api_from = end
+        self._api_check = self._submit(self.service.detect_content, content, self.cohort)
+
+    def _check_api_result(self, check: Future, timeout: Optional[float] = None) -> None:
+        try:
+            moderation = check.result(timeout=timeout)
+        except FuturesTimeoutError as exc:
+            # like the other paths, text the moderation API didn't check isn't delivered
+            check.cancel()
+            logger.warning(f"Stream moderation check timed out - timeout={timeout}")
+            raise UpstreamOverloadedError("stream_moderation", timeout) from exc
+        except UpstreamOverloadedError as exc:
+            logger.warning(f"Stream moderation check failed - error={exc!r}")
+            raise
 
-        for category, patterns in self.CATEGORY_PATTERNS.items():
-            for pattern in patterns:
-                if pattern.search(content):
-                    detected_types.add(category)
-                    break
+        if moderation.flagged:
+            self._flag({
+                category for category, flagged in moderation.categories.model_dump(by_alias=True).items() if flagged
+            })
 
-        return detected_types
+    def _flag(self, detected_types: Set[str]) -> None:
+        logger.warning(f"Generated content flagged - categories={sorted(detected_types)}")
+        raise ContentDetectionFlaggedError(content=self._text, flagged_categories=sorted(detected_types))
 
 
 # TODO: replace with DI/singleton
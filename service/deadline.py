@@ -0,0 +1,54 @@
+"""Request deadlines propagated through the recommendation pipeline."""
+import time
+from typing import Callable, Optional
+
+from ..config import settings
+
+
+class Deadline:
+    """Point in time by which a request has to be answered, split into time budgets for its stages."""
+
+    def __init__(self, timeout_seconds: float, clock: Callable[[], float] = time.monotonic):
+        """
+        Initialize the deadline.
+
+        Args:
+            timeout_seconds (float): Time from now until the deadline.
+            clock (Callable[[], float]): Monotonic clock in seconds.
+        """
+        self.timeout_seconds = timeout_seconds
+        self._clock = clock
+        self._expires_at = clock() + timeout_seconds
+
+    @classmethod
+    def from_timeout_ms(cls, timeout_ms: Optional[int]) -> "Deadline":
+        """
+        Deadline for a client supplied timeout, capped at `settings.RECOMMENDATION_DEADLINE_MAX_SECONDS`.
+
+        Defaults to `settings.RECOMMENDATION_DEADLINE_SECONDS` if the client didn't supply a timeout.
+        """
+        if timeout_ms is None:
+            return cls(settings.RECOMMENDATION_DEADLINE_SECONDS)
+        return cls(min(timeout_ms / 1000, settings.RECOMMENDATION_DEADLINE_MAX_SECONDS))
+
+    def remaining(self) -> float:
+        """Seconds left until the deadline, 0 once it passed."""
+        return max(0.0, self._expires_at - self._clock())
+
+    def budget(self, stage_seconds: Optional[float] = None) -> float:
+        """
+        Time a stage may take, which is its own budget if it fits, and otherwise what's left of the deadline after
+        reserving `settings.DEADLINE_FALLBACK_RESERVE_SECONDS` to answer with a fallback.
+
+        Args:
+            stage_seconds (Optional[float]): The stage's own budget, None for the rest of the deadline.
+
+        Returns:
+            float: Seconds the stage may take, 0 if the deadline already passed.
+        """
+        remaining = max(0.0, self.remaining() - settings.DEADLINE_FALLBACK_RESERVE_SECONDS)
+        return remaining if stage_seconds is None else min(stage_seconds, remaining)
+
+    @property
+    def expired(self) -> bool:
+        return self.remaining() == 0
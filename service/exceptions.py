@@ -24,4 +24,48 @@ class FlaggedGoalError(RecommendationError):
     def __init__(self, recommendation_id: str, reason: str):
         self.recommendation_id = recommendation_id
         self.reason = reason
-        super().__init__(f"Recommendation {recommendation_id} flagged: {reason}")
\ No newline at end of file
+        super().__init__(f"Recommendation {recommendation_id} flagged: {reason}")
+
+
+class EmptyBatchError(RecommendationError):
+    """Exception raised when a batch has no requests left to submit, e.g. all users' goals were flagged."""
+    def __init__(self, flagged_user_ids: List[str]):
+        self.flagged_user_ids = flagged_user_ids
+        super().__init__(f"No recommendation requests left to submit, {len(flagged_user_ids)} flagged")
+
+
+class IdempotencyKeyReusedError(Exception):
+    """Exception raised when an idempotency key is reused with a different request payload."""
+    def __init__(self, key: str):
+        self.key = key
+        super().__init__(f"Idempotency key {key} was already used for a different request")
+
+
+class JobQueueFullError(Exception):
+    """Exception raised when the job queue can't accept more jobs."""
+    def __init__(self, max_depth: int):
+        self.max_depth = max_depth
+        super().__init__(f"Job queue is full ({max_depth} jobs waiting)")
+
+
+class AdmissionRejectedError(Exception):
+    """Exception raised when a request is rejected by admission control."""
+    def __init__(self, reason: str, retry_after: float):
+        self.reason = reason
+        self.retry_after = retry_after
+        super().__init__(f"Request rejected by admission control: {reason}, retry after {retry_after:.1f}s")
+
+
+class UpstreamOverloadedError(Exception):
+    """Exception raised when the LLM provider stays overloaded after backing off."""
+    def __init__(self, limiter: str, retry_after: float):
+        self.limiter = limiter
+        self.retry_after = retry_after
+        super().__init__(f"LLM provider is overloaded ({limiter}), retry after {retry_after:.1f}s")
+
+
+class CircuitOpenError(UpstreamOverloadedError):
+    """Exception raised when a call site's circuit breaker is open and calls go straight to the fallback."""
+    def __init__(self, call_site: str, retry_after: float):
+        super().__init__(call_site, retry_after)
+        self.call_site = call_site
@@ -0,0 +1,318 @@
+"""Evaluation of goal progress over the users' metric history."""
+import functools
+import re
+import threading
+from collections import OrderedDict, defaultdict
+from datetime import date, datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from ..config import settings
+from ..dto import DailyMetric, Goal, GoalPeriod, GoalProgress
+
+# how the days of a period are combined for each metric goals can be set on, and how the result meets the target by
+# default: "at_least" the target, "at_most" the target, or "near" it within `settings.GOAL_WEIGHT_TOLERANCE_KG`
+GOAL_METRICS = {
+    "steps": ("sum", "at_least"),
+    "active_minutes": ("sum", "at_least"),
+    "calories_in": ("sum", "at_most"),
+    "sleep_hours": ("mean", "at_least"),
+    "weight_kg": ("last", "near"),
+}
+
+# wording of a goal's description that sets its direction over the metric's default, ceilings are checked first since
+# "no more than" contains "more than"
+_AT_MOST_WORDING = re.compile(
+    r"\b(no more than|not more than|at most|less than|fewer than|under|below|max(imum)?|limit|reduce)\b", re.IGNORECASE
+)
+_AT_LEAST_WORDING = re.compile(r"\b(at least|no less than|not less than|more than|min(imum)?)\b", re.IGNORECASE)
+
+# multipliers of target units that differ from the metric's own unit
+UNIT_CONVERSIONS = {
+    ("active_minutes", "hour"): 60.0,
+    ("active_minutes", "hours"): 60.0,
+    ("active_minutes", "h"): 60.0,
+    ("sleep_hours", "minute"): 1 / 60,
+    ("sleep_hours", "minutes"): 1 / 60,
+    ("sleep_hours", "min"): 1 / 60,
+    ("weight_kg", "lb"): 0.45359237,
+    ("weight_kg", "lbs"): 0.45359237,
+}
+
+_NUMBER = re.compile(r"(\d{1,3}(?:,\d{3})+|\d+(?:\.\d+)?|\.\d+)\s*(k\b)?", re.IGNORECASE)
+
+PERIOD_DAYS = {GoalPeriod.DAILY: 1, GoalPeriod.WEEKLY: 7}
+PERIOD_MONTHS = {GoalPeriod.MONTHLY: 1, GoalPeriod.YEARLY: 12}
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_target(metric: str, target_value: str, target_unit: str) -> Optional[float]:
+    """
+    The goal's target in the metric's unit, e.g. "10k" steps is 10000 and "1.5" hours of active minutes is 90.
+
+    Goals mostly repeat the same few targets, so the parsed ones are cached.
+
+    Returns:
+        Optional[float]: The target, None if it has no number or isn't positive.
+    """
+    found = _NUMBER.search(target_value or "")
+    if found is None:
+        return None
+
+    target = float(found.group(1).replace(",", ""))
+    if found.group(2):
+        target *= 1000
+    target *= UNIT_CONVERSIONS.get((metric, (target_unit or "").strip().lower()), 1.0)
+    return target if target > 0 else None
+
+
+@functools.lru_cache(maxsize=4096)
+def goal_comparison(metric: str, description: str) -> str:
+    """
+    How the goal's value meets its target, e.g. "Consume no more than 1,800 kcal" is "at_most".
+
+    Goals on totals and averages take the direction their description words, e.g. a minimum calorie intake, the
+    others and goals that don't word one take the metric's default.
+    """
+    aggregation, comparison = GOAL_METRICS[metric]
+    if aggregation == "last":
+        return comparison
+    if _AT_MOST_WORDING.search(description or ""):
+        return "at_most"
+    if _AT_LEAST_WORDING.search(description or ""):
+        return "at_least"
+    return comparison
+
+
+def _add_months(day: date, months: int) -> date:
+    """The day `months` later, on the last day of the month if it's shorter."""
+    month_index = day.month - 1 + months
+    year, month = day.year + month_index // 12, month_index % 12 + 1
+    next_month = date(year + month // 12, month % 12 + 1, 1)
+    return date(year, month, min(day.day, (next_month - timedelta(days=1)).day))
+
+
+def period_window(goal: Goal, as_of: date) -> Tuple[date, date]:
+    """First and exclusive last day of the goal's period containing `as_of`, periods repeat from its start date."""
+    start = goal.start_date.date()
+    as_of = max(as_of, start)
+
+    if goal.period in PERIOD_DAYS:
+        length = PERIOD_DAYS[goal.period]
+        period_start = start + timedelta(days=(as_of - start).days // length * length)
+        return period_start, period_start + timedelta(days=length)
+
+    if goal.period in PERIOD_MONTHS:
+        length = PERIOD_MONTHS[goal.period]
+        months = (as_of.year - start.year) * 12 + as_of.month - start.month
+        period_start = _add_months(start, months // length * length)
+        if period_start > as_of:
+            period_start = _add_months(start, (months // length - 1) * length)
+        return period_start, _add_months(period_start, length)
+
+    # lifetime goals never end
+    return start, date.max
+
+
+class _MetricTable:
+    """
+    Days of all users in one array sorted by user and day, with prefix sums, so the total over any user's range of
+    days is two lookups and all the ranges of a metric are looked up at once.
+    """
+
+    def __init__(self, metrics_by_day: Dict[Tuple[str, int], DailyMetric], users: Dict[str, int]):
+        keys = sorted(metrics_by_day, key=lambda key: (users[key[0]], key[1]))
+        self._metrics = [metrics_by_day[key] for key in keys]
+        self.keys = np.array([self.key(users[user_id], day) for user_id, day in keys], dtype=np.int64)
+        self._columns: Dict[str, Tuple[np.ndarray, np.ndarray, np.ndarray]] = {}
+
+    @staticmethod
+    def key(user: int, day: int) -> int:
+        """Position of a user's day in the table, day ordinals are below 10 million."""
+        return user * 10_000_000 + day
+
+    def aggregate(self, field: str, aggregation: str, starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+        """The metric combined over each range of keys `[starts[i], ends[i])`, NaN where there are no values."""
+        values, sums, counts = self._column(field)
+        first = np.searchsorted(self.keys, starts, side="left")
+        last = np.searchsorted(self.keys, ends, side="left")
+        range_counts = counts[last] - counts[first]
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            if aggregation == "sum":
+                result = sums[last] - sums[first]
+            elif aggregation == "mean":
+                result = (sums[last] - sums[first]) / range_counts
+            elif range_counts.any():
+                # the latest day with a value in the range, there is one wherever the count isn't 0
+                present = np.flatnonzero(~np.isnan(values))
+                result = values[present[np.maximum(np.searchsorted(present, last, side="left") - 1, 0)]]
+            else:
+                result = np.full(len(starts), np.nan)
+
+        return np.where(range_counts > 0, result, np.nan)
+
+    def _column(self, field: str) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Values of the metric, NaN where missing, with the prefix sums of the values and of their count."""
+        if field not in self._columns:
+            values = np.array([getattr(metric, field) for metric in self._metrics], dtype=float)
+            present = ~np.isnan(values)
+            self._columns[field] = (
+                values,
+                np.concatenate(([0.0], np.cumsum(np.where(present, values, 0.0)))),
+                np.concatenate(([0], np.cumsum(present))),
+            )
+        return self._columns[field]
+
+
+class GoalProgressService:
+    """
+    Computes the progress of goals over their current daily, weekly, monthly, yearly or lifetime period.
+
+    Targets are parsed once, and the goals of a user are evaluated together on prefix sums of their metric history,
+    so a period's total costs the same whatever its length. The last `settings.GOAL_HISTORY_DAYS` days of each user
+    are kept as they come in, for recommendations that only carry today's metrics.
+    """
+
+    def __init__(
+        self,
+        history_days: Optional[int] = None,
+        max_users: Optional[int] = None,
+        weight_tolerance_kg: Optional[float] = None,
+    ):
+        """
+        Initialize the service.
+
+        Args:
+            history_days (Optional[int]): Days of metrics kept per user, defaults to `settings.GOAL_HISTORY_DAYS`.
+            max_users (Optional[int]): Users whose history is kept, the least recently updated are evicted first,
+                defaults to `settings.GOAL_HISTORY_MAX_USERS`.
+            weight_tolerance_kg (Optional[float]): How close to a weight target counts as met, defaults to
+                `settings.GOAL_WEIGHT_TOLERANCE_KG`.
+        """
+        self.history_days = history_days or settings.GOAL_HISTORY_DAYS
+        self.max_users = max_users or settings.GOAL_HISTORY_MAX_USERS
+        self.weight_tolerance_kg = weight_tolerance_kg or settings.GOAL_WEIGHT_TOLERANCE_KG
+        self._history: "OrderedDict[str, Dict[int, DailyMetric]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def observe(self, metrics: Iterable[DailyMetric]) -> None:
+        """Add days to their users' history, replacing the ones already there."""
+        with self._lock:
+            for metric in metrics:
+                days = self._history.get(metric.user_id)
+                if days is None:
+                    days = self._history[metric.user_id] = {}
+                    if len(self._history) > self.max_users:
+                        self._history.popitem(last=False)
+                else:
+                    self._history.move_to_end(metric.user_id)
+
+                days[metric.date.date().toordinal()] = metric
+                if len(days) > self.history_days:
+                    cutoff = max(days) - self.history_days
+                    for day in [day for day in days if day <= cutoff]:
+                        del days[day]
+
+    def history(self, user_id: str) -> List[DailyMetric]:
+        """The user's kept days."""
+        with self._lock:
+            return list(self._history.get(user_id, {}).values())
+
+    def evaluate(
+        self,
+        goals: List[Goal],
+        metrics: List[DailyMetric],
+        as_of: Optional[datetime] = None,
+    ) -> List[GoalProgress]:
+        """
+        Evaluate the active goals of any number of users.
+
+        Goals on metrics that aren't tracked, or whose target has no number, are left out.
+
+        Args:
+            goals (List[Goal]): The goals, of any users.
+            metrics (List[DailyMetric]): The metric history of the goals' users.
+            as_of (Optional[datetime]): Day the periods are evaluated on, each user's latest metric day by default.
+
+        Returns:
+            List[GoalProgress]: The progress of the evaluated goals, in the order of `goals`.
+        """
+        # the last metric of a user's day wins
+        metrics_by_day: Dict[Tuple[str, int], DailyMetric] = {}
+        latest_days: Dict[str, int] = {}
+        for metric in metrics:
+            day = metric.date.date().toordinal()
+            metrics_by_day[metric.user_id, day] = metric
+            latest_days[metric.user_id] = max(day, latest_days.get(metric.user_id, day))
+        users = {user_id: index for index, user_id in enumerate(latest_days)}
+        default_day = as_of.date() if as_of is not None else datetime.utcnow().date()
+
+        # the goals of each metric are evaluated together, whoever's they are
+        pending: Dict[str, List[Tuple[Goal, float, date, date, date, str]]] = defaultdict(list)
+        for goal in goals:
+            if goal.status != "active" or goal.metric not in GOAL_METRICS:
+                continue
+            target = parse_target(goal.metric, goal.target_value, goal.target_unit)
+            if target is None:
+                continue
+
+            day = default_day
+            if as_of is None and goal.user_id in latest_days:
+                day = date.fromordinal(latest_days[goal.user_id])
+            period_start, period_end = period_window(goal, day)
+            comparison = goal_comparison(goal.metric, goal.description)
+            pending[goal.metric].append((goal, target, period_start, period_end, day, comparison))
+
+        table = _MetricTable(metrics_by_day, users)
+        results: Dict[int, GoalProgress] = {}
+        for field, field_goals in pending.items():
+            aggregation, _ = GOAL_METRICS[field]
+            # users without metrics get an index past the table's, so their ranges are empty
+            user_indexes = np.array([users.get(goal.user_id, len(users)) for goal, *_ in field_goals], dtype=np.int64)
+            targets = np.array([target for _, target, *_ in field_goals])
+            starts = np.array([start.toordinal() for _, _, start, *_ in field_goals], dtype=np.int64)
+            ends = np.array([end.toordinal() for _, _, _, end, *_ in field_goals], dtype=np.int64)
+            days = np.array([day.toordinal() for _, _, _, _, day, _ in field_goals], dtype=np.int64)
+            comparisons = np.array([comparison for *_, comparison in field_goals])
+
+            # only the days up to the evaluated one count
+            values = table.aggregate(
+                field,
+                aggregation,
+                table.key(user_indexes, starts),
+                table.key(user_indexes, np.minimum(ends, days + 1)),
+            )
+            progress = np.nan_to_num(values / targets)
+            # the evaluated period contains the day, so it's still running: a goal not met yet stays active, ceilings
+            # included, the user still has the rest of the period
+            with np.errstate(invalid="ignore"):
+                met = np.where(
+                    comparisons == "near",
+                    np.abs(values - targets) <= self.weight_tolerance_kg,
+                    (comparisons == "at_least") & (progress >= 1),
+                )
+                # except a ceiling on a total, which is missed as soon as it's exceeded, an average can still come
+                # back under it
+                missed = (comparisons == "at_most") & (values > targets) & (aggregation == "sum")
+
+            for i, (goal, target, period_start, period_end, *_) in enumerate(field_goals):
+                results[id(goal)] = GoalProgress(
+                    goal_id=goal.id,
+                    user_id=goal.user_id,
+                    metric=field,
+                    period=goal.period,
+                    target=target,
+                    value=None if np.isnan(values[i]) else round(float(values[i]), 2),
+                    progress=round(float(progress[i]), 3),
+                    status="met" if met[i] else "expired" if missed[i] else "active",
+                    period_start=datetime.combine(period_start, datetime.min.time()),
+                    period_end=None if period_end == date.max else datetime.combine(period_end, datetime.min.time()),
+                )
+
+        return [results[id(goal)] for goal in goals if id(goal) in results]
+
+
+# TODO: replace with DI/singleton
+default_goal_progress_service = GoalProgressService()
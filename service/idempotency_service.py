@@ -0,0 +1,68 @@
+"""Deduplication of retried requests through client supplied idempotency keys."""
+import hashlib
+import json
+import logging
+from typing import Callable, Optional, Tuple, TypeVar
+
+from pydantic import BaseModel
+
+from .single_flight import SingleFlightStore
+from ..config import settings
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+def request_fingerprint(*payloads: BaseModel) -> str:
+    """Hash the request payload, so a key reused for a different request can be detected."""
+    canonical = json.dumps([payload.model_dump(mode="json") for payload in payloads], sort_keys=True)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+class IdempotencyStore(SingleFlightStore):
+    """
+    In-memory store of responses keyed by idempotency key.
+
+    The first request for a key runs, concurrent duplicates wait for its result and later duplicates get the stored
+    result until it expires. Failed requests aren't stored, so a retry after a failure runs again.
+    """
+
+    def __init__(self, ttl_seconds: Optional[float] = None, max_entries: Optional[int] = None):
+        """
+        Initialize the store.
+
+        Args:
+            ttl_seconds (Optional[float]): How long a response is stored, defaults to `settings.IDEMPOTENCY_TTL_SECONDS`.
+            max_entries (Optional[int]): Maximum stored responses, the oldest are evicted first,
+                defaults to `settings.IDEMPOTENCY_MAX_ENTRIES`.
+        """
+        super().__init__(
+            "idempotency",
+            ttl_seconds or settings.IDEMPOTENCY_TTL_SECONDS,
+            max_entries or settings.IDEMPOTENCY_MAX_ENTRIES,
+        )
+
+    def run(self, key: str, fingerprint: str, fn: Callable[[], T]) -> Tuple[T, bool]:
+        """
+        Run `fn` once per key and return its result to every request with that key.
+
+        Args:
+            key (str): The idempotency key, scoped by the caller to the route.
+            fingerprint (str): Fingerprint of the request payload.
+            fn (Callable[[], T]): Produces the response.
+
+        Returns:
+            Tuple[T, bool]: The response and whether it was replayed from an earlier request.
+
+        Raises:
+            IdempotencyKeyReusedError: If the key was used for a different payload.
+        """
+        result, replayed = self.get_or_compute(key, fn, fingerprint=fingerprint)
+        if replayed:
+            logger.info("Idempotent replay - key=%s", key)
+        return result, replayed
+
+
+# TODO: replace with DI/singleton
+default_idempotency_store = IdempotencyStore()
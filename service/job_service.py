@@ -0,0 +1,242 @@
+"""Background generation of recommendations for clients that shouldn't hold a connection open."""
+import logging
+import queue
+import random
+import threading
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, Optional, Tuple
+
+import httpx
+import openai
+
+from .exceptions import ContentDetectionFlaggedError, JobQueueFullError, UpstreamOverloadedError
+from .metrics import current_route
+from .orchestration_service import OrchestrationService
+from ..config import settings
+from ..dto import JobStatus, RecommendationJob, RecommendationRequest
+
+logger = logging.getLogger(__name__)
+
+# transient provider failures, anything else would fail the same way again
+RETRYABLE_JOB_ERRORS = (UpstreamOverloadedError, openai.APITimeoutError, openai.APIConnectionError)
+
+
+class RecommendationJobService:
+    """
+    Queue of recommendation jobs processed by a local pool of worker threads.
+
+    Attempts that fail because the provider is overloaded or unreachable are retried with exponential backoff, any
+    other failure fails the job immediately.
+    Finished jobs can be polled until they expire and are optionally delivered to a callback URL.
+    """
+
+    def __init__(
+        self,
+        orchestrator: OrchestrationService,
+        worker_count: Optional[int] = None,
+        max_queue_depth: Optional[int] = None,
+        max_attempts: Optional[int] = None,
+        retry_backoff_seconds: Optional[float] = None,
+    ):
+        """
+        Initialize the job service, the workers are started on the first submission.
+
+        Args:
+            orchestrator (OrchestrationService): Generates the recommendations.
+            worker_count (Optional[int]): Number of worker threads, defaults to `settings.JOB_WORKER_COUNT`.
+            max_queue_depth (Optional[int]): Maximum waiting jobs, defaults to `settings.JOB_QUEUE_MAX_DEPTH`.
+            max_attempts (Optional[int]): Attempts per job, defaults to `settings.JOB_MAX_ATTEMPTS`.
+            retry_backoff_seconds (Optional[float]): Delay before the first retry, doubled on every retry,
+                defaults to `settings.JOB_RETRY_BACKOFF_SECONDS`.
+        """
+        self.orchestrator = orchestrator
+        self.worker_count = worker_count or settings.JOB_WORKER_COUNT
+        self.max_queue_depth = max_queue_depth or settings.JOB_QUEUE_MAX_DEPTH
+        self.max_attempts = max_attempts or settings.JOB_MAX_ATTEMPTS
+        self.retry_backoff_seconds = retry_backoff_seconds or settings.JOB_RETRY_BACKOFF_SECONDS
+
+        self._queue: queue.Queue = queue.Queue(maxsize=self.max_queue_depth)
+        self._jobs: Dict[str, RecommendationJob] = {}
+        self._requests: Dict[str, Tuple[RecommendationRequest, Optional[int]]] = {}
+        # finished job ids and when they finished, in that order
+        self._finished: "OrderedDict[str, float]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._workers = []
+
+    def submit(
+        self,
+        request: RecommendationRequest,
+        callback_url: Optional[str] = None,
+        send_time: Optional[int] = None,
+    ) -> RecommendationJob:
+        """
+        Queue a recommendation job.
+
+        Args:
+            request (RecommendationRequest): The recommendation inputs.
+            callback_url (Optional[str]): Receives the job as a POST once it succeeded or failed.
+            send_time (Optional[int]): Hour the recommendation will be sent, selected by the timing policy if None.
+
+        Returns:
+            RecommendationJob: The queued job.
+
+        Raises:
+            JobQueueFullError: If the queue is at its maximum depth.
+        """
+        self.start()
+
+        job = RecommendationJob(id=str(uuid.uuid4()), user_id=request.profile.user_id, callback_url=callback_url)
+        with self._lock:
+            self._evict_expired()
+            self._jobs[job.id] = job
+            self._requests[job.id] = (request, send_time)
+
+        try:
+            self._queue.put_nowait(job.id)
+        except queue.Full:
+            with self._lock:
+                del self._jobs[job.id]
+                del self._requests[job.id]
+            raise JobQueueFullError(self.max_queue_depth)
+
+        logger.info(f"Recommendation job queued - job_id={job.id}, user_id={job.user_id}")
+
+        return job.model_copy()
+
+    def get(self, job_id: str) -> Optional[RecommendationJob]:
+        """Get a snapshot of a job by ID."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return job.model_copy() if job else None
+
+    def queue_depth(self) -> int:
+        """Number of jobs waiting for a worker."""
+        return self._queue.qsize()
+
+    def start(self) -> None:
+        """Start the worker threads if they aren't running yet."""
+        with self._lock:
+            if self._workers:
+                return
+            for i in range(self.worker_count):
+                worker = threading.Thread(target=self._work, name=f"recommendation-job-worker-{i}", daemon=True)
+                worker.start()
+                self._workers.append(worker)
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """Stop the workers once they finish their current job, queued jobs are not processed."""
+        with self._lock:
+            workers, self._workers = self._workers, []
+
+        # drop waiting jobs so the stop signals reach the workers
+        while True:
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                break
+
+        for _ in workers:
+            self._queue.put(None)
+        for worker in workers:
+            worker.join(timeout)
+
+    def _work(self) -> None:
+        current_route.set("job")
+        while True:
+            job_id = self._queue.get()
+            if job_id is None:
+                return
+            self._run(job_id)
+
+    def _run(self, job_id: str) -> None:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job_id not in self._requests:
+                return
+            request, send_time = self._requests[job_id]
+            job.status = JobStatus.RUNNING
+            job.attempts += 1
+            job.updated_at = datetime.utcnow()
+
+        try:
+            recommendation = self.orchestrator.create_daily_recommendation(
+                request.profile, request.daily_metrics, request.goals, send_time=send_time, background=True
+            )
+        except ContentDetectionFlaggedError as exc:
+            self._finish(job_id, error=f"Content flagged: {', '.join(exc.flagged_categories)}")
+        except RETRYABLE_JOB_ERRORS as exc:
+            if job.attempts >= self.max_attempts:
+                logger.exception(f"Recommendation job failed - job_id={job_id}, attempts={job.attempts}")
+                self._finish(job_id, error="Unknown error occurred. Please contact responsible team.")
+            else:
+                self._retry_later(job_id, job.attempts, exc)
+        except Exception:
+            logger.exception(f"Recommendation job failed - job_id={job_id}, attempts={job.attempts}")
+            self._finish(job_id, error="Unknown error occurred. Please contact responsible team.")
+        else:
+            self._finish(job_id, recommendation=recommendation)
+
+    def _retry_later(self, job_id: str, attempts: int, exc: Exception) -> None:
+        """Re-queue the job after a jittered exponential backoff, without holding up the worker."""
+        delay = self.retry_backoff_seconds * 2 ** (attempts - 1) * random.uniform(0.5, 1.5)
+        logger.warning(f"Recommendation job retrying - job_id={job_id}, attempts={attempts}, delay={delay:.1f}, error={exc!r}")
+
+        with self._lock:
+            self._jobs[job_id].status = JobStatus.QUEUED
+            self._jobs[job_id].updated_at = datetime.utcnow()
+
+        def requeue():
+            try:
+                self._queue.put_nowait(job_id)
+            except queue.Full:
+                self._finish(job_id, error="Job queue is full, retry abandoned.")
+
+        timer = threading.Timer(delay, requeue)
+        timer.daemon = True
+        timer.start()
+
+    def _finish(self, job_id: str, recommendation=None, error: Optional[str] = None) -> None:
+        with self._lock:
+            job = self._jobs[job_id]
+            job.status = JobStatus.FAILED if error else JobStatus.SUCCEEDED
+            job.recommendation = recommendation
+            job.error = error
+            job.updated_at = datetime.utcnow()
+            self._requests.pop(job_id, None)
+            self._finished[job_id] = job.updated_at.timestamp()
+            snapshot = job.model_copy()
+
+        logger.info(f"Recommendation job finished - job_id={job_id}, status={snapshot.status.value}")
+
+        if snapshot.callback_url:
+            self._deliver(snapshot)
+
+    @staticmethod
+    def _deliver(job: RecommendationJob) -> None:
+        """Best effort delivery of the finished job to its callback URL, the job can still be polled if this fails."""
+        try:
+            response = httpx.post(
+                job.callback_url,
+                content=job.model_dump_json(),
+                headers={"Content-Type": "application/json"},
+                timeout=settings.JOB_CALLBACK_TIMEOUT_SECONDS,
+            )
+            response.raise_for_status()
+        except httpx.HTTPError as exc:
+            logger.warning(f"Recommendation job callback failed - job_id={job.id}, error={exc!r}")
+
+    def _evict_expired(self) -> None:
+        """
+        Drop finished jobs older than `settings.JOB_RESULT_TTL_SECONDS`, must hold the lock.
+
+        Finished jobs are in the order they finished, so only the ones evicted and the first one kept are looked at.
+        """
+        cutoff = datetime.utcnow().timestamp() - settings.JOB_RESULT_TTL_SECONDS
+        while self._finished:
+            job_id, finished_at = next(iter(self._finished.items()))
+            if finished_at >= cutoff:
+                break
+            del self._finished[job_id]
+            self._jobs.pop(job_id, None)
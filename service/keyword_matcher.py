@@ -0,0 +1,139 @@
+"""Single-pass matching of the local moderation terms and patterns."""
+import json
+import re
+from collections import deque
+from typing import Dict, Iterable, List, Mapping, Optional, Pattern, Set, Tuple
+
+from .text_normalizer import canonical_variants, canonicalize, squeeze
+
+
+def _is_word_char(char: str) -> bool:
+    return char.isalnum() or char == "_"
+
+
+class _TermAutomaton:
+    """
+    Aho-Corasick automaton over literal terms.
+
+    The text is scanned once whatever the number of terms, matches only count on word boundaries like `\\b` would.
+    """
+
+    def __init__(self, terms: Iterable[Tuple[str, str]]):
+        """
+        Build the automaton.
+
+        Args:
+            terms (Iterable[Tuple[str, str]]): (term, category) pairs.
+        """
+        # per state: transitions, failure link, (length, category) of the terms ending there
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._output: List[List[Tuple[int, str]]] = [[]]
+
+        for term, category in terms:
+            state = 0
+            for char in term:
+                if char not in self._goto[state]:
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append([])
+                    self._goto[state][char] = len(self._goto) - 1
+                state = self._goto[state][char]
+            self._output[state].append((len(term), category))
+
+        # breadth-first, so the failure state of a node is always complete before its children
+        pending = deque(self._goto[0].values())
+        while pending:
+            state = pending.popleft()
+            for char, child in self._goto[state].items():
+                pending.append(child)
+                fallback = self._fail[state]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                self._fail[child] = self._goto[fallback].get(char, 0) if state else 0
+                self._output[child] = self._output[child] + self._output[self._fail[child]]
+
+    def match(self, text: str, categories: Set[str]) -> None:
+        """Add the categories of the terms found in `text`."""
+        goto, fail, output = self._goto, self._fail, self._output
+        state = 0
+        for end, char in enumerate(text, start=1):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for length, category in output[state]:
+                if category in categories:
+                    continue
+                start = end - length
+                if (start == 0 or not _is_word_char(text[start - 1])) and (
+                    end == len(text) or not _is_word_char(text[end])
+                ):
+                    categories.add(category)
+
+
+class KeywordMatcher:
+    """
+    Matches a text against the moderation categories' terms and patterns in one pass each.
+
+    Literal terms go into an Aho-Corasick automaton, so the scan time doesn't grow with the number of terms. Regex
+    patterns, for what can't be written as terms, are combined into one alternation with a named group per pattern.
+
+    Texts are canonicalized first, in each reading of their leetspeak, see `text_normalizer`. Terms are canonicalized
+    and squeezed like the texts, so they're written plainly, patterns are matched against the canonical text before
+    squeezing.
+    """
+
+    def __init__(self, categories: Mapping[str, Mapping[str, List[str]]]):
+        """
+        Compile the matcher.
+
+        Args:
+            categories (Mapping[str, Mapping[str, List[str]]]): Per category, its case-insensitive literal `terms`
+                and regex `patterns`.
+
+        Raises:
+            ValueError: If a pattern doesn't compile.
+        """
+        self.categories = tuple(categories)
+        self._terms = _TermAutomaton(
+            (squeeze(canonicalize(term)), category)
+            for category, entry in categories.items()
+            for term in entry.get("terms", [])
+        )
+
+        self._group_categories: Dict[str, str] = {}
+        alternatives = []
+        for category, entry in categories.items():
+            for pattern in entry.get("patterns", []):
+                group = f"p{len(self._group_categories)}"
+                self._group_categories[group] = category
+                alternatives.append(f"(?P<{group}>{pattern})")
+
+        try:
+            self._patterns: Optional[Pattern] = re.compile("|".join(alternatives), re.IGNORECASE) if alternatives else None
+        except re.error as exc:
+            raise ValueError(f"Invalid moderation pattern: {exc}") from exc
+
+    @classmethod
+    def from_file(cls, path: str) -> "KeywordMatcher":
+        """Load a matcher from a JSON file of `{category: {"terms": [...], "patterns": [...]}}`."""
+        with open(path, "rt", encoding="utf-8") as f:
+            return cls(json.load(f))
+
+    def match(self, text: str) -> Set[str]:
+        """The categories with a term or pattern found in the text."""
+        categories: Set[str] = set()
+        for text in canonical_variants(text):
+            self._terms.match(squeeze(text), categories)
+
+            if self._patterns is not None:
+                # patterns can overlap, so the search resumes right after the start of each match
+                position = 0
+                while position <= len(text):
+                    found = self._patterns.search(text, position)
+                    if found is None:
+                        break
+                    categories.add(self._group_categories[found.lastgroup])
+                    position = found.start() + 1
+
+        return categories
@@ -0,0 +1,261 @@
+"""In-process metrics exposed in the Prometheus text format."""
+import bisect
+import contextvars
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple, TypeVar
+
+T = TypeVar("T")
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# route template of the request being handled, "background" for work that isn't tied to a request
+current_route: contextvars.ContextVar[str] = contextvars.ContextVar("current_route", default="background")
+
+# (name, labels, value) of a sample reported by a collector
+Sample = Tuple[str, Dict[str, str], float]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(label_names: Sequence[str], label_values: Sequence[str]) -> str:
+    if not label_names:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(str(value))}"' for name, value in zip(label_names, label_values))
+    return "{" + pairs + "}"
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+class _Metric:
+    type = ""
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        lines.extend(self._render_samples())
+        return lines
+
+    def _render_samples(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """Monotonically increasing count."""
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = ()):
+        super().__init__(name, documentation, label_names)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _render_samples(self) -> List[str]:
+        with self._lock:
+            values = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.label_names, key)} {_format_value(v)}" for key, v in values]
+
+
+class Gauge(Counter):
+    """Value that can go up and down."""
+    type = "gauge"
+
+    def dec(self, amount: float = 1, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    @contextmanager
+    def track_in_progress(self, **labels: str) -> Iterator[None]:
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+
+class Histogram(_Metric):
+    """Distribution of observed values in cumulative buckets."""
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        label_names: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets))
+        # per label set: count per bucket (the last one is +Inf), sum of the observations
+        self._values: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.setdefault(key, ([0] * (len(self.buckets) + 1), [0.0]))
+            counts[index] += 1
+            total[0] += value
+
+    def _render_samples(self) -> List[str]:
+        with self._lock:
+            values = [(key, list(counts), total[0]) for key, (counts, total) in self._values.items()]
+
+        lines = []
+        label_names = self.label_names + ("le",)
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                lines.append(
+                    f"{self.name}_bucket{_format_labels(label_names, key + (_format_value(bound),))} {cumulative}"
+                )
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, key)} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    """
+    Registry of the service's metrics.
+
+    Updating a metric only takes a lock and a dict lookup, the text format is built when `/metrics` is scraped.
+    Collectors report the counters services already keep, e.g. admission control, as gauges at scrape time.
+    """
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._collectors: List[Tuple[str, Callable[[], List[Sample]]]] = []
+        self._lock = threading.Lock()
+
+    def counter(self, name: str, documentation: str, label_names: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, documentation, label_names))
+
+    def gauge(self, name: str, documentation: str, label_names: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge(name, documentation, label_names))
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        label_names: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ) -> Histogram:
+        return self._register(Histogram(name, documentation, label_names, buckets))
+
+    def register_collector(self, documentation: str, collect: Callable[[], List[Sample]]) -> None:
+        """Register a callable reporting gauge samples when the metrics are rendered."""
+        with self._lock:
+            self._collectors.append((documentation, collect))
+
+    def render(self) -> str:
+        """The metrics in the Prometheus text exposition format."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+            collectors = list(self._collectors)
+
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+
+        for documentation, collect in collectors:
+            samples: Dict[str, List[Tuple[Dict[str, str], float]]] = {}
+            for name, labels, value in collect():
+                samples.setdefault(name, []).append((labels, value))
+            for name, values in samples.items():
+                lines.append(f"# HELP {name} {documentation}")
+                lines.append(f"# TYPE {name} gauge")
+                for labels, value in values:
+                    lines.append(f"{name}{_format_labels(list(labels), list(labels.values()))} {_format_value(value)}")
+
+        return "\n".join(lines) + "\n"
+
+    def _register(self, metric: _Metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric {metric.name} is already registered")
+            self._metrics[metric.name] = metric
+        return metric
+
+
+def stats_samples(prefix: str, stats: Dict[str, object], **labels: str) -> List[Sample]:
+    """Turn the numeric entries of a service's `stats()` into samples named `{prefix}_{key}`."""
+    return [
+        (f"{prefix}_{key}", labels, float(value))
+        for key, value in stats.items()
+        if isinstance(value, (int, float))
+    ]
+
+
+# TODO: replace with DI/singleton
+default_metrics_registry = MetricsRegistry()
+
+HTTP_REQUEST_DURATION = default_metrics_registry.histogram(
+    "coaching_http_request_duration_seconds", "HTTP request latency.", ["route", "method", "status"]
+)
+HTTP_REQUESTS_IN_FLIGHT = default_metrics_registry.gauge(
+    "coaching_http_requests_in_flight", "HTTP requests being handled."
+)
+STAGE_DURATION = default_metrics_registry.histogram(
+    "coaching_stage_duration_seconds", "Latency of the pipeline stages.", ["route", "stage"]
+)
+STAGES_IN_FLIGHT = default_metrics_registry.gauge(
+    "coaching_stages_in_flight", "Pipeline stages running.", ["route", "stage"]
+)
+STAGE_ERRORS = default_metrics_registry.counter(
+    "coaching_stage_errors_total", "Pipeline stages that raised.", ["route", "stage", "error"]
+)
+CACHE_REQUESTS = default_metrics_registry.counter(
+    "coaching_cache_requests_total", "Cache lookups by result, hit or miss.", ["cache", "result"]
+)
+FALLBACKS = default_metrics_registry.counter(
+    "coaching_fallbacks_total", "Responses served from a fallback instead of the assistant.", ["route", "kind"]
+)
+STORE_WRITES_DROPPED = default_metrics_registry.counter(
+    "coaching_store_writes_dropped_total", "Recommendations dropped after the store failed to commit them."
+)
+
+
+@contextmanager
+def track_stage(stage: str) -> Iterator[None]:
+    """Record the latency, in-flight count and errors of a pipeline stage for the current route."""
+    route = current_route.get()
+    STAGES_IN_FLIGHT.inc(route=route, stage=stage)
+    started_at = time.perf_counter()
+    try:
+        yield
+    except Exception as exc:
+        STAGE_ERRORS.inc(route=route, stage=stage, error=type(exc).__name__)
+        raise
+    finally:
+        STAGE_DURATION.observe(time.perf_counter() - started_at, route=route, stage=stage)
+        STAGES_IN_FLIGHT.dec(route=route, stage=stage)
+
+
+def in_current_context(fn: Callable[..., T]) -> Callable[..., T]:
+    """Wrap `fn` to run in a copy of the caller's context, so stages on other threads keep the route label."""
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.run(fn, *args, **kwargs)
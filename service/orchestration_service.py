@@ -1,13 +1,24 @@
 import logging
+import threading
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor, as_completed
+from concurrent.futures import TimeoutError as FuturesTimeoutError
 from datetime import datetime
-from typing import List, Optional
+from typing import Callable, Iterator, List, Optional, Tuple, Union
 from uuid import uuid4
 
-from .exceptions import ContentDetectionFlaggedError
+from .exceptions import ContentDetectionFlaggedError, UpstreamOverloadedError
+from ..config import settings
 from ..model import RiskPredictor, TimingPolicy
-from ..dto import BehavioralRecommendation, Recommendation, UserProfile, DailyMetric, Goal
+from ..dto import BehavioralRecommendation, Recommendation, RecommendationRequest, UserProfile, DailyMetric, Goal
 from ..service import AssistantService, BehavioralAnalysisService
-from .content_detection_service import default_content_detection_service
+from .assistant_service import CompletionStream
+from .content_detection_service import StreamModerator, default_content_detection_service
+from .deadline import Deadline
+from .goal_progress_service import GoalProgressService, default_goal_progress_service
+from .metrics import FALLBACKS, current_route, in_current_context, track_stage
+from .percentile_service import PopulationPercentiles, default_population_percentiles
+from .recommendation_store import RecommendationStore
+from .usage_service import UsageTracker, default_usage_tracker, user_cohort
 
 logger = logging.getLogger(__name__)
 
@@ -19,6 +30,12 @@ class OrchestrationService:
         risk_predictor: RiskPredictor,
         timing_policy: TimingPolicy,
         behavior_service: BehavioralAnalysisService,
+        recommendation_store: Optional[RecommendationStore] = None,
+        completion_workers: Optional[int] = None,
+        moderation_workers: Optional[int] = None,
+        usage_tracker: Optional[UsageTracker] = None,
+        population_percentiles: Optional[PopulationPercentiles] = None,
+        goal_progress_service: Optional[GoalProgressService] = None,
     ):
         """Initialize the orchestration service.
 
@@ -26,18 +43,45 @@ class OrchestrationService:
             assistant_service (AssistantService): The assistant service to use.
             risk_predictor (RiskPredictor): The risk predictor to use.
             timing_policy (TimingPolicy): The timing policy to use.
+            recommendation_store (Optional[RecommendationStore]): Where generated recommendations are persisted,
+                nothing is persisted if None.
+            completion_workers (Optional[int]): Size of the thread pool running the completions of interactive
+                requests, one per request admission lets in, defaults to `settings.ADMISSION_MAX_CONCURRENT_LLM_REQUESTS`.
+            moderation_workers (Optional[int]): Size of the separate thread pool running moderation checks, so they
+                never wait behind completions, defaults to `settings.ORCHESTRATION_MODERATION_WORKERS`.
+            usage_tracker (Optional[UsageTracker]): Counts the delivered recommendations for the cost per
+                recommendation.
+            population_percentiles (Optional[PopulationPercentiles]): The days whose goals passed moderation are
+                added to it.
+            goal_progress_service (Optional[GoalProgressService]): The days whose goals passed moderation are added
+                to the users' history.
         """
         self.assistant_service = assistant_service
         self.risk_predictor = risk_predictor
         self.timing_policy = timing_policy
         self.behavior_service = behavior_service
+        self.recommendation_store = recommendation_store
         self.content_detection_service = default_content_detection_service
+        self.usage_tracker = usage_tracker or default_usage_tracker
+        self.population_percentiles = population_percentiles or default_population_percentiles
+        self.goal_progress_service = goal_progress_service or default_goal_progress_service
+        self.completion_executor = ThreadPoolExecutor(
+            max_workers=completion_workers or settings.ADMISSION_MAX_CONCURRENT_LLM_REQUESTS,
+            thread_name_prefix="orchestration-completion",
+        )
+        self.moderation_executor = ThreadPoolExecutor(
+            max_workers=moderation_workers or settings.ORCHESTRATION_MODERATION_WORKERS,
+            thread_name_prefix="orchestration-moderation",
+        )
 
     def create_daily_recommendation(
         self,
         user_profile: UserProfile,
         daily_metric: DailyMetric,
         goals: List[Goal],
+        send_time: Optional[int] = None,
+        deadline: Optional[Deadline] = None,
+        background: bool = False,
     ) -> Recommendation:
         """
         Create a recommendation for the user based on their profile and daily metrics.
@@ -46,15 +90,266 @@ class OrchestrationService:
             user_profile (UserProfile): The user's profile.
             daily_metric (DailyMetric): The user's daily metrics.
             goals (list): The user's goals.
+            send_time (Optional[int]): Hour the recommendation will be sent, selected by the timing policy if None.
+            deadline (Optional[Deadline]): When the recommendation is due, if moderation or the assistant can't
+                answer within their budgets a template recommendation marked as fallback is returned instead.
+                Waits for the assistant however long it takes if None. A generated message that is flagged, or
+                can't be moderated in time, is also replaced by the template.
+            background (bool): For bulk and job work, every stage runs on the calling thread so it doesn't take
+                threads from interactive requests. Can't be combined with a deadline.
 
         Returns:
             Recommendation: The recommendation for the user.
         """
+        if background and deadline is not None:
+            raise ValueError("Background recommendations can't have a deadline")
+
+        logger.info("Creating recommendation - user_id=%s", user_profile.user_id)
+        logger.debug("Recommendation metrics - user_id=%s, metrics=%s", user_profile.user_id, daily_metric)
+
+        # risk scoring and the completion (which only depends on risk) don't need the moderation result, so they are
+        # started right away while moderation runs
+        completion_future = None
+        abandoned = threading.Event()
+        if settings.SPECULATIVE_COMPLETION and not background:
+            completion_future = self._submit_completion(
+                self._score_and_recommend, user_profile, daily_metric, goals, abandoned
+            )
+
+        moderated = False
+        is_fallback = False
+        try:
+            if deadline is None:
+                self._moderate_goals(user_profile, goals)
+            else:
+                # moderation runs on its pool so waiting for it can be bounded
+                self._submit_moderation(self._moderate_goals, user_profile, goals).result(
+                    timeout=deadline.budget(settings.DEADLINE_MODERATION_BUDGET_SECONDS)
+                )
+            moderated = True
+            self._observe(user_profile, daily_metric)
+
+            if completion_future is None and deadline is None:
+                risk, recommendation = self._score_and_recommend(user_profile, daily_metric, goals)
+            else:
+                if completion_future is None:
+                    completion_future = self._submit_completion(
+                        self._score_and_recommend, user_profile, daily_metric, goals
+                    )
+                risk, recommendation = completion_future.result(timeout=self._completion_budget(deadline))
+        except (FuturesTimeoutError, UpstreamOverloadedError) as exc:
+            if deadline is None:
+                raise
+            logger.warning(
+                f"Recommendation deadline missed, using fallback - user_id={user_profile.user_id}, "
+                f"moderated={moderated}, error={exc!r}"
+            )
+            risk = self._score_risk(user_profile)
+            # moderation fails closed, goals it didn't pass are left out and the message only covers the metrics
+            recommendation = self.assistant_service.create_fallback_recommendation(
+                user_profile=user_profile,
+                metrics=daily_metric,
+                goals=goals if moderated else [],
+                risk=risk,
+            )
+            is_fallback = True
+            FALLBACKS.inc(route=current_route.get(), kind="recommendation")
+        finally:
+            # a completion that hasn't reached the assistant yet stops there, one that's already running can't be
+            # interrupted and its result is simply discarded
+            abandoned.set()
+            self._cancel_futures(completion_future)
+
+        if not is_fallback and not self._output_passes_moderation(user_profile, recommendation, deadline):
+            # the goals passed moderation, only the generated text is replaced
+            recommendation = self.assistant_service.create_fallback_recommendation(
+                user_profile=user_profile,
+                metrics=daily_metric,
+                goals=goals,
+                risk=risk,
+            )
+            is_fallback = True
+            FALLBACKS.inc(route=current_route.get(), kind="output_moderation")
+
+        # get time to send the recommendation, sampling the policy takes microseconds so it runs inline
+        if send_time is None:
+            send_time = self._select_send_time()
+
+        logger.info(
+            "Recommendation created - user_id=%s, risk=%s, send_time=%s, is_fallback=%s",
+            user_profile.user_id, risk, send_time, is_fallback,
+        )
+        logger.debug("Recommendation message - user_id=%s, message=%s", user_profile.user_id, recommendation)
+
+        return self._save(user_profile, Recommendation(
+            id=str(uuid4()),
+            user_id=user_profile.user_id,
+            message=recommendation,
+            send_time=send_time,
+            is_fallback=is_fallback,
+            created_at=datetime.now()
+        ))
+
+    def create_daily_recommendations(
+        self,
+        requests: List[RecommendationRequest],
+        max_concurrency: Optional[int] = None,
+    ) -> Iterator[Tuple[int, Union[Recommendation, Exception]]]:
+        """
+        Create recommendations for many users with bounded concurrency.
+
+        Each recommendation runs all its stages on one thread of this call's own pool, so bulk work never queues
+        in the pools of interactive requests. Failures are yielded alongside the successful recommendations instead
+        of being raised, so one bad item doesn't fail the others.
+
+        Args:
+            requests (List[RecommendationRequest]): The recommendation inputs, one per user.
+            max_concurrency (Optional[int]): Maximum recommendations generated at once,
+                defaults to `settings.BULK_MAX_CONCURRENCY`.
+
+        Returns:
+            Iterator[Tuple[int, Union[Recommendation, Exception]]]: The index of each request with its recommendation
+                or the exception it raised, in order of completion.
+        """
+        executor = ThreadPoolExecutor(
+            max_workers=max_concurrency or settings.BULK_MAX_CONCURRENCY,
+            thread_name_prefix="orchestration-bulk",
+        )
+        try:
+            futures = {
+                executor.submit(
+                    in_current_context(self.create_daily_recommendation),
+                    request.profile,
+                    request.daily_metrics,
+                    request.goals,
+                    background=True,
+                ): index
+                for index, request in enumerate(requests)
+            }
+
+            for future in as_completed(futures):
+                index = futures[future]
+                try:
+                    yield index, future.result()
+                except Exception as exc:
+                    logger.warning(
+                        f"Bulk recommendation failed - user_id={requests[index].profile.user_id}, error={exc!r}"
+                    )
+                    yield index, exc
+        finally:
+            # also reached when the consumer stops early, e.g. the client disconnected
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def stream_daily_recommendation(
+        self,
+        user_profile: UserProfile,
+        daily_metric: DailyMetric,
+        goals: List[Goal],
+    ) -> Iterator[Union[str, Recommendation]]:
+        """
+        Stream a recommendation for the user based on their profile and daily metrics.
+
+        Moderation happens before this returns, so flagged goals raise instead of producing a stream.
+
+        Args:
+            user_profile (UserProfile): The user's profile.
+            daily_metric (DailyMetric): The user's daily metrics.
+            goals (list): The user's goals.
+
+        Returns:
+            Iterator[Union[str, Recommendation]]: The message text as it is generated, followed by the final
+                recommendation.
+        """
+        logger.info("Streaming recommendation - user_id=%s", user_profile.user_id)
+        logger.debug("Recommendation metrics - user_id=%s, metrics=%s", user_profile.user_id, daily_metric)
+
+        stream_future = None
+        abandoned = threading.Event()
+        if settings.SPECULATIVE_COMPLETION:
+            stream_future = self._submit_completion(
+                self._score_and_stream, user_profile, daily_metric, goals, abandoned
+            )
+
+        try:
+            self._moderate_goals(user_profile, goals)
+        except Exception:
+            abandoned.set()
+            self._cancel_futures(stream_future)
+            if stream_future is not None:
+                # closing the stream aborts the completion if its connection was already opened
+                stream_future.add_done_callback(self._close_stream_future)
+            raise
+
+        self._observe(user_profile, daily_metric)
+        if stream_future is None:
+            risk, stream = self._score_and_stream(user_profile, daily_metric, goals)
+        else:
+            risk, stream = stream_future.result()
+
+        return self._stream_recommendation_events(user_profile, risk, stream)
+
+    def _stream_recommendation_events(
+        self,
+        user_profile: UserProfile,
+        risk: float,
+        stream: CompletionStream,
+    ) -> Iterator[Union[str, Recommendation]]:
+        """
+        Relay the completion stream and finish with the recommendation once it's complete.
+
+        Raises:
+            ContentDetectionFlaggedError: If the generated text is flagged, the stream is cut off at that chunk.
+            UpstreamOverloadedError: If the generated text couldn't be moderated, nothing is saved either.
+        """
+        moderator = None
+        if settings.STREAM_MODERATION:
+            moderator = StreamModerator(self.content_detection_service, self._submit_moderation, user_cohort(user_profile))
+
+        message_parts = []
+        try:
+            for delta in stream:
+                if moderator is not None:
+                    moderator.feed(delta)
+                message_parts.append(delta)
+                yield delta
+
+            if moderator is not None:
+                with track_stage("output_moderation"):
+                    moderator.finish()
+        finally:
+            stream.close()
+
+        recommendation = "".join(message_parts)
+        send_time = self._select_send_time()
+
+        logger.info(
+            "Recommendation streamed - user_id=%s, risk=%s, send_time=%s", user_profile.user_id, risk, send_time
+        )
+        logger.debug("Recommendation message - user_id=%s, message=%s", user_profile.user_id, recommendation)
+
+        yield self._save(user_profile, Recommendation(
+            id=str(uuid4()),
+            user_id=user_profile.user_id,
+            message=recommendation,
+            send_time=send_time,
+            created_at=datetime.now()
+        ))
 
-        logger.info(f"Creating recommendation - user_id={user_profile.user_id}, metrics={daily_metric}")
+    def _observe(self, user_profile: UserProfile, daily_metric: DailyMetric) -> None:
+        """Add the day to the population and the user's goal history, once its goals passed moderation."""
+        self.population_percentiles.observe(user_profile, [daily_metric])
+        self.goal_progress_service.observe([daily_metric])
 
+    def _moderate_goals(self, user_profile: UserProfile, goals: List[Goal]) -> None:
+        """
+        Run content moderation on the user's goals.
+
+        Raises:
+            ContentDetectionFlaggedError: If the goals violate the content policies.
+        """
         goal_text = "\n".join(f"{goal.description}" for goal in goals)
-        moderation_response = self.content_detection_service.detect_content(goal_text)
+        with track_stage("moderation"):
+            moderation_response = self.content_detection_service.detect_content(goal_text, user_cohort(user_profile))
 
         if moderation_response.flagged:
             # TODO: should emit async event for followup w/ caregiver (maybe internal staff too) about content of goals
@@ -70,10 +365,65 @@ class OrchestrationService:
                 ],
             )
 
-        # calculate risk
-        risk = self.risk_predictor.score(user_profile)
+    def _output_passes_moderation(
+        self,
+        user_profile: UserProfile,
+        message: str,
+        deadline: Optional[Deadline] = None,
+    ) -> bool:
+        """
+        Check a generated message before it's saved or returned, against the local patterns and then the moderation
+        API. Fails closed, a message the moderation API couldn't check in time doesn't pass.
+        """
+        if not settings.OUTPUT_MODERATION:
+            return True
+
+        cohort = user_cohort(user_profile)
+        try:
+            with track_stage("output_moderation"):
+                if deadline is None:
+                    moderation = self.content_detection_service.detect_content(message, cohort)
+                else:
+                    moderation = self._submit_moderation(
+                        self.content_detection_service.detect_content, message, cohort
+                    ).result(timeout=deadline.budget(settings.DEADLINE_OUTPUT_MODERATION_BUDGET_SECONDS))
+        except (FuturesTimeoutError, UpstreamOverloadedError) as exc:
+            logger.warning(f"Generated content not moderated, using fallback - user_id={user_profile.user_id}, error={exc!r}")
+            return False
+
+        if moderation.flagged:
+            logger.warning(
+                f"Generated content flagged, using fallback - user_id={user_profile.user_id}, "
+                f"categories={moderation.categories}"
+            )
+            return False
+        return True
+
+    @staticmethod
+    def _completion_budget(deadline: Optional[Deadline]) -> Optional[float]:
+        """Time the completion may take, the output moderation's budget is kept back from it."""
+        if deadline is None:
+            return None
+        if not settings.OUTPUT_MODERATION:
+            return deadline.budget()
+        return max(0.0, deadline.budget() - settings.DEADLINE_OUTPUT_MODERATION_BUDGET_SECONDS)
+
+    def _score_and_recommend(
+        self,
+        user_profile: UserProfile,
+        daily_metric: DailyMetric,
+        goals: List[Goal],
+        abandoned: Optional[threading.Event] = None,
+    ) -> Tuple[float, str]:
+        """
+        Calculate the user's risk and get a recommendation from the assistant that takes it into account.
+
+        Raises:
+            CancelledError: If `abandoned` was set before the assistant was called, e.g. the goals were flagged.
+        """
+        risk = self._score_risk(user_profile)
+        self._check_abandoned(abandoned)
 
-        # get recommendation from assistant
         recommendation = self.assistant_service.create_recommendation(
             user_profile=user_profile,
             metrics=daily_metric,
@@ -81,22 +431,76 @@ class OrchestrationService:
             risk=risk,
         )
 
-        # get time to send the recommendation
-        send_time = self.timing_policy.select_hour()
+        return risk, recommendation
 
-        logger.info(
-            f"Recommendation created - user_id={user_profile.user_id}, recommendation={recommendation}, "
-            f"risk={risk}, send_time={send_time}"
-        )
+    def _score_and_stream(
+        self,
+        user_profile: UserProfile,
+        daily_metric: DailyMetric,
+        goals: List[Goal],
+        abandoned: Optional[threading.Event] = None,
+    ) -> Tuple[float, CompletionStream]:
+        """
+        Calculate the user's risk and open a streamed recommendation from the assistant.
 
-        return Recommendation(
-            id=str(uuid4()),
-            user_id=user_profile.user_id,
-            message=recommendation,
-            send_time=send_time,
-            created_at=datetime.now()
+        Raises:
+            CancelledError: If `abandoned` was set before the assistant was called, e.g. the goals were flagged.
+        """
+        risk = self._score_risk(user_profile)
+        self._check_abandoned(abandoned)
+
+        stream = self.assistant_service.stream_recommendation(
+            user_profile=user_profile,
+            metrics=daily_metric,
+            goals=goals,
+            risk=risk,
         )
 
+        return risk, stream
+
+    def _score_risk(self, user_profile: UserProfile) -> float:
+        with track_stage("risk_scoring"):
+            return self.risk_predictor.score(user_profile)
+
+    def _select_send_time(self) -> int:
+        with track_stage("timing"):
+            return self.timing_policy.select_hour()
+
+    def _submit_completion(self, fn: Callable, *args) -> Future:
+        """Run a completion stage on its pool, in the caller's context so its metrics keep the route label."""
+        return self.completion_executor.submit(in_current_context(fn), *args)
+
+    def _submit_moderation(self, fn: Callable, *args) -> Future:
+        """Run a moderation check on its pool, in the caller's context so its metrics keep the route label."""
+        return self.moderation_executor.submit(in_current_context(fn), *args)
+
+    @staticmethod
+    def _close_stream_future(future: Future) -> None:
+        """Close the stream of a discarded `_score_and_stream` future once it's available."""
+        if not future.cancelled() and future.exception() is None:
+            _, stream = future.result()
+            stream.close()
+
+    def _save(self, user_profile: UserProfile, recommendation: Recommendation) -> Recommendation:
+        """Queue the recommendation for persistence, this doesn't block on the write."""
+        self.usage_tracker.record_recommendation(user_cohort(user_profile))
+        if self.recommendation_store is not None:
+            self.recommendation_store.save_recommendation(recommendation)
+        return recommendation
+
+    @staticmethod
+    def _check_abandoned(abandoned: Optional[threading.Event]) -> None:
+        """Stop a speculative stage before its paid assistant call once its result won't be used."""
+        if abandoned is not None and abandoned.is_set():
+            raise CancelledError()
+
+    @staticmethod
+    def _cancel_futures(*futures: Optional[Future]) -> None:
+        """Cancel pending stage futures, stages that already started run to completion and are ignored."""
+        for future in futures:
+            if future is not None:
+                future.cancel()
+
     def check_for_concerning_behaviors(
         self,
         user_profile: UserProfile,
@@ -112,14 +516,45 @@ class OrchestrationService:
         Returns:
             BehavioralRecommendation: The recommendation for the user.
         """
-        logger.info(f"Checking for concerning behaviors - user_id={user_profile.user_id}, metrics={daily_metrics}")
+        logger.info("Checking for concerning behaviors - user_id=%s, days=%d", user_profile.user_id, len(daily_metrics))
+        logger.debug("Behavior metrics - user_id=%s, metrics=%s", user_profile.user_id, daily_metrics)
 
         # analyze behavior
-        recommendation = self.behavior_service.analyze_aggregate_user_metrics(
-            user_profile=user_profile,
-            daily_metrics=daily_metrics
-        )
+        with track_stage("behavior_analysis"):
+            recommendation = self.behavior_service.analyze_aggregate_user_metrics(
+                user_profile=user_profile,
+                daily_metrics=daily_metrics
+            )
 
-        logger.info(f"Behavioral recommendation - user_id={user_profile.user_id}, recommendation={recommendation}")
+        logger.debug("Behavioral recommendation - user_id=%s, recommendation=%s", user_profile.user_id, recommendation)
+
+        if recommendation is not None and self.recommendation_store is not None:
+            self.recommendation_store.save_behavioral_recommendation(recommendation)
 
         return recommendation
+
+    def check_caretaker_digest(
+        self,
+        caretaker_id: str,
+        children: List[Tuple[UserProfile, List[DailyMetric]]],
+    ) -> List[BehavioralRecommendation]:
+        """
+        Check for concerning behaviors of all of a caretaker's children with a single assistant call.
+
+        Args:
+            caretaker_id (str): The caretaker.
+            children (List[Tuple[UserProfile, List[DailyMetric]]]): Each child's profile and daily metrics.
+
+        Returns:
+            List[BehavioralRecommendation]: The recommendations for the children that need action.
+        """
+        logger.info("Checking caretaker digest - caretaker_id=%s, children=%d", caretaker_id, len(children))
+
+        with track_stage("behavior_analysis"):
+            recommendations = self.behavior_service.analyze_caretaker_digest(caretaker_id, children)
+
+        if self.recommendation_store is not None:
+            for recommendation in recommendations:
+                self.recommendation_store.save_behavioral_recommendation(recommendation)
+
+        return recommendations
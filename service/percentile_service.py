@@ -0,0 +1,217 @@
+"""Percentiles of the daily metrics across the user base, per age band and sex."""
+import math
+import os
+import re
+import socket
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional
+
+from .quantile_sketch import KllSketch
+from .usage_service import age_band
+from ..config import settings
+from ..dto import DailyMetric, UserProfile
+
+# DailyMetric fields with population percentiles, and how they're worded in prompts
+PERCENTILE_METRICS = {
+    "steps": "steps",
+    "active_minutes": "active minutes",
+    "calories_in": "calories in",
+    "sleep_hours": "sleep hours",
+}
+
+KNOWN_SEXES = ("female", "male")
+
+SUMMARY_QUANTILES = (0.05, 0.25, 0.5, 0.75, 0.95)
+
+# cohorts of `population_cohort`, merged sketches of anything else are rejected so the cohorts stay bounded
+COHORT_PATTERN = re.compile(r"age_(under_\d+|\d+_plus|\d+_\d+):(female|male|unknown)")
+
+
+def population_cohort(age: int, sex: Optional[str]) -> str:
+    """Cohort for population percentiles, the age band and sex, e.g. "age_13_15:female"."""
+    sex = (sex or "").strip().lower()
+    return f"{age_band(age)}:{sex if sex in KNOWN_SEXES else 'unknown'}"
+
+
+class PopulationPercentiles:
+    """
+    Streaming quantile sketches of the daily metrics, per cohort and metric.
+
+    Every user's days are added once as they come in, lookups are a binary search over the sketches so they take
+    microseconds, and memory is bounded by the number of cohorts and workers. Sketches of other workers are kept
+    apart from this worker's own, per worker, and replaced by their next export. So only this worker's own values
+    are exported, and merging the same export again, or exchanging exports both ways, doesn't count values twice.
+    """
+
+    def __init__(
+        self,
+        k: Optional[int] = None,
+        min_samples: Optional[int] = None,
+        max_users: Optional[int] = None,
+        worker_id: Optional[str] = None,
+        max_merged_workers: Optional[int] = None,
+    ):
+        """
+        Initialize the percentiles.
+
+        Args:
+            k (Optional[int]): Accuracy of the sketches, defaults to `settings.POPULATION_SKETCH_K`.
+            min_samples (Optional[int]): Values a cohort's sketch needs before its percentiles are used in prompts,
+                defaults to `settings.POPULATION_MIN_SAMPLES`.
+            max_users (Optional[int]): Users whose last added day is remembered, so a day sent again isn't added
+                twice, defaults to `settings.POPULATION_MAX_TRACKED_USERS`.
+            worker_id (Optional[str]): Identifies this worker's exports, defaults to `settings.POPULATION_WORKER_ID`
+                or the host name and process id.
+            max_merged_workers (Optional[int]): Other workers whose sketches are kept, the least recently merged are
+                dropped first, defaults to `settings.POPULATION_MAX_MERGED_WORKERS`.
+        """
+        self.k = k or settings.POPULATION_SKETCH_K
+        self.min_samples = min_samples or settings.POPULATION_MIN_SAMPLES
+        self.max_users = max_users or settings.POPULATION_MAX_TRACKED_USERS
+        self.worker_id = worker_id or settings.POPULATION_WORKER_ID or f"{socket.gethostname()}:{os.getpid()}"
+        self.max_merged_workers = max_merged_workers or settings.POPULATION_MAX_MERGED_WORKERS
+        # this worker's own values, the only ones exported
+        self._sketches: Dict[str, Dict[str, KllSketch]] = {}
+        # the latest export of each other worker, by worker id
+        self._merged: "OrderedDict[str, Dict[str, Dict[str, KllSketch]]]" = OrderedDict()
+        self._last_dates: "OrderedDict[str, datetime]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def observe(self, user_profile: UserProfile, metrics: Iterable[DailyMetric]) -> None:
+        """Add the user's days that are newer than the last one added."""
+        cohort = population_cohort(user_profile.age, user_profile.sex)
+
+        with self._lock:
+            last_date = self._last_dates.get(user_profile.user_id)
+            sketches = None
+            for metric in sorted(metrics, key=lambda metric: metric.date):
+                if last_date is not None and metric.date <= last_date:
+                    continue
+                if sketches is None:
+                    sketches = self._cohort_sketches(cohort)
+                for field in PERCENTILE_METRICS:
+                    value = float(getattr(metric, field))
+                    # other workers reject sketches with non-finite values
+                    if math.isfinite(value):
+                        sketches[field].update(value)
+                last_date = metric.date
+
+            if last_date is not None:
+                self._last_dates[user_profile.user_id] = last_date
+                self._last_dates.move_to_end(user_profile.user_id)
+                if len(self._last_dates) > self.max_users:
+                    self._last_dates.popitem(last=False)
+
+    def percentile(self, cohort: str, metric: str, value: float) -> Optional[float]:
+        """Percentile of the value within the cohort, from 0 to 100, None if the cohort has no values yet."""
+        with self._lock:
+            sketches = self._metric_sketches(cohort, metric)
+            if not sketches:
+                return None
+            return 100 * self._rank(sketches, value)
+
+    def summary(self, cohort: str, metric: str) -> Optional[dict]:
+        """Number of values and summary quantiles of the cohort, None if the cohort has no values yet."""
+        with self._lock:
+            sketches = self._metric_sketches(cohort, metric)
+            if not sketches:
+                return None
+            combined = KllSketch(self.k)
+            for sketch in sketches:
+                combined.merge(sketch)
+
+        return {
+            "count": combined.count,
+            "quantiles": {f"p{round(q * 100)}": combined.quantile(q) for q in SUMMARY_QUANTILES},
+        }
+
+    def peer_percentiles(self, user_profile: UserProfile, metrics: DailyMetric) -> Dict[str, int]:
+        """
+        The user's percentile of each metric within their cohort, by its prompt wording.
+
+        Metrics whose cohort has fewer than `min_samples` values are left out.
+        """
+        cohort = population_cohort(user_profile.age, user_profile.sex)
+        percentiles = {}
+        with self._lock:
+            for field, label in PERCENTILE_METRICS.items():
+                sketches = self._metric_sketches(cohort, field)
+                if sum(sketch.count for sketch in sketches) >= self.min_samples:
+                    percentiles[label] = round(100 * self._rank(sketches, float(getattr(metrics, field))))
+        return percentiles
+
+    def export(self) -> dict:
+        """This worker's own sketches per cohort and metric, to be merged into another worker's with `merge`."""
+        with self._lock:
+            return {
+                "worker_id": self.worker_id,
+                "sketches": {
+                    cohort: {field: sketch.to_dict() for field, sketch in sketches.items()}
+                    for cohort, sketches in self._sketches.items()
+                },
+            }
+
+    def merge(self, exported: dict) -> List[str]:
+        """
+        Merge another worker's export, replacing the sketches merged from that worker before.
+
+        Returns:
+            List[str]: The merged cohorts.
+
+        Raises:
+            ValueError: If the export is malformed or this worker's own, or a metric or `k` isn't supported. Nothing
+                is merged then.
+        """
+        try:
+            worker_id = str(exported["worker_id"])
+            parsed = {
+                cohort: {field: KllSketch.from_dict(sketch) for field, sketch in sketches.items()}
+                for cohort, sketches in exported["sketches"].items()
+            }
+        except (AttributeError, KeyError, TypeError, ValueError) as exc:
+            raise ValueError(f"Malformed sketches: {exc!r}") from exc
+
+        if worker_id == self.worker_id:
+            raise ValueError("Sketches of this worker can't be merged into itself")
+        for cohort, sketches in parsed.items():
+            if not COHORT_PATTERN.fullmatch(cohort):
+                raise ValueError(f"Unknown cohort: {cohort}")
+            for field, sketch in sketches.items():
+                if field not in PERCENTILE_METRICS:
+                    raise ValueError(f"Unknown metric: {field}")
+                if sketch.k != self.k:
+                    raise ValueError(f"Sketch k {sketch.k} doesn't match {self.k}")
+
+        with self._lock:
+            self._merged[worker_id] = parsed
+            self._merged.move_to_end(worker_id)
+            if len(self._merged) > self.max_merged_workers:
+                self._merged.popitem(last=False)
+
+        return list(parsed)
+
+    def _metric_sketches(self, cohort: str, metric: str) -> List[KllSketch]:
+        """The cohort's non-empty sketches of the metric, this worker's and the merged ones, must hold the lock."""
+        sources = [self._sketches, *self._merged.values()]
+        sketches = (source.get(cohort, {}).get(metric) for source in sources)
+        return [sketch for sketch in sketches if sketch is not None and sketch.count > 0]
+
+    @staticmethod
+    def _rank(sketches: List[KllSketch], value: float) -> float:
+        """Rank of the value among the values of all the sketches, their ranks weighted by their number of values."""
+        total = sum(sketch.count for sketch in sketches)
+        return sum(sketch.rank(value) * sketch.count for sketch in sketches) / total
+
+    def _cohort_sketches(self, cohort: str) -> Dict[str, KllSketch]:
+        """The cohort's sketches, created if needed, must hold the lock."""
+        sketches = self._sketches.get(cohort)
+        if sketches is None:
+            sketches = {field: KllSketch(self.k) for field in PERCENTILE_METRICS}
+            self._sketches[cohort] = sketches
+        return sketches
+
+
+# TODO: replace with DI/singleton
+default_population_percentiles = PopulationPercentiles()
@@ -0,0 +1,88 @@
+"""Prompt assembly: compact templates, per-coach static prefixes and token budgets."""
+import functools
+import re
+import textwrap
+from typing import Callable, Dict, List, Sequence, Tuple
+
+from .constants import FEW_SHOT_EXAMPLES
+from ..config import settings
+
+# words, runs of up to 3 digits, single symbols, line breaks with their indentation and other runs of spaces, roughly
+# how the GPT-4o tokenizer splits text, a single space goes with the following word
+_TOKEN_PIECES = re.compile(r"[^\W\d_]+|\d{1,3}|[^\w\s]|_|\s*\n\s*|\s{2,}")
+
+# characters a long word is split into per token
+_CHARS_PER_WORD_TOKEN = 6
+_LONG_WORDS = re.compile(r"[^\W\d_]{%d,}" % (_CHARS_PER_WORD_TOKEN + 1))
+
+
+def compact(text: str) -> str:
+    """Dedent the lines of an indented triple-quoted template, trim them and drop the blank ones."""
+    lines = (line.strip() for line in textwrap.dedent(text).splitlines())
+    return "\n".join(line for line in lines if line)
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Estimate the tokens of a text without a tokenizer.
+
+    Counts words, three-digit number runs, symbols and whitespace runs, with a token per 6 characters of long words.
+    Close enough to budget prompts, not to bill them.
+    """
+    # the pieces are counted by the regex engine, only the rare long words are looked at one by one
+    extra = sum((len(word) - 1) // _CHARS_PER_WORD_TOKEN for word in _LONG_WORDS.findall(text))
+    return len(_TOKEN_PIECES.findall(text)) + extra
+
+
+def fit_to_budget(
+    render: Callable[[Dict[str, List[str]], Dict[str, int]], str],
+    items: Dict[str, List[str]],
+    trim_order: Sequence[str],
+    max_tokens: int,
+) -> str:
+    """
+    Render a prompt, dropping list items from the end until its estimated tokens are within the budget.
+
+    Args:
+        render (Callable[[Dict[str, List[str]], Dict[str, int]], str]): Renders the prompt from the items kept and
+            the number dropped per list.
+        items (Dict[str, List[str]]): The prompt's lists, e.g. goal lines.
+        trim_order (Sequence[str]): Lists in the order they're trimmed, each is emptied before the next is touched.
+        max_tokens (int): The budget.
+
+    Returns:
+        str: The prompt, over the budget only if the lists in `trim_order` are all emptied.
+    """
+    dropped = {name: 0 for name in items}
+    text = render(items, dropped)
+    excess = estimate_tokens(text) - max_tokens
+    if excess <= 0:
+        return text
+
+    items = {name: list(values) for name, values in items.items()}
+    for name in trim_order:
+        while excess > 0 and items[name]:
+            # and the separator from the previous item
+            excess -= estimate_tokens(items[name].pop()) + 1
+            dropped[name] += 1
+
+    return render(items, dropped)
+
+
+@functools.lru_cache(maxsize=256)
+def static_prefix(system_template: str, assistant_name: str, few_shot: bool) -> Tuple[dict, ...]:
+    """
+    The messages that are the same for every request of a coach, built once per coach.
+
+    They come first so providers that cache prompt prefixes can reuse them, the request's own content goes after.
+    The messages are shared between requests and must not be modified.
+    """
+    messages = [{"role": "system", "content": system_template.format(assistant_name=assistant_name)}]
+    if few_shot:
+        messages.extend({"role": message["role"], "content": compact(message["content"])} for message in FEW_SHOT_EXAMPLES)
+    return tuple(messages)
+
+
+def prefix_messages(system_template: str, assistant_name: str) -> List[dict]:
+    """The coach's static prefix, with the few-shot examples if `settings.PROMPT_FEW_SHOT_EXAMPLES` is on."""
+    return list(static_prefix(system_template, assistant_name, settings.PROMPT_FEW_SHOT_EXAMPLES))
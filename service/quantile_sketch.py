@@ -0,0 +1,158 @@
+"""Mergeable streaming quantile sketch with bounded memory."""
+import bisect
+import math
+import random
+from typing import List, Optional, Tuple
+
+# capacity of a level relative to the one above it
+CAPACITY_DECAY = 2 / 3
+
+# levels a sketch can have, a value at the top one stands for 2**63 of the original ones
+MAX_LEVELS = 64
+
+
+class KllSketch:
+    """
+    KLL quantile sketch.
+
+    Values are kept in levels of compactors, a value at level `h` stands for `2**h` of the original ones. When the
+    sketch is full, a level is sorted and every other value, from a random offset, is promoted to the next level.
+    Memory stays around `3 * k` values whatever the number of updates, with a rank error of about `1.7 / k`. Sketches
+    built with the same `k` can be merged, e.g. the ones of different workers.
+    """
+
+    def __init__(self, k: int = 200):
+        """
+        Initialize an empty sketch.
+
+        Args:
+            k (int): Capacity of the top level, higher is more accurate and uses more memory.
+        """
+        self.k = k
+        self.count = 0
+        self._levels: List[List[float]] = [[]]
+        self._size = 0
+        # sorted values with their cumulative weights, built on the first lookup after an update
+        self._cdf: Optional[Tuple[List[float], List[int]]] = None
+
+    def update(self, value: float) -> None:
+        """Add a value."""
+        self._levels[0].append(value)
+        self._size += 1
+        self.count += 1
+        self._cdf = None
+        if self._size >= self._max_size():
+            self._compress()
+
+    def merge(self, other: "KllSketch") -> None:
+        """Add the values of another sketch to this one."""
+        if other.k != self.k:
+            raise ValueError(f"Sketches with different k can't be merged: {self.k} and {other.k}")
+
+        while len(self._levels) < len(other._levels):
+            self._levels.append([])
+        for level, values in enumerate(other._levels):
+            self._levels[level].extend(values)
+        self._size += other._size
+        self.count += other.count
+        self._cdf = None
+        while self._size >= self._max_size():
+            self._compress()
+
+    def rank(self, value: float) -> float:
+        """Share of the values that are less than `value`, counting the equal ones half, from 0 to 1."""
+        if self.count == 0:
+            raise ValueError("The sketch is empty")
+
+        values, weights = self._cumulative()
+        below = bisect.bisect_left(values, value)
+        up_to = bisect.bisect_right(values, value)
+        below_weight = weights[below - 1] if below else 0
+        up_to_weight = weights[up_to - 1] if up_to else 0
+        return (below_weight + up_to_weight) / (2 * weights[-1])
+
+    def quantile(self, q: float) -> float:
+        """The value at the `q` quantile, from 0 to 1."""
+        if self.count == 0:
+            raise ValueError("The sketch is empty")
+
+        values, weights = self._cumulative()
+        index = bisect.bisect_left(weights, q * weights[-1])
+        return values[min(index, len(values) - 1)]
+
+    def to_dict(self) -> dict:
+        """Serialize the sketch, e.g. to merge it into another worker's."""
+        return {"k": self.k, "count": self.count, "levels": [list(values) for values in self._levels]}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "KllSketch":
+        """
+        Deserialize a sketch of `to_dict`.
+
+        The data can come from elsewhere, so it must be a sketch `to_dict` could have produced: within the memory
+        bound of its `k`, with finite values and a count matching the weights of its levels.
+
+        Raises:
+            ValueError: If the data isn't a valid sketch.
+        """
+        k = int(data["k"])
+        if k < 2:
+            raise ValueError(f"Sketch k must be at least 2: {k}")
+        if len(data["levels"]) > MAX_LEVELS:
+            raise ValueError(f"Sketch has {len(data['levels'])} levels, at most {MAX_LEVELS} are supported")
+
+        sketch = cls(k=k)
+        sketch._levels = [[float(value) for value in values] for values in data["levels"]] or [[]]
+        sketch._size = sum(len(values) for values in sketch._levels)
+        sketch.count = int(data["count"])
+
+        if sketch._size > sketch._max_size():
+            raise ValueError(f"Sketch has {sketch._size} values, at most {sketch._max_size()} fit its k")
+        if not all(math.isfinite(value) for values in sketch._levels for value in values):
+            raise ValueError("Sketch values must be finite")
+        weight = sum(len(values) << level for level, values in enumerate(sketch._levels))
+        if sketch.count != weight:
+            raise ValueError(f"Sketch count {sketch.count} doesn't match the weight of its values {weight}")
+
+        # `to_dict` sketches are compressed already, a full one is compressed like after an update
+        while sketch._size >= sketch._max_size():
+            sketch._compress()
+        return sketch
+
+    def _capacity(self, level: int) -> int:
+        depth = len(self._levels) - level - 1
+        return max(2, math.ceil(self.k * CAPACITY_DECAY ** depth))
+
+    def _max_size(self) -> int:
+        return sum(self._capacity(level) for level in range(len(self._levels)))
+
+    def _compress(self) -> None:
+        """Compact the lowest level that is over capacity."""
+        for level in range(len(self._levels)):
+            if len(self._levels[level]) < self._capacity(level):
+                continue
+
+            if level + 1 == len(self._levels):
+                self._levels.append([])
+
+            values = sorted(self._levels[level])
+            # an odd value out stays at this level
+            kept = [values.pop()] if len(values) % 2 else []
+            promoted = values[random.getrandbits(1)::2]
+
+            self._levels[level] = kept
+            self._levels[level + 1].extend(promoted)
+            self._size -= len(values) - len(promoted)
+            return
+
+    def _cumulative(self) -> Tuple[List[float], List[int]]:
+        if self._cdf is None:
+            weighted = sorted(
+                (value, 1 << level) for level, values in enumerate(self._levels) for value in values
+            )
+            cumulative, total = [], 0
+            for _, weight in weighted:
+                total += weight
+                cumulative.append(total)
+            self._cdf = ([value for value, _ in weighted], cumulative)
+        return self._cdf
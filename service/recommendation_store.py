@@ -0,0 +1,322 @@
+"""Embedded store for generated recommendations."""
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional, Union
+
+from .metrics import STORE_WRITES_DROPPED, track_stage
+from ..config import settings
+from ..dto import BehavioralRecommendation, Recommendation
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS recommendations (
+    id TEXT PRIMARY KEY,
+    user_id TEXT,
+    created_at TEXT NOT NULL,
+    payload TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_recommendations_user_created ON recommendations (user_id, created_at);
+
+CREATE TABLE IF NOT EXISTS behavioral_recommendations (
+    id TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    caretaker_id TEXT,
+    created_at TEXT NOT NULL,
+    payload TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_behavioral_recommendations_user_created
+    ON behavioral_recommendations (user_id, created_at);
+"""
+
+StoredRecommendation = Union[Recommendation, BehavioralRecommendation]
+
+
+class RecommendationStore:
+    """
+    SQLite (WAL mode) store for `Recommendation`s and `BehavioralRecommendation`s.
+
+    Writes are queued and committed in batches by a background thread, so saving never blocks a request on disk I/O.
+    Recommendations that are still queued are served from memory, so a read right after a save sees it. A batch that
+    fails to commit is retried and stays readable from memory meanwhile, until it has been queued again
+    `max_requeues` times and is dropped.
+
+    The database is opened on `start`, or on first use, rather than when the store is created.
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        batch_size: Optional[int] = None,
+        flush_interval_seconds: Optional[float] = None,
+        write_attempts: Optional[int] = None,
+        retry_backoff_seconds: Optional[float] = None,
+        max_requeues: Optional[int] = None,
+    ):
+        """
+        Initialize the store, the database is opened and the writer thread started by `start`.
+
+        Args:
+            path (Optional[str]): Path of the SQLite database, defaults to `settings.RECOMMENDATION_DB_PATH`.
+            batch_size (Optional[int]): Maximum writes per transaction, defaults to `settings.RECOMMENDATION_DB_BATCH_SIZE`.
+            flush_interval_seconds (Optional[float]): Maximum time a write waits for its batch to fill up,
+                defaults to `settings.RECOMMENDATION_DB_FLUSH_INTERVAL_SECONDS`.
+            write_attempts (Optional[int]): Attempts to commit a batch before it's queued again behind newer writes,
+                defaults to `settings.RECOMMENDATION_DB_WRITE_ATTEMPTS`.
+            retry_backoff_seconds (Optional[float]): Delay before the first retry of a batch, doubled on every retry,
+                defaults to `settings.RECOMMENDATION_DB_RETRY_BACKOFF_SECONDS`.
+            max_requeues (Optional[int]): Times a write that failed all its attempts is queued again before it's
+                dropped, defaults to `settings.RECOMMENDATION_DB_MAX_REQUEUES`.
+        """
+        self.path = path or settings.RECOMMENDATION_DB_PATH
+        self.batch_size = batch_size or settings.RECOMMENDATION_DB_BATCH_SIZE
+        self.flush_interval_seconds = flush_interval_seconds or settings.RECOMMENDATION_DB_FLUSH_INTERVAL_SECONDS
+        self.write_attempts = write_attempts or settings.RECOMMENDATION_DB_WRITE_ATTEMPTS
+        self.retry_backoff_seconds = retry_backoff_seconds or settings.RECOMMENDATION_DB_RETRY_BACKOFF_SECONDS
+        self.max_requeues = max_requeues if max_requeues is not None else settings.RECOMMENDATION_DB_MAX_REQUEUES
+
+        self._local = threading.local()
+        # every thread's connection, so they can be closed with the store
+        self._connections: List[sqlite3.Connection] = []
+        self._pending: Dict[str, StoredRecommendation] = {}
+        self._pending_lock = threading.Lock()
+        self._queue: queue.Queue = queue.Queue()
+        # times each write was queued again after failing, only used by the writer thread
+        self._requeues: Dict[str, int] = {}
+        self._writer: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def start(self) -> None:
+        """Open the database and start the writer thread if they aren't yet."""
+        if self._writer is not None:
+            return
+        with self._lock:
+            if self._writer is not None:
+                return
+
+            connection = self._connect()
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript(SCHEMA)
+
+            self._writer = threading.Thread(target=self._write_loop, name="recommendation-store-writer", daemon=True)
+            self._writer.start()
+
+    def save_recommendation(self, recommendation: Recommendation) -> None:
+        """Queue a recommendation to be stored."""
+        self._enqueue(recommendation)
+
+    def save_behavioral_recommendation(self, recommendation: BehavioralRecommendation) -> None:
+        """Queue a behavioral recommendation to be stored."""
+        self._enqueue(recommendation)
+
+    def get_recommendation(self, recommendation_id: str) -> Optional[Recommendation]:
+        """Get a recommendation by ID."""
+        return self._get(Recommendation, "recommendations", recommendation_id)
+
+    def get_behavioral_recommendation(self, recommendation_id: str) -> Optional[BehavioralRecommendation]:
+        """Get a behavioral recommendation by ID."""
+        return self._get(BehavioralRecommendation, "behavioral_recommendations", recommendation_id)
+
+    def list_recommendations(self, user_id: str, limit: int = 20) -> List[Recommendation]:
+        """Get a user's most recent recommendations, newest first."""
+        return self._list(Recommendation, "recommendations", user_id, limit)
+
+    def list_behavioral_recommendations(self, user_id: str, limit: int = 20) -> List[BehavioralRecommendation]:
+        """Get a user's most recent behavioral recommendations, newest first."""
+        return self._list(BehavioralRecommendation, "behavioral_recommendations", user_id, limit)
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """
+        Wait until all writes queued so far are committed, or dropped after failing too often.
+
+        Returns:
+            bool: Whether the writes were done before the timeout.
+        """
+        self.start()
+        done = threading.Event()
+        self._queue.put(done)
+        return done.wait(timeout)
+
+    def close(self) -> None:
+        """Commit the queued writes, stop the writer thread and close the connections, `start` opens them again."""
+        with self._lock:
+            writer, self._writer = self._writer, None
+            if writer is None:
+                return
+
+            self._queue.put(None)
+            writer.join()
+
+            for connection in self._connections:
+                connection.close()
+            self._connections = []
+            # other threads' connections are closed, they connect again if the store is started again
+            self._local = threading.local()
+
+    def _enqueue(self, recommendation: StoredRecommendation) -> None:
+        self.start()
+        with self._pending_lock:
+            self._pending[recommendation.id] = recommendation
+        self._queue.put(recommendation)
+
+    def _get(self, model: type, table: str, recommendation_id: str) -> Optional[StoredRecommendation]:
+        with self._pending_lock:
+            pending = self._pending.get(recommendation_id)
+        if isinstance(pending, model):
+            return pending
+
+        self.start()
+        row = self._connect().execute(f"SELECT payload FROM {table} WHERE id = ?", (recommendation_id,)).fetchone()
+
+        return model.model_validate_json(row[0]) if row else None
+
+    def _list(self, model: type, table: str, user_id: str, limit: int) -> List[StoredRecommendation]:
+        self.start()
+        rows = self._connect().execute(
+            f"SELECT payload FROM {table} WHERE user_id = ? ORDER BY created_at DESC LIMIT ?",
+            (user_id, limit),
+        ).fetchall()
+        stored = [model.model_validate_json(row[0]) for row in rows]
+
+        with self._pending_lock:
+            pending = [r for r in self._pending.values() if isinstance(r, model) and r.user_id == user_id]
+
+        if not pending:
+            return stored
+
+        by_id = {r.id: r for r in stored}
+        by_id.update({r.id: r for r in pending})
+        return sorted(by_id.values(), key=self._created_at, reverse=True)[:limit]
+
+    def _connect(self) -> sqlite3.Connection:
+        """
+        Get the calling thread's connection, sqlite connections can't be shared between threads.
+
+        Each connection is only used by its thread, `close` is the exception once the store is stopped.
+        """
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, check_same_thread=False)
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+            with self._pending_lock:
+                self._connections.append(connection)
+        return connection
+
+    def _write_loop(self) -> None:
+        """Commit queued writes in batches until `close` is called."""
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            batch, waiters = [], []
+
+            # drain whatever else arrives within the flush interval, up to the batch size
+            while True:
+                if item is None:
+                    stopping = True
+                elif isinstance(item, threading.Event):
+                    waiters.append(item)
+                else:
+                    batch.append(item)
+
+                if stopping or len(batch) >= self.batch_size:
+                    break
+                try:
+                    item = self._queue.get(timeout=self.flush_interval_seconds)
+                except queue.Empty:
+                    break
+
+            if batch and not self._write_batch(batch):
+                # nothing is queued again once the store is closing
+                requeued = [] if stopping else [r for r in batch if self._requeues.get(r.id, 0) < self.max_requeues]
+                self._drop([r for r in batch if r not in requeued])
+                if requeued:
+                    # queued again behind newer writes, and so are the flushes waiting for them
+                    for r in requeued:
+                        self._requeues[r.id] = self._requeues.get(r.id, 0) + 1
+                    for item in requeued + waiters:
+                        self._queue.put(item)
+                    continue
+
+            for waiter in waiters:
+                waiter.set()
+
+        # writes queued again behind the stop signal get a last try
+        remaining = []
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if isinstance(item, threading.Event):
+                item.set()
+            elif item is not None:
+                remaining.append(item)
+        if remaining and not self._write_batch(remaining):
+            self._drop(remaining)
+
+    def _write_batch(self, batch: List[StoredRecommendation]) -> bool:
+        """
+        Commit a batch, retrying with backoff.
+
+        Returns:
+            bool: Whether the batch was committed, it stays readable from memory if not.
+        """
+        recommendations = [
+            (r.id, r.user_id, r.created_at.isoformat(), r.model_dump_json())
+            for r in batch if isinstance(r, Recommendation)
+        ]
+        behavioral_recommendations = [
+            (r.id, r.user_id, r.caretaker_id, r.generated_at.isoformat(), r.model_dump_json())
+            for r in batch if isinstance(r, BehavioralRecommendation)
+        ]
+
+        connection = self._connect()
+        for attempt in range(1, self.write_attempts + 1):
+            try:
+                with track_stage("store_write"), connection:
+                    connection.executemany(
+                        "INSERT OR REPLACE INTO recommendations (id, user_id, created_at, payload) VALUES (?, ?, ?, ?)",
+                        recommendations,
+                    )
+                    connection.executemany(
+                        "INSERT OR REPLACE INTO behavioral_recommendations "
+                        "(id, user_id, caretaker_id, created_at, payload) VALUES (?, ?, ?, ?, ?)",
+                        behavioral_recommendations,
+                    )
+                break
+            except sqlite3.Error:
+                # keep the writer alive, the recommendations were already returned to the client
+                logger.exception(f"Failed to store recommendations - count={len(batch)}, attempt={attempt}")
+                if attempt == self.write_attempts:
+                    return False
+                time.sleep(self.retry_backoff_seconds * 2 ** (attempt - 1))
+
+        self._forget(batch)
+
+        return True
+
+    def _drop(self, batch: List[StoredRecommendation]) -> None:
+        """Give up on writes that kept failing, so they don't pile up in memory."""
+        if not batch:
+            return
+        logger.error(f"Dropped recommendations the store failed to commit - ids={[r.id for r in batch]}")
+        STORE_WRITES_DROPPED.inc(len(batch))
+        self._forget(batch)
+
+    def _forget(self, batch: List[StoredRecommendation]) -> None:
+        for r in batch:
+            self._requeues.pop(r.id, None)
+        with self._pending_lock:
+            for r in batch:
+                if self._pending.get(r.id) is r:
+                    del self._pending[r.id]
+
+    @staticmethod
+    def _created_at(recommendation: StoredRecommendation):
+        if isinstance(recommendation, Recommendation):
+            return recommendation.created_at
+        return recommendation.generated_at
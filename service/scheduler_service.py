@@ -0,0 +1,234 @@
+"""Just-in-time generation of recommendations ahead of their send window."""
+import heapq
+import itertools
+import logging
+import threading
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+from .exceptions import JobQueueFullError
+from .job_service import RecommendationJobService
+from ..config import settings
+from ..dto import RecommendationRequest, ScheduledRecommendation
+from ..model import TimingPolicy
+
+logger = logging.getLogger(__name__)
+
+
+class _Entry:
+    """Scheduler bookkeeping for a single user."""
+
+    def __init__(self, request: RecommendationRequest, callback_url: Optional[str], scheduled: ScheduledRecommendation,
+                 seq: int):
+        self.request = request
+        self.callback_url = callback_url
+        self.scheduled = scheduled
+        self.seq = seq
+
+
+class PreGenerationScheduler:
+    """
+    Generates each user's recommendation shortly before the send window selected by the timing policy.
+
+    Instead of generating every recommendation when the morning batch arrives, recommendations are handed to the job
+    workers in rate limited waves as their windows approach. This spreads the LLM load across the day, and
+    rescheduling a user before generation swaps in their latest metrics while keeping the selected window. Generated
+    entries are kept while their job can be polled.
+    """
+
+    def __init__(
+        self,
+        job_service: RecommendationJobService,
+        timing_policy: TimingPolicy,
+        lead_minutes: Optional[int] = None,
+        wave_size: Optional[int] = None,
+        wave_interval_seconds: Optional[float] = None,
+        now: Callable[[], datetime] = datetime.now,
+    ):
+        """
+        Initialize the scheduler, its thread is started on the first scheduled recommendation.
+
+        Args:
+            job_service (RecommendationJobService): Generates the recommendations.
+            timing_policy (TimingPolicy): Selects each user's send window.
+            lead_minutes (Optional[int]): How long before the window the recommendation is generated,
+                defaults to `settings.SCHEDULER_LEAD_MINUTES`.
+            wave_size (Optional[int]): Max recommendations per wave, defaults to `settings.SCHEDULER_WAVE_SIZE`.
+            wave_interval_seconds (Optional[float]): Min time between waves,
+                defaults to `settings.SCHEDULER_WAVE_INTERVAL_SECONDS`.
+            now (Callable[[], datetime]): Clock, the send windows are hours of its local day.
+        """
+        self.job_service = job_service
+        self.timing_policy = timing_policy
+        self.lead = timedelta(minutes=lead_minutes if lead_minutes is not None else settings.SCHEDULER_LEAD_MINUTES)
+        self.wave_size = wave_size or settings.SCHEDULER_WAVE_SIZE
+        self.wave_interval_seconds = (
+            wave_interval_seconds if wave_interval_seconds is not None else settings.SCHEDULER_WAVE_INTERVAL_SECONDS
+        )
+        self._now = now
+
+        self._entries: Dict[str, _Entry] = {}
+        self._heap: List[Tuple[datetime, int, str]] = []
+        # generated entries as (user_id, seq, job_id), in the order their jobs were submitted
+        self._generated: Deque[Tuple[str, int, str]] = deque()
+        self._pending = 0
+        self._seq = itertools.count()
+        self._condition = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._stopping = False
+
+    def schedule(self, request: RecommendationRequest, callback_url: Optional[str] = None) -> ScheduledRecommendation:
+        """
+        Schedule a user's recommendation, or update the inputs of one that hasn't been generated yet.
+
+        Args:
+            request (RecommendationRequest): The latest recommendation inputs for the user.
+            callback_url (Optional[str]): Receives the finished job as a POST.
+
+        Returns:
+            ScheduledRecommendation: When the recommendation will be generated and sent.
+        """
+        user_id = request.profile.user_id
+
+        with self._condition:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry.scheduled.job_id is None:
+                entry.request = request
+                entry.callback_url = callback_url or entry.callback_url
+                logger.info(f"Scheduled recommendation updated - user_id={user_id}")
+                return entry.scheduled.model_copy()
+
+            send_time = self.timing_policy.select_hour()
+            scheduled = ScheduledRecommendation(
+                user_id=user_id,
+                send_time=send_time,
+                generate_at=self._generation_time(send_time),
+            )
+            seq = next(self._seq)
+            self._entries[user_id] = _Entry(request, callback_url, scheduled, seq)
+            self._pending += 1
+            heapq.heappush(self._heap, (scheduled.generate_at, seq, user_id))
+            self._condition.notify()
+
+        self.start()
+        logger.info(f"Recommendation scheduled - user_id={user_id}, send_time={send_time}, generate_at={scheduled.generate_at}")
+
+        return scheduled.model_copy()
+
+    def get(self, user_id: str) -> Optional[ScheduledRecommendation]:
+        """Get the user's latest scheduled recommendation."""
+        with self._condition:
+            entry = self._entries.get(user_id)
+            return entry.scheduled.model_copy() if entry else None
+
+    def pending_count(self) -> int:
+        """Number of scheduled recommendations that haven't been generated yet."""
+        with self._condition:
+            return self._pending
+
+    def start(self) -> None:
+        """Start the scheduler thread if it isn't running yet."""
+        with self._condition:
+            if self._thread is not None:
+                return
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name="pre-generation-scheduler", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        """Stop the scheduler thread, pending recommendations are not generated."""
+        with self._condition:
+            thread, self._thread = self._thread, None
+            self._stopping = True
+            self._condition.notify_all()
+
+        if thread is not None:
+            thread.join()
+
+    def _generation_time(self, send_time: int) -> datetime:
+        """Generation time ahead of the next occurrence of the send window."""
+        now = self._now()
+        window = now.replace(hour=send_time, minute=0, second=0, microsecond=0)
+        if window <= now:
+            window += timedelta(days=1)
+        return window - self.lead
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                while not self._stopping:
+                    wait = self._seconds_until_due()
+                    if wait is not None and wait <= 0:
+                        break
+                    self._condition.wait(timeout=wait)
+
+                if self._stopping:
+                    return
+
+                self._prune_generated()
+                wave = self._pop_due()
+
+            self._submit_wave(wave)
+
+            # rate limit the waves
+            with self._condition:
+                self._condition.wait_for(lambda: self._stopping, timeout=self.wave_interval_seconds)
+
+    def _seconds_until_due(self) -> Optional[float]:
+        """Seconds until the earliest scheduled generation, or None if nothing is scheduled. Must hold the lock."""
+        while self._heap:
+            generate_at, seq, user_id = self._heap[0]
+            entry = self._entries.get(user_id)
+            if entry is not None and entry.seq == seq and entry.scheduled.job_id is None:
+                return (generate_at - self._now()).total_seconds()
+            heapq.heappop(self._heap)
+        return None
+
+    def _prune_generated(self) -> None:
+        """
+        Drop the generated entries whose job can't be polled anymore, must hold the lock.
+
+        Jobs expire roughly in the order they were submitted, so pruning stops at the first one that's still known.
+        """
+        while self._generated:
+            user_id, seq, job_id = self._generated[0]
+            if self.job_service.get(job_id) is not None:
+                return
+            self._generated.popleft()
+            entry = self._entries.get(user_id)
+            # unless the user was scheduled again since
+            if entry is not None and entry.seq == seq:
+                del self._entries[user_id]
+
+    def _pop_due(self) -> List[_Entry]:
+        """Pop up to a wave of due entries, must hold the lock."""
+        now = self._now()
+        wave = []
+        while self._heap and len(wave) < self.wave_size and self._heap[0][0] <= now:
+            _, seq, user_id = heapq.heappop(self._heap)
+            entry = self._entries.get(user_id)
+            if entry is not None and entry.seq == seq and entry.scheduled.job_id is None:
+                wave.append(entry)
+        return wave
+
+    def _submit_wave(self, wave: List[_Entry]) -> None:
+        for i, entry in enumerate(wave):
+            with self._condition:
+                # copy the inputs under the lock, they can be swapped by a concurrent reschedule
+                request, callback_url = entry.request, entry.callback_url
+            try:
+                job = self.job_service.submit(request, callback_url=callback_url, send_time=entry.scheduled.send_time)
+            except JobQueueFullError:
+                logger.warning(f"Job queue full, deferring {len(wave) - i} scheduled recommendations to the next wave")
+                with self._condition:
+                    for deferred in wave[i:]:
+                        heapq.heappush(self._heap, (deferred.scheduled.generate_at, deferred.seq, deferred.scheduled.user_id))
+                return
+
+            with self._condition:
+                entry.scheduled.job_id = job.id
+                self._pending -= 1
+                self._generated.append((entry.scheduled.user_id, entry.seq, job.id))
+
+        logger.info(f"Scheduled recommendation wave submitted - size={len(wave)}")
@@ -0,0 +1,124 @@
+"""In-memory results that are computed once per key, shared by concurrent callers and kept for a while."""
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Generic, Optional, Tuple, TypeVar
+
+from .exceptions import IdempotencyKeyReusedError
+from .metrics import CACHE_REQUESTS
+
+T = TypeVar("T")
+
+
+class _Entry:
+    """A result that is in-flight or stored for a key."""
+
+    def __init__(self, fingerprint: Optional[str]):
+        self.fingerprint = fingerprint
+        self.done = threading.Event()
+        self.succeeded = False
+        self.result = None
+        self.expires_at: Optional[float] = None
+
+
+class SingleFlightStore(Generic[T]):
+    """
+    In-memory store of results with a TTL, where the first caller of a key computes the result.
+
+    Concurrent callers of the key wait for that result and later ones get the stored result until it expires. Failed
+    computations aren't stored, so the next caller computes again.
+    """
+
+    def __init__(self, name: str, ttl_seconds: float, max_entries: int):
+        """
+        Initialize the store.
+
+        Args:
+            name (str): Cache label of the hit and miss metrics.
+            ttl_seconds (float): How long a result is stored.
+            max_entries (int): Maximum stored results, the oldest are evicted first.
+        """
+        self.name = name
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        # completed entries, in order of expiry since they all have the same TTL
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._in_flight: Dict[str, _Entry] = {}
+        self._lock = threading.Lock()
+
+    def get_or_compute(
+        self,
+        key: str,
+        compute: Callable[[], T],
+        fingerprint: Optional[str] = None,
+        keep: Optional[Callable[[T], bool]] = None,
+    ) -> Tuple[T, bool]:
+        """
+        Run `compute` once per key and return its result to every caller with that key.
+
+        Args:
+            key (str): The key.
+            compute (Callable[[], T]): Produces the result.
+            fingerprint (Optional[str]): Fingerprint of the input, callers with the same key must pass the same one.
+            keep (Optional[Callable[[T], bool]]): Whether a result is stored for later callers, all are by default.
+                Callers already waiting get it either way.
+
+        Returns:
+            Tuple[T, bool]: The result and whether it was computed by an earlier caller.
+
+        Raises:
+            IdempotencyKeyReusedError: If the key was used with a different fingerprint.
+        """
+        while True:
+            with self._lock:
+                self._evict(time.monotonic())
+                entry = self._entries.get(key) or self._in_flight.get(key)
+
+                if entry is None:
+                    entry = _Entry(fingerprint)
+                    self._in_flight[key] = entry
+                    break
+
+            if entry.fingerprint != fingerprint:
+                raise IdempotencyKeyReusedError(key)
+
+            entry.done.wait()
+            if entry.succeeded:
+                CACHE_REQUESTS.inc(cache=self.name, result="hit")
+                return entry.result, True
+            # the computation failed and was removed, compute again
+
+        CACHE_REQUESTS.inc(cache=self.name, result="miss")
+        try:
+            result = compute()
+        except Exception:
+            with self._lock:
+                del self._in_flight[key]
+            entry.done.set()
+            raise
+
+        with self._lock:
+            now = time.monotonic()
+            entry.result = result
+            entry.succeeded = True
+            entry.expires_at = now + self.ttl_seconds
+            del self._in_flight[key]
+            if keep is None or keep(result):
+                self._entries[key] = entry
+                self._evict(now)
+        entry.done.set()
+
+        return result, False
+
+    def _evict(self, now: float) -> None:
+        """
+        Drop expired entries and the oldest ones above `max_entries`, must hold the lock.
+
+        Entries are in expiry order, so only the ones evicted and the first one kept are looked at. In-flight entries
+        are never evicted.
+        """
+        while self._entries:
+            oldest = next(iter(self._entries.values()))
+            if oldest.expires_at > now and len(self._entries) <= self.max_entries:
+                break
+            self._entries.popitem(last=False)
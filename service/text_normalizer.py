@@ -0,0 +1,75 @@
+"""Canonicalization of text before local moderation, so trivial obfuscations match the moderation terms."""
+import re
+import unicodedata
+from typing import List
+
+# invisible characters used to split words: soft hyphen, mongolian vowel separator, zero-width space, non-joiner,
+# joiner, word joiner and byte order mark
+ZERO_WIDTH_CHARACTERS = "\u00ad\u180e\u200b\u200c\u200d\u2060\ufeff"
+
+APOSTROPHES = "‘’‚‛ʼʹ`´′"
+QUOTES = "“”„‟″"
+
+# lowercase letters of other scripts that look like latin ones, applied after casefolding
+CONFUSABLES = {
+    # cyrillic
+    "а": "a", "в": "b", "е": "e", "ё": "e", "к": "k", "м": "m", "н": "h", "о": "o", "р": "p", "с": "c", "т": "t",
+    "у": "y", "х": "x", "і": "i", "ї": "i", "ј": "j", "ѕ": "s", "ԁ": "d", "ӏ": "l", "ԛ": "q", "ԝ": "w",
+    # greek
+    "α": "a", "ε": "e", "η": "n", "ι": "i", "κ": "k", "ν": "v", "ο": "o", "ρ": "p", "τ": "t", "υ": "u", "χ": "x",
+    "ω": "w",
+    # latin lookalikes
+    "ı": "i", "ɡ": "g", "ɑ": "a", "ʟ": "l",
+}
+
+CANONICAL_TABLE = str.maketrans({
+    **{char: None for char in ZERO_WIDTH_CHARACTERS},
+    **{char: "'" for char in APOSTROPHES},
+    **{char: '"' for char in QUOTES},
+    **CONFUSABLES,
+})
+
+# only applied within words that have letters too, so numbers like "under 18" are left alone
+LEET_TABLE = str.maketrans({"0": "o", "1": "i", "3": "e", "4": "a", "5": "s", "7": "t", "@": "a", "$": "s"})
+# "1" stands for "l" as often as for "i", texts with it are matched in both readings
+LEET_L_TABLE = str.maketrans({**LEET_TABLE, ord("1"): "l"})
+_LEET_CHARACTERS = re.compile(r"[013457@$]")
+_LEET_WORD = re.compile(r"[a-z0-9@$]*[a-z][a-z0-9@$]*")
+
+_REPEATED_CHARACTERS = re.compile(r"(.)\1+")
+
+
+def canonicalize(text: str) -> str:
+    """
+    Canonicalize text for matching.
+
+    Compatibility characters (fullwidth letters, ligatures) are decomposed, the text is casefolded, zero-width
+    characters are removed, curly apostrophes and quotes are straightened, confusable letters of other scripts
+    become latin ones and leetspeak within words is decoded, e.g. "5tup1d" becomes "stupid".
+    """
+    return canonical_variants(text)[0]
+
+
+def canonical_variants(text: str) -> List[str]:
+    """
+    Canonicalize text for matching in every reading of its leetspeak.
+
+    Like `canonicalize`, but a text with "1" within a word also comes in the reading where it's an "l", e.g. "ki11"
+    is both "kiii" and "kill". The `canonicalize` reading is always first.
+    """
+    text = unicodedata.normalize("NFKC", text).casefold().translate(CANONICAL_TABLE)
+    if not _LEET_CHARACTERS.search(text):
+        return [text]
+
+    words = _LEET_WORD.findall(text)
+    tables = [LEET_TABLE, LEET_L_TABLE] if any("1" in word for word in words) else [LEET_TABLE]
+    return [_LEET_WORD.sub(lambda word: word.group().translate(table), text) for table in tables]
+
+
+def squeeze(text: str) -> str:
+    """
+    Collapse runs of a repeated character into one, e.g. "stuuupid" becomes "stupid".
+
+    Terms must be squeezed the same way as the texts they're matched against, "kill" becomes "kil" too.
+    """
+    return _REPEATED_CHARACTERS.sub(r"\1", text)
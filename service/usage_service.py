@@ -0,0 +1,216 @@
+"""Token and cost accounting for the LLM calls."""
+import bisect
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+from .metrics import default_metrics_registry
+from ..config import settings
+from ..dto import UserProfile
+
+UNKNOWN_COHORT = "unknown"
+
+# dedupe keys remembered, e.g. batch output lines that are ingested on every poll
+MAX_DEDUPE_KEYS = 100_000
+
+LLM_CALLS = default_metrics_registry.counter(
+    "coaching_llm_calls_total", "LLM calls with recorded usage.", ["call_site", "model", "cohort"]
+)
+LLM_TOKENS = default_metrics_registry.counter(
+    "coaching_llm_tokens_total",
+    "LLM tokens by kind: prompt, cached_prompt (part of prompt) or completion.",
+    ["call_site", "model", "cohort", "kind"],
+)
+LLM_COST = default_metrics_registry.counter(
+    "coaching_llm_cost_usd_total", "Estimated LLM cost in USD.", ["call_site", "model", "cohort"]
+)
+
+
+def user_cohort(user_profile: Optional[UserProfile]) -> str:
+    """Cohort of the user for cost reporting, their age band from `settings.USAGE_COHORT_AGE_BOUNDARIES`."""
+    if user_profile is None:
+        return UNKNOWN_COHORT
+    return age_band(user_profile.age)
+
+
+def age_band(age: int) -> str:
+    """Band of `settings.USAGE_COHORT_AGE_BOUNDARIES` the age is in, e.g. "age_13_15"."""
+    boundaries = settings.USAGE_COHORT_AGE_BOUNDARIES
+    index = bisect.bisect_right(boundaries, age)
+    low = boundaries[index - 1] if index > 0 else None
+    high = boundaries[index] - 1 if index < len(boundaries) else None
+
+    if low is None:
+        return f"age_under_{high + 1}"
+    if high is None:
+        return f"age_{low}_plus"
+    return f"age_{low}_{high}"
+
+
+def _usage_value(usage: Any, *path: str) -> int:
+    """Read a token count from an SDK usage object or the usage dict of a batch output line."""
+    value = usage
+    for key in path:
+        if value is None:
+            return 0
+        value = value.get(key) if isinstance(value, dict) else getattr(value, key, None)
+    return int(value or 0)
+
+
+def _prices(model: str) -> Dict[str, float]:
+    """Prices of the model, responses name a dated snapshot (e.g. gpt-4o-mini-2024-07-18) so prefixes match too."""
+    prices = settings.LLM_PRICES_PER_MILLION_TOKENS
+    if model in prices:
+        return prices[model]
+    matches = [name for name in prices if model.startswith(name)]
+    return prices[max(matches, key=len)] if matches else {}
+
+
+class _Totals:
+    __slots__ = ("calls", "prompt_tokens", "cached_prompt_tokens", "completion_tokens", "cost_usd", "cache_savings_usd")
+
+    def __init__(self):
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.cached_prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cost_usd = 0.0
+        self.cache_savings_usd = 0.0
+
+    def to_dict(self) -> Dict[str, float]:
+        return {field: getattr(self, field) for field in self.__slots__}
+
+
+class UsageTracker:
+    """
+    In-memory aggregate of the tokens used by every LLM call, by call site, model and user cohort.
+
+    Costs are estimated from `settings.LLM_PRICES_PER_MILLION_TOKENS`. Delivered recommendations are counted per
+    cohort, so the cost per recommendation includes the moderation calls, discarded speculative completions and
+    hedges it took to produce them.
+    """
+
+    def __init__(self):
+        self._totals: Dict[Tuple[str, str, str], _Totals] = {}
+        self._recommendations: Dict[str, int] = {}
+        self._dedupe_keys: "OrderedDict[str, None]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def record(
+        self,
+        call_site: str,
+        model: str,
+        usage: Any,
+        cohort: str = UNKNOWN_COHORT,
+        price_multiplier: float = 1.0,
+        dedupe_key: Optional[str] = None,
+    ) -> None:
+        """
+        Record the usage of a call.
+
+        Args:
+            call_site (str): Where the call was made, e.g. recommendation or behavior_alert.
+            model (str): The model that served the call.
+            usage (Any): The `usage` of the response, an SDK object or dict, None if the endpoint doesn't report it.
+            cohort (str): The user's cohort, see `user_cohort`.
+            price_multiplier (float): Discount applied to the price, e.g. for the Batch API.
+            dedupe_key (Optional[str]): Usage with a key that was already recorded is ignored.
+        """
+        prompt_tokens = _usage_value(usage, "prompt_tokens")
+        cached_tokens = _usage_value(usage, "prompt_tokens_details", "cached_tokens")
+        completion_tokens = _usage_value(usage, "completion_tokens")
+
+        prices = _prices(model)
+        prompt_price = prices.get("prompt", 0.0) * price_multiplier / 1e6
+        cached_price = prices.get("cached_prompt", prices.get("prompt", 0.0)) * price_multiplier / 1e6
+        completion_price = prices.get("completion", 0.0) * price_multiplier / 1e6
+
+        cost = (
+            (prompt_tokens - cached_tokens) * prompt_price
+            + cached_tokens * cached_price
+            + completion_tokens * completion_price
+        )
+
+        with self._lock:
+            if not self._first_time(dedupe_key):
+                return
+            totals = self._totals.setdefault((call_site, model, cohort), _Totals())
+            totals.calls += 1
+            totals.prompt_tokens += prompt_tokens
+            totals.cached_prompt_tokens += cached_tokens
+            totals.completion_tokens += completion_tokens
+            totals.cost_usd += cost
+            totals.cache_savings_usd += cached_tokens * (prompt_price - cached_price)
+
+        labels = {"call_site": call_site, "model": model, "cohort": cohort}
+        LLM_CALLS.inc(**labels)
+        LLM_TOKENS.inc(prompt_tokens, kind="prompt", **labels)
+        LLM_TOKENS.inc(cached_tokens, kind="cached_prompt", **labels)
+        LLM_TOKENS.inc(completion_tokens, kind="completion", **labels)
+        LLM_COST.inc(cost, **labels)
+
+    def record_recommendation(self, cohort: str = UNKNOWN_COHORT, dedupe_key: Optional[str] = None) -> None:
+        """Count a delivered recommendation for the cost per recommendation."""
+        with self._lock:
+            if self._first_time(dedupe_key):
+                self._recommendations[cohort] = self._recommendations.get(cohort, 0) + 1
+
+    def report(
+        self,
+        call_site: Optional[str] = None,
+        model: Optional[str] = None,
+        cohort: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        """
+        Usage totals matching the filters, by call site, model and cohort, and the cost per recommendation.
+
+        Returns:
+            Dict[str, Any]: `usage` rows, their `totals`, and per cohort the `recommendations` delivered and their
+                `cost_per_recommendation_usd` across the recommendation call sites.
+        """
+        with self._lock:
+            rows = [
+                (key, totals.to_dict()) for key, totals in self._totals.items()
+                if (call_site is None or key[0] == call_site)
+                and (model is None or key[1] == model)
+                and (cohort is None or key[2] == cohort)
+            ]
+            recommendations = {
+                key: count for key, count in self._recommendations.items() if cohort is None or key == cohort
+            }
+            recommendation_cost: Dict[str, float] = {}
+            for (site, _, row_cohort), totals in self._totals.items():
+                if site in settings.USAGE_RECOMMENDATION_CALL_SITES and row_cohort in recommendations:
+                    recommendation_cost[row_cohort] = recommendation_cost.get(row_cohort, 0.0) + totals.cost_usd
+
+        overall = _Totals()
+        for _, totals in rows:
+            for field, value in totals.items():
+                setattr(overall, field, getattr(overall, field) + value)
+
+        return {
+            "usage": [
+                {"call_site": site, "model": row_model, "cohort": row_cohort, **totals}
+                for (site, row_model, row_cohort), totals in sorted(rows)
+            ],
+            "totals": overall.to_dict(),
+            "recommendations": recommendations,
+            "cost_per_recommendation_usd": {
+                key: recommendation_cost.get(key, 0.0) / count for key, count in recommendations.items() if count
+            },
+        }
+
+    def _first_time(self, dedupe_key: Optional[str]) -> bool:
+        """Whether the key wasn't seen before, must hold the lock."""
+        if dedupe_key is None:
+            return True
+        if dedupe_key in self._dedupe_keys:
+            return False
+        self._dedupe_keys[dedupe_key] = None
+        if len(self._dedupe_keys) > MAX_DEDUPE_KEYS:
+            self._dedupe_keys.popitem(last=False)
+        return True
+
+
+# TODO: replace with DI/singleton
+default_usage_tracker = UsageTracker()
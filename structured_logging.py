@@ -0,0 +1,142 @@
+"""
+Logging handlers, formatters and filters referenced by `log_conf.yaml`.
+
+This module is loaded by dotted path from the logging config, possibly before the app package is importable, so it
+must not import from the app.
+"""
+import atexit
+import json
+import logging
+import queue
+import random
+import sys
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Dict, Optional, TextIO
+
+# attributes every LogRecord has, anything else was passed through `extra` and is emitted as a field
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "taskName"}
+
+
+def _event(record: logging.LogRecord) -> str:
+    """The event of a record, the part of its message template before " - ", e.g. "Recommendation created"."""
+    return str(record.msg).split(" - ", 1)[0]
+
+
+def _truncate(value: str, max_length: int) -> str:
+    if len(value) <= max_length:
+        return value
+    return f"{value[:max_length]}...[{len(value) - max_length} more chars]"
+
+
+class AsyncStreamHandler(QueueHandler):
+    """
+    Stream handler that writes from a background thread.
+
+    Records are put on a bounded queue as they are, without formatting them, so the calling thread only pays for the
+    filters. A listener thread formats and writes them. Records are dropped, and counted, when the queue is full
+    rather than blocking a request on a slow stream.
+    """
+
+    def __init__(self, stream: Optional[TextIO] = None, max_queue_size: int = 10_000):
+        super().__init__(queue.Queue(maxsize=max_queue_size))
+        self.dropped = 0
+        self._target = logging.StreamHandler(stream or sys.stderr)
+        self._listener = QueueListener(self.queue, self._target)
+        self._listener.start()
+        self._stopped = False
+        atexit.register(self.close)
+
+    def setFormatter(self, fmt: Optional[logging.Formatter]) -> None:
+        # formatting happens on the listener thread
+        self._target.setFormatter(fmt)
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # the record stays in process, its message and arguments are only formatted when it's written
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self) -> None:
+        """Write the queued records and stop the listener thread."""
+        if not self._stopped:
+            self._stopped = True
+            self._listener.stop()
+        self._target.close()
+        super().close()
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats records as one JSON object per line.
+
+    The message's arguments and `extra` fields are rendered and truncated to `max_field_length` characters, so a
+    large payload logged by mistake can't flood the stream.
+    """
+
+    def __init__(self, max_field_length: int = 1000, **kwargs):
+        super().__init__(**kwargs)
+        self.max_field_length = max_field_length
+
+    def format(self, record: logging.LogRecord) -> str:
+        document: Dict[str, Any] = {
+            "timestamp": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "event": _event(record),
+            "message": self._message(record),
+        }
+
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and key not in document:
+                document[key] = value if isinstance(value, (int, float, bool)) or value is None else self._field(value)
+
+        if record.exc_info:
+            document["exception"] = self.formatException(record.exc_info)
+
+        return json.dumps(document, default=str)
+
+    def _message(self, record: logging.LogRecord) -> str:
+        message = str(record.msg)
+        if record.args:
+            args = record.args
+            if isinstance(args, tuple):
+                args = tuple(a if isinstance(a, (int, float)) else self._field(a) for a in args)
+            try:
+                message = message % args
+            except (TypeError, ValueError):
+                message = f"{message} {args}"
+        return _truncate(message, self.max_field_length * 2)
+
+    def _field(self, value: Any) -> str:
+        return _truncate(str(value), self.max_field_length)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keeps a fraction of the records of high-volume events.
+
+    Events are identified by their message template, see `_event`. Warnings and errors are always kept.
+    """
+
+    def __init__(self, rates: Optional[Dict[str, float]] = None, name: str = ""):
+        """
+        Initialize the filter.
+
+        Args:
+            rates (Optional[Dict[str, float]]): Fraction of the records kept per event, events not listed are kept.
+            name (str): Only records of this logger and its children are filtered.
+        """
+        super().__init__(name)
+        self.rates = rates or {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not super().filter(record) or record.levelno >= logging.WARNING:
+            return True
+        rate = self.rates.get(_event(record))
+        return rate is None or random.random() < rate